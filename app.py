@@ -14,19 +14,29 @@
 # limitations under the License.
 #
 
+import argparse
 import base64
 import cv2
-import json
+import geometry
 import numpy as np
+import os
 import requests
-import threading
 import time
 
+from collections import deque, namedtuple
 from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, render_template, Response
+from flask import Flask, abort, render_template, request, Response
 from gevent import monkey
-from io import BytesIO
-from PIL import Image
+from imaging import FramePyramid, SceneChangeDetector, get_jpeg_encoder
+from inference import BatchingGateway, InferenceRouter, submit_face_crops
+from journal import JournalWriter, SessionJournal
+from metrics import MetricsRegistry
+from scheduling import InferenceScheduler, OutputController, RequestBudget
+from sessions import SessionRegistry
+from stages import Prefetch, StagePool
+from tracking import (FlowTracker, FrameRing, TrackStore, replay_frames,
+                      select_replay_frames)
+from workers import WorkerPool
 try:
     from flask.ext.socketio import SocketIO, emit
 except ImportError:
@@ -39,20 +49,174 @@ monkey.patch_all()
 app = Flask(__name__)
 app.config.from_object('config')
 
-# Condition variable for passing incoming frames to the video processing thread
-app.condition_var = threading.Condition()
-
-# Zero or one-element list holding the most recent video frame, if available.
-# Guarded by app.condition_var.
-app.latest_frame_list = []
+# Per-browser sessions, keyed by Socket.IO session id. Each session has its own
+# frame slot and its own gen() loop.
+app.sessions = SessionRegistry(app.config['MAX_SESSIONS'],
+                               app.config['SESSION_IDLE_TIMEOUT_SEC'])
 
 # Time that the most recent iteration of the main image processing loop began.
 # Used for calculating and printing FPS and latency.
 app.start_time = time.time()
 
+# Shared, connection-pooling client for the replicas of the MAX model server
+# (an InferenceRouter), and the gateway that batches requests to it from all
+# sessions
+app.inference_client = None
+app.inference_gateway = None
+
+# Threads on which trackers catch up with the video after a new inference
+# result, off the display path
+app.catchup_executor = ThreadPoolExecutor(max_workers=app.config['CATCHUP_WORKERS'])
+
+# Global limit on the rate of requests to the model server, shared by all
+# sessions
+app.inference_budget = RequestBudget(app.config['INFERENCE_BUDGET_PER_SEC'])
+
+# JPEG encoder used for both display frames and inference uploads
+app.jpeg_encoder = get_jpeg_encoder(app.config['JPEG_ENCODER'])
+
+# Per-stage latencies and frame counters, served on /metrics
+app.metrics = MetricsRegistry()
+app.stage_latency = app.metrics.histogram(
+    'age_estimator_stage_seconds',
+    'Time spent in each stage of the frame pipeline', ['stage'])
+app.frame_latency = app.metrics.histogram(
+    'age_estimator_frame_latency_seconds',
+    'Time from receiving a frame to sending its result')
+app.inference_batch_size = app.metrics.histogram(
+    'age_estimator_inference_batch_size',
+    'Inference requests per batch sent to the model server',
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+app.inference_batch_latency = app.metrics.histogram(
+    'age_estimator_inference_batch_seconds',
+    'Time from dispatching a batch of inference requests to its last result')
+app.frames_received = app.metrics.counter(
+    'age_estimator_frames_received_total', 'Frames received from browsers')
+app.frames_dropped = app.metrics.counter(
+    'age_estimator_frames_dropped_total',
+    'Frames dropped without a result being sent', ['reason'])
+app.frames_sent = app.metrics.counter(
+    'age_estimator_frames_sent_total', 'Results sent to browsers')
+app.inference_inflight = app.metrics.gauge(
+    'age_estimator_inference_inflight', 'Inference requests in flight')
+app.scene_cache = app.metrics.counter(
+    'age_estimator_scene_cache_total',
+    'Frames on which an inference request was saved because the scene had not '
+    'changed (hit), or sent (miss)', ['result'])
+app.inference_failures = app.metrics.counter(
+    'age_estimator_inference_failures_total', 'Failed inference requests')
+app.replica_events = app.metrics.counter(
+    'age_estimator_model_replica_events_total',
+    'Model server replicas ejected, reinstated and found slow, and requests failed over and hedged',
+    ['event', 'endpoint'])
+
+
+def replica_values(value_fn):
+    """Per-replica gauge values, read at render time."""
+    if app.inference_client is None:
+        return {}
+    return {(r.endpoint,): value_fn(r) for r in app.inference_client.replicas}
+
+
+app.metrics.gauge('age_estimator_model_replica_healthy',
+                  'Whether each model server replica is taking requests', ['endpoint'],
+                  value_fn=lambda: replica_values(lambda r: int(r.healthy)))
+app.metrics.gauge('age_estimator_model_replica_outstanding',
+                  'Requests in flight to each model server replica', ['endpoint'],
+                  value_fn=lambda: replica_values(lambda r: r.outstanding))
+app.metrics.gauge('age_estimator_sessions', 'Active sessions',
+                  value_fn=lambda: len(app.sessions))
+app.metrics.gauge('age_estimator_workers_alive', 'Worker processes running',
+                  value_fn=lambda: 0 if app.worker_pool is None else app.worker_pool.num_alive)
+app.worker_restarts = app.metrics.counter(
+    'age_estimator_worker_restarts_total', 'Worker processes restarted')
+
+# Native threads on which the CPU-bound stages of all sessions' pipelines run,
+# off the event loop (see init_stage_pool())
+app.stage_pool = None
+
+
+def output_values(value_fn):
+    """Per-session gauge values of the sessions with adaptive video output,
+    read at render time."""
+    return {(s.sid,): value_fn(s.output) for s in app.sessions.all() if s.output is not None}
+
+
+app.metrics.gauge('age_estimator_display_width_pixels',
+                  'Width of the annotated frames sent to each browser', ['session'],
+                  value_fn=lambda: output_values(lambda o: o.width_px))
+app.metrics.gauge('age_estimator_display_jpeg_quality',
+                  'JPEG quality of the annotated frames sent to each browser', ['session'],
+                  value_fn=lambda: output_values(lambda o: o.quality))
+app.metrics.gauge('age_estimator_display_drain_bytes_per_second',
+                  'Rate at which each browser takes the annotated video', ['session'],
+                  value_fn=lambda: output_values(lambda o: o.drain_bytes_per_sec or 0.))
+
+# Writes the session journals, once the first one is opened (see
+# open_journal())
+app.journal_writer = None
+app.metrics.gauge('age_estimator_journal_records_dropped',
+                  'Journal records dropped because the writer fell behind',
+                  value_fn=lambda: 0 if app.journal_writer is None else app.journal_writer.num_dropped)
+
+# Worker processes that run the sessions' pipelines, if enabled (see
+# start_workers()). Otherwise every pipeline runs in this process.
+app.worker_pool = None
+
 socketio = SocketIO(app)
 
 
+def init_inference():
+    """(Re)create the model server client and batching gateway from app.config."""
+    if app.inference_client is not None:
+        app.inference_client.close()
+    app.inference_client = InferenceRouter(
+        app.config['ML_ENDPOINTS'],
+        pool_size=app.config['INFERENCE_POOL_SIZE'],
+        connect_timeout_sec=app.config['INFERENCE_CONNECT_TIMEOUT_SEC'],
+        read_timeout_sec=app.config['INFERENCE_READ_TIMEOUT_SEC'],
+        health_check_interval_sec=app.config['INFERENCE_HEALTH_CHECK_INTERVAL_SEC'],
+        health_check_timeout_sec=app.config['INFERENCE_HEALTH_CHECK_TIMEOUT_SEC'],
+        hedge=app.config['INFERENCE_HEDGE'],
+        hedge_percentile=app.config['INFERENCE_HEDGE_PERCENTILE'],
+        hedge_min_delay_sec=app.config['INFERENCE_HEDGE_MIN_DELAY_SEC'],
+        slow_factor=app.config['INFERENCE_SLOW_REPLICA_FACTOR'],
+        slow_eject_sec=app.config['INFERENCE_SLOW_REPLICA_EJECT_SEC'],
+        on_event=lambda event, endpoint: app.replica_events.labels(event, endpoint).inc())
+    if app.inference_gateway is not None:
+        app.inference_gateway.close()
+    app.inference_gateway = BatchingGateway(
+        predict_age_local,
+        max_batch_size=app.config['INFERENCE_BATCH_MAX_SIZE'],
+        max_wait_sec=app.config['INFERENCE_BATCH_MAX_WAIT_SEC'],
+        mode=app.config['INFERENCE_BATCH_MODE'],
+        num_workers=app.config['INFERENCE_POOL_SIZE'],
+        batch_size=app.inference_batch_size,
+        batch_latency=app.inference_batch_latency)
+
+
+def init_stage_pool():
+    """(Re)create the pool that runs the CPU-bound pipeline stages from
+    app.config."""
+    if app.stage_pool is not None:
+        app.stage_pool.close()
+    app.stage_pool = StagePool(app.config['STAGE_THREADS'], app.stage_latency)
+
+
+def open_journal(session):
+    """Start recording a session to a new journal directory under
+    JOURNAL_DIR."""
+    if app.journal_writer is None:
+        app.journal_writer = JournalWriter(app.config['JOURNAL_MAX_QUEUED'])
+    path = os.path.join(app.config['JOURNAL_DIR'], '{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S'), session.sid))
+    session.journal = SessionJournal(
+        app.journal_writer, path,
+        {'sid': session.sid, 'output_mode': session.output_mode, 'mirror': session.mirror},
+        segment_bytes=app.config['JOURNAL_SEGMENT_BYTES'],
+        max_segments=app.config['JOURNAL_MAX_SEGMENTS'])
+
+
 ################################################################################
 # HANDLERS
 
@@ -62,6 +226,59 @@ def index():
     return render_template('index.html')
 
 
+def start_session():
+    """
+    Create the processing pipeline for the Socket.IO client making the
+    current request and tell the client about it.
+
+    The client picks its output mode with the 'output' query parameter of
+    its Socket.IO connection.
+
+    Returns the new Session, or None if the server is full.
+    """
+    output_mode = request.args.get('output', app.config['OUTPUT_MODE'])
+    if output_mode not in ('video', 'annotations'):
+        output_mode = app.config['OUTPUT_MODE']
+    session = app.sessions.create(request.sid, output_mode,
+                                  app.config['FLOW_CONTROL_CREDITS'], grant_credit)
+    if session is None:
+        print("Refusing session {}: {} sessions active"
+              "".format(request.sid, len(app.sessions)))
+        return None
+    if app.config['JOURNAL_ENABLED']:
+        open_journal(session)
+    if app.worker_pool is not None:
+        app.worker_pool.open(request.sid, output_mode, session.credits)
+    elif output_mode == 'annotations':
+        # Nobody will request /video_feed, so drive the pipeline ourselves.
+        socketio.start_background_task(stream_annotations, session)
+    # The browser may send as many frames as it has credits; see
+    # grant_credit().
+    emit('session', {'sid': request.sid, 'output_mode': output_mode,
+                     'credits': session.credits})
+    return session
+
+
+@app.route('/metrics')
+def metrics():
+    """Pipeline metrics in the Prometheus text format."""
+    return Response(app.metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@socketio.on('connect', namespace='/streaming')
+def connect():
+    if start_session() is None:
+        return False
+
+
+@socketio.on('disconnect', namespace='/streaming')
+def disconnect():
+    app.sessions.remove(request.sid)
+    if app.worker_pool is not None:
+        app.worker_pool.close(request.sid)
+
+
 @socketio.on('netin', namespace='/streaming')
 def msg(dta):
     emit('response', {'data': dta['data']})
@@ -74,26 +291,207 @@ def connected():
 
 @socketio.on('streamingvideo', namespace='/streaming')
 def webdata(dta):
-    print("{:5.3f} Image received".format(time.time() - app.start_time))
-    with app.condition_var:
-        # Clear stale frames. In the future we may retain some of these frames
-        # to aid in object tracking.
-        app.latest_frame_list.clear()
-        app.latest_frame_list.append(dta['data'])
-        app.condition_var.notify()
+    if app.config['LOG_FRAMES']:
+        print("{:5.3f} Image received".format(time.time() - app.start_time))
+    app.frames_received.inc()
+    session = app.sessions.get(request.sid)
+    if session is None:
+        # Session was evicted while idle; start a new one and tell the browser
+        # to reconnect its video feed.
+        session = start_session()
+        if session is None:
+            app.frames_dropped.labels('refused').inc()
+            return
+    if not session.take_credit():
+        # The browser sent a frame without waiting for a credit.
+        app.frames_dropped.labels('no_credit').inc()
+        return
+    frame = dta['data']
+    received_ts = time.time()
+    if session.journal is not None:
+        frame = jpeg_bytes(frame)
+        session.journal.record_frame(frame, dta.get('frame_id'), received_ts)
+    if app.worker_pool is not None:
+        session.touch()
+        if not app.worker_pool.put_frame(request.sid, jpeg_bytes(frame),
+                                         dta.get('frame_id'), received_ts):
+            app.frames_dropped.labels('worker_busy').inc()
+            session.return_credit()
+        return
+    if session.put_frame(frame, dta.get('frame_id'), received_ts):
+        # The pipeline hadn't gotten to the previous frame yet.
+        app.frames_dropped.labels('superseded').inc()
+
+
+@socketio.on('streamingframe', namespace='/streaming')
+def webframe(jpeg_bytes, frame_id=None):
+    """Binary frame path: the payload is the raw JPEG bytes of the frame."""
+    webdata({'data': bytes(jpeg_bytes), 'frame_id': frame_id})
 
 
 @app.route('/video_feed')
 def video_feed():
-    """Video streaming route. Put this in the src attribute of an img tag."""
-    return Response(gen(),
+    """
+    Video streaming route. Put this in the src attribute of an img tag, with
+    the Socket.IO session id as the 'sid' query parameter.
+    """
+    session = app.sessions.get(request.args.get('sid'))
+    if session is None:
+        abort(404)
+    if app.worker_pool is not None:
+        return Response(forward_video(session),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
+    if app.config['ADAPTIVE_DISPLAY'] and session.output is None:
+        session.output = OutputController(
+            max_width_px=app.config['DISPLAY_IMAGE_WIDTH_PX'],
+            min_width_px=app.config['DISPLAY_MIN_WIDTH_PX'],
+            max_quality=app.config['DISPLAY_JPEG_QUALITY'],
+            min_quality=app.config['DISPLAY_MIN_JPEG_QUALITY'],
+            target_latency_sec=app.config['DISPLAY_TARGET_LATENCY_SEC'],
+            adapt_interval_sec=app.config['DISPLAY_ADAPT_INTERVAL_SEC'])
+    return Response(gen(session),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
+def stream_annotations(session):
+    """
+    Background task that runs the pipeline of a session in 'annotations'
+    output mode and sends each frame's boxes and ages to the browser.
+    """
+    for message in gen(session):
+        socketio.emit('annotations', message, room=session.sid,
+                      namespace='/streaming')
+
+
+def reap_idle_sessions():
+    """Background task that periodically evicts idle sessions."""
+    while True:
+        socketio.sleep(app.config['SESSION_IDLE_TIMEOUT_SEC'] / 2)
+        for sid in app.sessions.evict_idle():
+            print("Evicted idle session {}".format(sid))
+            if app.worker_pool is not None:
+                app.worker_pool.close(sid)
+
+
+################################################################################
+# WORKER MODE
+
+def start_workers(num_workers):
+    """
+    Run the sessions' pipelines in num_workers worker processes, with this
+    process only passing frames and results between them and the browsers.
+    """
+    config = {key: value for key, value in app.config.items() if key.isupper()}
+    app.worker_pool = WorkerPool(
+        num_workers, config, on_worker_credit, on_worker_annotations,
+        on_worker_restart,
+        num_slots=app.config['WORKER_RING_SLOTS'],
+        slot_bytes=app.config['WORKER_RING_SLOT_BYTES'],
+        heartbeat_sec=app.config['WORKER_HEARTBEAT_SEC'],
+        heartbeat_timeout_sec=app.config['WORKER_HEARTBEAT_TIMEOUT_SEC']).start()
+
+
+def forward_video(session):
+    """Annotated video of a session from its worker, for /video_feed."""
+    for chunk, received_ts in app.worker_pool.video_frames(session.sid):
+        record_frame_sent(received_ts)
+        yield chunk
+
+
+def on_worker_credit(sid, processing_fps):
+    session = app.sessions.get(sid)
+    if session is not None:
+        session.return_credit(processing_fps=processing_fps)
+
+
+def on_worker_annotations(sid, message, received_ts):
+    socketio.emit('annotations', message, room=sid, namespace='/streaming')
+    record_frame_sent(received_ts)
+
+
+def on_worker_restart(sids):
+    app.worker_restarts.inc()
+    # The frames these sessions had in flight are gone.
+    for sid in sids:
+        session = app.sessions.get(sid)
+        if session is not None:
+            session.restore_credits()
+
+
 ################################################################################
 # MAIN LOOP
 
-def gen():
+def gen(session, with_received_ts=False):
+    """
+    Main image processing loop for one browser session.
+
+    Args:
+        session: Session object whose frames this loop consumes. All tracking
+            and inference state is private to the session.
+        with_received_ts: Yield (result, received_ts) tuples, where
+            received_ts is the time the result's frame was received
+
+    Yields one result per frame: a multipart JPEG chunk for /video_feed in
+    'video' output mode, or an annotation message (see
+    annotation_message()) in 'annotations' output mode.
+    """
+    # The next frame is decoded while the current one goes through the rest
+    # of the pipeline.
+    decoded = Prefetch(decode_frames(session))
+    try:
+        for result, received_ts in process_frames(session, decoded):
+            yield (result, received_ts) if with_received_ts else result
+    finally:
+        decoded.close()
+
+
+def decode_frames(session):
+    """
+    Yields the frames of a session as (RGB image, frame id, received_ts)
+    tuples, mirrored if the session is, until the session is closed. Frames
+    that cannot be decoded are dropped.
+    """
+    # Factor (1, 2, 4 or 8) by which incoming JPEGs are downscaled while they
+    # are decoded. Decoding at reduced resolution is much cheaper than
+    # decoding at full size and resizing afterwards.
+    DECODE_REDUCTION = app.config['FRAME_DECODE_REDUCTION']
+
+    # How long to wait for a frame before checking again whether the session
+    # was closed
+    GET_FRAME_TIMEOUT_SEC = 1.0
+
+    while True:
+        next_frame = session.get_frame(GET_FRAME_TIMEOUT_SEC)
+        if next_frame is None:
+            if session.closed:
+                return
+            continue
+        img_data, frame_id, received_ts = next_frame
+        try:
+            raw_img_np_frame = app.stage_pool.run('decode', decode_frame, img_data,
+                                                  DECODE_REDUCTION)
+        except ValueError as e:
+            print("Dropping frame: {}".format(e))
+            app.frames_dropped.labels('undecodable').inc()
+            continue
+
+        # Mirror effect. Flipping in place saves a full-frame copy.
+        if session.mirror:
+            app.stage_pool.run('flip', cv2.flip, raw_img_np_frame, 1, raw_img_np_frame)
+        yield raw_img_np_frame, frame_id, received_ts
+
+
+def process_frames(session, decoded):
+    """
+    Body of gen(): everything after decoding.
+
+    Args:
+        session: Session object the frames belong to
+        decoded: Iterator over the session's decoded frames; see
+            decode_frames()
+
+    Yields (result, received_ts) tuples; see gen().
+    """
     # FPS now regulated in client.
     # TARGET_FPS = 30.0
     # FRAME_TIME_INTERVAL = 1.0 / TARGET_FPS
@@ -104,12 +502,20 @@ def gen():
     # Width of the images we use for local object tracking
     TRACKING_IMAGE_WIDTH_PX = 256
 
-    # Width of the images we send back to the browser
-    DISPLAY_IMAGE_WIDTH_PX = 1024
+    # Width and JPEG quality of the images we send back to the browser,
+    # unless the session adapts them to the browser's link (see
+    # OutputController)
+    DISPLAY_IMAGE_WIDTH_PX = app.config['DISPLAY_IMAGE_WIDTH_PX']
+    DISPLAY_JPEG_QUALITY = app.config['DISPLAY_JPEG_QUALITY']
+    output = session.output
 
     # If True, skip all the machine learning stuff to help debug end-to-end
     # latency issues.
-    SKIP_INFERENCE = False
+    SKIP_INFERENCE = app.config['SKIP_INFERENCE']
+
+    # If True, send only box coordinates and ages to the browser instead of
+    # annotated video frames.
+    annotations_only = session.output_mode == 'annotations'
 
     # Factor to use for exponentially decaying averages.
     # 0.0 => ignore new values, 1.0 => ignore old values
@@ -119,132 +525,346 @@ def gen():
     # for choosing box color.
     frames_since_update = 0
 
-    tracker = cv2.MultiTracker_create()
-    executor = ThreadPoolExecutor(max_workers=1)
-    future = None
-
-    # The image submitted for the most recent inference request, downsampled
-    # to a width of TRACKING_IMAGE_WIDTH_PX pixels
-    last_inference_image = None
-
-    # List of images captured since the last time an image was submitted to
-    # the expensive backend model. Image size determined by
-    # TRACKING_IMAGE_WIDTH_PX.
-    images_since_submit = []
-
-    # Bounding boxes of faces in the most recent frame, relative to
-    # TRACKING_IMAGE_WIDTH_PX.
-    bounding_boxes = []
-
-    # Age estimates corresponding to the bounding boxes.
-    # When more than one age has been received, these are exponentially
-    # decaying averages
-    age_results = []
+    # Maximum number of inference requests this session keeps in flight
+    MAX_INFLIGHT_REQUESTS = app.config['INFERENCE_MAX_INFLIGHT']
+
+    # Versions of the current frame at the widths above, reusing buffers from
+    # one frame to the next
+    pyramid = FramePyramid()
+
+    # Time by which to decide when to ask the model again; see Session.clock
+    clock = session.clock
+
+    def result_due(request):
+        """Whether to apply the result of a PendingRequest now; see
+        Session.result_delay_sec."""
+        if session.result_delay_sec is None:
+            return request.future.done()
+        return clock() - request.submit_ts >= session.result_delay_sec
+
+    # Skips inference while the camera is looking at a static scene
+    scene_detector = None
+    if app.config['SCENE_CHANGE_DETECTION']:
+        scene_detector = SceneChangeDetector(
+            app.config['SCENE_CHANGE_THRESHOLD'],
+            app.config['SCENE_MAX_REUSE_SEC'],
+            clock=clock)
+
+    # Inference requests in flight (PendingRequest objects), oldest first
+    pending = deque()
+
+    # The most recent tracking-size frames, for replaying through new
+    # trackers. When an inference result arrives, at most CATCHUP_MAX_FRAMES
+    # of the frames since its request are replayed (every k-th frame if there
+    # are more), for at most CATCHUP_TIME_BUDGET_SEC seconds. If ASYNC_CATCHUP
+    # is set, the replay runs in the background while the video keeps going
+    # with the old tracker.
+    frame_ring = FrameRing(app.config['CATCHUP_RING_CAPACITY'])
+    CATCHUP_MAX_FRAMES = app.config['CATCHUP_MAX_FRAMES']
+    CATCHUP_TIME_BUDGET_SEC = app.config['CATCHUP_TIME_BUDGET_SEC']
+    if session.result_delay_sec is not None:
+        # Catching up must not depend on how fast it runs either.
+        CATCHUP_TIME_BUDGET_SEC = 0.
+    ASYNC_CATCHUP = app.config['CATCHUP_ASYNC']
+
+    # Background catch-up in progress (CatchUp object), if any
+    catch_up = None
+
+    # Decides when to send the next inference request
+    scheduler = InferenceScheduler(
+        app.inference_budget,
+        max_inflight=MAX_INFLIGHT_REQUESTS,
+        max_staleness_sec=app.config['SCHEDULER_MAX_STALENESS_SEC'],
+        stable_age_delta=app.config['SCHEDULER_STABLE_AGE_DELTA'],
+        max_backoff=app.config['SCHEDULER_MAX_BACKOFF'],
+        clock=clock)
+
+    # If True, faces that are already being tracked are sent to the model as
+    # small crops, and the whole frame only every
+    # FULL_DETECTION_INTERVAL_SEC seconds or when we may have lost a face.
+    FACE_CROP_INFERENCE = app.config['FACE_CROP_INFERENCE']
+    FULL_DETECTION_INTERVAL_SEC = app.config['FACE_CROP_FULL_DETECTION_INTERVAL_SEC']
+    FACE_CROP_PADDING = app.config['FACE_CROP_PADDING']
+
+    # Time of the most recent request that covered the whole frame, by clock
+    last_full_detection_ts = float('-inf')
+
+    # Whether the tracker followed all faces successfully in the last frame
+    success = True
+
+    # Faces being followed, with their bounding boxes in the most recent
+    # frame (relative to TRACKING_IMAGE_WIDTH_PX) and their ages. When more
+    # than one age has been received for a face, its age is an exponentially
+    # decaying average. The tracker tracks the faces in the same order.
+    tracks = new_track_store(EXP_DECAY_FACTOR)
+    tracker = update_trackers(None, tracks)
 
     # Timestamp of the most recent frame processed
     frame_ts = 0.
 
-    while True:
-        with app.condition_var:
-            # Wait for the browser to send an image
-            while len(app.latest_frame_list) == 0:
-                app.condition_var.wait()
-            img_data = app.latest_frame_list.pop()
+    # Print a line for every frame
+    LOG_FRAMES = app.config['LOG_FRAMES']
+
+    # CPU-bound stages run on the stage pool, which records their latencies.
+    run_stage = app.stage_pool.run
 
+    for raw_img_np_frame, frame_id, received_ts in decoded:
         last_frame_ts = frame_ts
         frame_ts = time.time()
-        print("{:5.3f}      ==> Image dequeued ({:4.1f} FPS)"
-              "".format(time.time() - app.start_time,
-                        1.0 / (frame_ts - last_frame_ts)))
-
-        input_img = base64_to_pil_image(img_data.split('base64')[-1])
-        raw_img_np_frame = np.array(input_img)
-        img_w, img_h, _ = raw_img_np_frame.shape
-
-        # Mirror effect
-        raw_img_np_frame = cv2.flip(raw_img_np_frame, 1)
+        if LOG_FRAMES:
+            print("{:5.3f}      ==> Image dequeued ({:4.1f} FPS)"
+                  "".format(time.time() - app.start_time,
+                            1.0 / (frame_ts - last_frame_ts)))
 
         if SKIP_INFERENCE:
-            print("{:5.3f}            ==> Image sent"
-                  "".format(time.time() - app.start_time))
-            yield(gen_result_bytes(raw_img_np_frame))
+            if LOG_FRAMES:
+                print("{:5.3f}            ==> Image sent"
+                      "".format(time.time() - app.start_time))
+            if annotations_only:
+                result = annotation_message(frame_id, raw_img_np_frame.shape[1],
+                                            [], [], frames_since_update)
+            else:
+                result = gen_result_bytes(raw_img_np_frame)
+            record_frame_sent(received_ts)
+            yield result, received_ts
             # regulate_fps(start, FRAME_TIME_INTERVAL)
             continue
 
-        # Create versions of the image at different sizes for different
-        # purposes.
-        inference_np_frame = resize_image(raw_img_np_frame, INFERENCE_IMAGE_WIDTH_PX)
-        tracking_np_frame = resize_image(raw_img_np_frame, TRACKING_IMAGE_WIDTH_PX)
-        display_np_frame = resize_image(raw_img_np_frame, DISPLAY_IMAGE_WIDTH_PX)
-
-        # Start by handling any outstanding results from previous model
-        # invocations.
-        if future is not None and future.done():
-            # Remember the previous results so we can connect them with the
-            # new results.
-            last_inference_image_bounding_boxes = bounding_boxes
-            last_inference_image_ages = age_results
-
-            predict_results = future.result()
-            bounding_boxes = [entry['detection_box'] for entry in predict_results]
-            age_results = [entry['age_estimation'] for entry in predict_results]
-            # scale back to the original bounding box coordinates
-            bounding_boxes = scale_up_norm_bbx(bounding_boxes, img_w, img_h)
-
-            # Scale the bounding boxes to the image size we use for tracking.
-            bounding_boxes = scale_bounding_boxes(bounding_boxes,
-                                                  INFERENCE_IMAGE_WIDTH_PX,
-                                                  TRACKING_IMAGE_WIDTH_PX)
-            tracker = update_trackers(last_inference_image, bounding_boxes)
+        # Versions of the image at different sizes for different purposes are
+        # computed on demand from the pyramid.
+        pyramid.set_base(raw_img_np_frame)
+        tracking_np_frame = run_stage('resize', pyramid.level, TRACKING_IMAGE_WIDTH_PX)
+
+        # Remember this frame, so that trackers can catch up with it when
+        # the results for earlier frames arrive.
+        frame_seq = frame_ring.push(tracking_np_frame)
+
+        got_result = False
+
+        # If a new tracker has finished catching up in the background, switch
+        # to it, along with the results it belongs to.
+        if catch_up is not None and (catch_up.future.done()
+                                     or session.result_delay_sec is not None):
+            tracker = catch_up.future.result()
+            # Frames have kept arriving while it was catching up.
+            replay_seqs = select_replay_frames(
+                [seq for seq in frame_ring.seqs_since(catch_up.last_seq) if seq < frame_seq],
+                CATCHUP_MAX_FRAMES)
+            catch_up_tracker(tracker, [frame_ring.get(seq) for seq in replay_seqs],
+                             CATCHUP_TIME_BUDGET_SEC)
+            tracks = catch_up.tracks
+            catch_up = None
+            got_result = True
+            # The requests still in flight have not seen the faces found by
+            # this result, which are still where they were detected.
+            for later in pending:
+                tracks.add_missing(later.track_boxes)
+
+        # Handle any outstanding results from previous model invocations.
+        # Results are applied strictly in the order in which the requests were
+        # submitted, and not while a tracker is still catching up.
+        while catch_up is None and len(pending) > 0 and result_due(pending[0]):
+            request = pending.popleft()
+            try:
+                predict_results = request.future.result()
+            except requests.RequestException as e:
+                print("Inference request failed: {}".format(e))
+                app.inference_failures.inc()
+                if scene_detector is not None:
+                    # Retry on the next frame, even if nothing has changed.
+                    scene_detector.reset()
+                continue
+
+            if session.journal is not None:
+                session.journal.record_result(request.received_ts, predict_results,
+                                              request.num_crops)
+
+            if len(predict_results) < request.num_crops:
+                # A face was not found again in its crop. It may have moved
+                # out of its box, so look at the whole frame next time.
+                last_full_detection_ts = float('-inf')
+
+            new_bounding_boxes, new_age_results = geometry.parse_predictions(predict_results)
+            # Scale the normalized boxes up to the image size we use for
+            # tracking, and convert them to the trackers' (x, y, w, h).
+            tracking_h, tracking_w = request.image.shape[:2]
+            new_bounding_boxes = geometry.clip_xywh(geometry.yxyx_to_xywh(
+                geometry.denormalize(new_bounding_boxes, tracking_w, tracking_h)),
+                tracking_w, tracking_h)
+
+            # Match the faces found by the model to the faces we are already
+            # following. If the current tracker keeps running while the new
+            # one catches up in the background, the current faces have to
+            # stay as they are until then.
+            replay_seqs = []
+            if len(pending) == 0 or not result_due(pending[0]):
+                replay_seqs = select_replay_frames(
+                    [seq for seq in frame_ring.seqs_since(request.frame_seq) if seq < frame_seq],
+                    CATCHUP_MAX_FRAMES)
+            catch_up_async = ASYNC_CATCHUP and len(replay_seqs) > 0
+            new_tracks = tracks.copy() if catch_up_async else tracks
+            # The detections are in the submitted frame, and the tracker is
+            # restarted from that frame below, so move the tracks back to
+            # where they were in it. Otherwise faces the model missed would
+            # keep their boxes from the current frame and be replayed from
+            # the older one.
+            new_tracks.rewind(request.track_boxes)
+            age_delta = new_tracks.update(new_bounding_boxes, new_age_results)
+            if not catch_up_async:
+                for later in pending:
+                    new_tracks.add_missing(later.track_boxes)
+
+            scheduler.record_result(clock() - request.submit_ts, age_delta)
 
             # Play back the video that has happened since the image was
-            # submitted for inference, updating the bounding boxes as we go
-            for img in images_since_submit:
-                _, _ = tracker.update(img)
-
-            # Match faces from the previous match with the current match
-            bbox_mapping = match_bounding_boxes(last_inference_image_bounding_boxes,
-                                                bounding_boxes)
-
-            for old_ix, new_ix in bbox_mapping:
-                old_age = last_inference_image_ages[old_ix]
-                new_age = age_results[new_ix]
-                exp_decay_average_age = (new_age * EXP_DECAY_FACTOR
-                                         + old_age * (1.0 - EXP_DECAY_FACTOR))
-                age_results[new_ix] = exp_decay_average_age
-
+            # submitted for inference, updating the bounding boxes as we go.
+            # If a newer result is also ready, it will replace this tracker,
+            # so don't bother.
+            if catch_up_async:
+                # The current tracker keeps running while the new one catches
+                # up.
+                new_tracker = update_trackers(request.image, new_tracks)
+                # Catch up in the background and keep showing the current
+                # results until the new tracker is ready. The ring may
+                # overwrite its frames in the meantime, so hand over copies.
+                frames = [frame_ring.get(seq).copy() for seq in replay_seqs]
+                catch_up = CatchUp(
+                    app.catchup_executor.submit(catch_up_tracker, new_tracker, frames,
+                                                CATCHUP_TIME_BUDGET_SEC),
+                    replay_seqs[-1], new_tracks)
+            else:
+                tracker = update_trackers(request.image, tracks, tracker)
+                catch_up_tracker(tracker, [frame_ring.get(seq) for seq in replay_seqs],
+                                 CATCHUP_TIME_BUDGET_SEC)
+                got_result = True
+
+        if got_result:
             frames_since_update = 0
         else:
             frames_since_update += 1
 
-        # Start a new inference request if it is appropriate to do so.
-        if future is None or future.done():
-            future = executor.submit(predict_age_local, inference_np_frame)
-            last_inference_image = tracking_np_frame
-            del images_since_submit[:]
-        else:
-            images_since_submit.append(tracking_np_frame)
+        # Start a new inference request if it is appropriate to do so. If the
+        # scene hasn't changed since the last request, the results we have are
+        # still good, so don't bother the model server unless they are getting
+        # too old; see InferenceScheduler for the rest of the policy.
+        scene_changed = True
+        if scene_detector is not None and len(pending) < MAX_INFLIGHT_REQUESTS:
+            scene_changed = scene_detector.changed(tracking_np_frame)
+        # Faces that have been seen only once need another look before they
+        # are shown, so treat them like a tracking failure.
+        tracking_ok = success and tracks.num_tentative == 0
+        if scheduler.should_dispatch(len(pending), len(tracks), tracking_ok,
+                                     scene_changed):
+            scheduler.dispatched()
+            if scene_detector is not None:
+                scene_detector.set_reference(tracking_np_frame)
+                app.scene_cache.labels('miss').inc()
+            inference_np_frame = run_stage('resize', pyramid.level, INFERENCE_IMAGE_WIDTH_PX)
+            if session.predictions_for is not None:
+                # Replaying a journal without the model server; the recorded
+                # predictions are for whole frames.
+                future = session.predictions_for(received_ts)
+                last_full_detection_ts = clock()
+                num_crops = 0
+            elif (FACE_CROP_INFERENCE and success and len(tracks) > 0
+                    and clock() - last_full_detection_ts < FULL_DETECTION_INTERVAL_SEC):
+                # We know where the faces are (as of the previous frame), so
+                # only send those parts of the image.
+                face_boxes = geometry.xywh_to_xyxy(geometry.scale(tracks.boxes,
+                                                                  TRACKING_IMAGE_WIDTH_PX,
+                                                                  INFERENCE_IMAGE_WIDTH_PX))
+                future = submit_face_crops(app.inference_gateway.submit,
+                                           inference_np_frame, face_boxes,
+                                           FACE_CROP_PADDING)
+                num_crops = len(face_boxes)
+            else:
+                future = app.inference_gateway.submit(inference_np_frame)
+                last_full_detection_ts = clock()
+                num_crops = 0
+            record_inference(future)
+            pending.append(PendingRequest(future, tracking_np_frame, frame_seq,
+                                          num_crops, clock(), received_ts, {}))
+        elif not scene_changed:
+            app.scene_cache.labels('hit').inc()
 
         # Use CV2 MultiTracker to track faces and pair ages to face
         # For now, every box gets the same color.
         color_tuple = box_color(frames_since_update)
-        success, bounding_boxes = tracker.update(tracking_np_frame)
-        scaled_bounding_boxes = scale_bounding_boxes(bounding_boxes,
-                                                     TRACKING_IMAGE_WIDTH_PX,
-                                                     DISPLAY_IMAGE_WIDTH_PX)
-        for i, (box, age) in enumerate(zip(scaled_bounding_boxes, age_results)):
-            display_np_frame = draw_boxes_and_label(display_np_frame, str(int(age)),
-                                                    box, color_tuple)
-
-        print("{:5.3f}                ==> Annotated image sent"
-              "".format(time.time() - app.start_time))
-        yield(gen_result_bytes(display_np_frame))
+        success, tracked_boxes = run_stage('track', tracker.update, tracking_np_frame)
+        tracks.set_boxes(tracked_boxes)
+        if len(pending) > 0 and pending[-1].frame_seq == frame_seq:
+            # Where the faces were in the frame just submitted
+            pending[-1].track_boxes.update(tracks.snapshot())
+        track_ids, bounding_boxes, age_results = tracks.visible()
+        if annotations_only:
+            # Let the browser draw the boxes over its own copy of the video.
+            result = annotation_message(frame_id, TRACKING_IMAGE_WIDTH_PX,
+                                        geometry.xywh_to_xyxy(bounding_boxes),
+                                        age_results, frames_since_update, track_ids)
+            record_frame_sent(received_ts)
+            yield result, received_ts
+            continue
+
+        if output is not None:
+            # Rather than add to the backlog of a browser that is falling
+            # behind, skip to the newer frame.
+            if output.is_stale(time.time() - received_ts,
+                               session.frames_waiting() + len(decoded) > 0):
+                output.record_skipped()
+                app.frames_dropped.labels('stale').inc()
+                continue
+            display_width_px, display_quality = output.width_px, output.quality
+        else:
+            display_width_px, display_quality = DISPLAY_IMAGE_WIDTH_PX, DISPLAY_JPEG_QUALITY
+
+        # The display image gets boxes drawn on it, so it must not share memory
+        # with the image that may have just been submitted for inference.
+        display_np_frame = run_stage('resize', pyramid.writable_level, display_width_px)
+        display_boxes = geometry.to_pixels(geometry.xywh_to_xyxy(
+            geometry.scale(bounding_boxes, TRACKING_IMAGE_WIDTH_PX, display_width_px)))
+        run_stage('draw', draw_annotations, display_np_frame, display_boxes, age_results,
+                  color_tuple)
+
+        result = gen_result_bytes(display_np_frame, display_quality)
+        if LOG_FRAMES:
+            print("{:5.3f}                ==> Annotated image sent"
+                  "".format(time.time() - app.start_time))
+        record_frame_sent(received_ts)
+        send_start = time.time()
+        yield result, received_ts
+        if output is not None:
+            # The server asks for the next frame once it has written this
+            # one to the browser's connection.
+            now = time.time()
+            output.record_sent(len(result), now - send_start, now - received_ts)
         # regulate_fps(start, FRAME_TIME_INTERVAL)
 
 
 ################################################################################
 # SUBROUTINES
 
+# An inference request that gen() is waiting for.
+#   future: Future for the model's predictions
+#   image: The submitted frame, downsampled to the tracking width
+#   frame_seq: Sequence number of the submitted frame in the session's
+#       FrameRing
+#   num_crops: Number of face crops sent, or 0 if the request covered the
+#       whole frame
+#   submit_ts: Time the request was submitted, by the session's clock
+#   received_ts: Time the submitted frame was received
+#   track_boxes: Dict from track id to the track's box in the submitted frame
+#       (see TrackStore.snapshot())
+PendingRequest = namedtuple('PendingRequest', ['future', 'image', 'frame_seq',
+                                               'num_crops', 'submit_ts', 'received_ts',
+                                               'track_boxes'])
+
+# A tracker that is catching up with the video in the background.
+#   future: Future for the tracker, once it has caught up
+#   last_seq: Sequence number of the last frame it is replaying
+#   tracks: TrackStore with the inference results it was created from
+CatchUp = namedtuple('CatchUp', ['future', 'last_seq', 'tracks'])
+
+
 def box_color(frames_since_update):
     """
     Compute the color of the bounding box.
@@ -286,9 +906,8 @@ def draw_boxes_and_label(image, label, box, color=(255, 255, 0)):
     Args:
         image: The original image as a numpy ndarray
         label: Text label string to apply to the box
-        box: list of integers (x1, y1, x2, y2) that describe the
-             coordinates of the upper left corner and the width
-             and height of the box
+        box: Integers (x1, y1, x2, y2), the coordinates of the upper left
+             and lower right corners of the box
         color: Tuple of RGB values to use as the color of the box
     Returns the original image, with the indicated box drawn
     """
@@ -300,21 +919,67 @@ def draw_boxes_and_label(image, label, box, color=(255, 255, 0)):
     return image
 
 
+def draw_annotations(image, boxes, ages, color):
+    """Draw the boxes of a frame's faces, labeled with their ages, on the
+    frame in place."""
+    for box, age in zip(boxes, ages):
+        draw_boxes_and_label(image, str(int(age)), box, color)
+
+
 def draw_FPS(image, fps):
     cv2.putText(image, "FPS: {}".format("%.4f" % fps), (20, 20),
                 cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
 
 
-def base64_to_pil_image(base64_img):
-    return Image.open(BytesIO(base64.b64decode(base64_img)))
+# cv2.imread flags for decoding JPEGs at reduced resolution, by reduction
+# factor
+_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
 
 
-def convert_to_JPEG(np_image_frame):
-    # np_image_color = cv2.cvtColor(np_image_frame, cv2.COLOR_BGR2RGB)
-    image = Image.fromarray(np_image_frame)
-    with BytesIO() as f:
-        image.save(f, format='JPEG', quality=95)
-        return f.getvalue()
+def decode_frame(frame_data, reduction=1):
+    """
+    Decode a frame received from the browser into an RGB numpy array.
+
+    Args:
+        frame_data: Either the raw JPEG bytes of the frame (binary frame
+            path), a base64 data URL string (legacy path), or an RGB image
+            that has already been decoded (batch mode), which is returned
+            as is
+        reduction: Factor of 1, 2, 4 or 8 by which to downscale the image
+            while decoding it
+
+    Returns the decoded image as a numpy array of shape (height, width, 3).
+    """
+    if isinstance(frame_data, np.ndarray):
+        return frame_data
+    img = cv2.imdecode(np.frombuffer(jpeg_bytes(frame_data), dtype=np.uint8),
+                       _DECODE_FLAGS[reduction])
+    if img is None:
+        raise ValueError("Could not decode frame")
+    # OpenCV decodes to BGR; the rest of the pipeline expects RGB.
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+
+
+def jpeg_bytes(frame_data):
+    """The raw JPEG bytes of a frame received from the browser, which may
+    come as bytes or as a base64 data URL string."""
+    if isinstance(frame_data, str):
+        return base64.b64decode(frame_data.split('base64,')[-1])
+    return frame_data
+
+
+def convert_to_JPEG(np_image_frame, quality=95):
+    """
+    Encode an RGB image as JPEG with the configured encoder backend.
+
+    Returns a bytes-like object; see imaging.JpegEncoder.
+    """
+    return app.jpeg_encoder.encode(np_image_frame, quality)
 
 
 def resize_image(img_np, target_width_px):
@@ -337,11 +1002,76 @@ def resize_image(img_np, target_width_px):
                                    int(target_width_px * img_h / img_w)))
 
 
-def gen_result_bytes(np_frame):
+def annotation_message(frame_id, width_px, bounding_boxes, ages,
+                       frames_since_update, track_ids=()):
+    """
+    Build the message sent to the browser in 'annotations' output mode.
+
+    Args:
+        frame_id: Identifier the browser attached to the frame
+        width_px: Width of the image that the box coordinates refer to. The
+            browser scales the boxes from this width to its own video width.
+        bounding_boxes: (N, 4) array of boxes to draw, as corners
+            (x1, y1, x2, y2) like draw_boxes_and_label() takes
+        ages: Age estimates corresponding to the bounding boxes
+        frames_since_update: Input to box_color(); the browser uses it to
+            fade the boxes as the results get stale
+        track_ids: Persistent ids of the faces, in the same order as the
+            boxes
+
+    Returns a dict that can be sent as a Socket.IO message.
+    """
+    return {
+        'frame_id': frame_id,
+        'width': width_px,
+        'boxes': geometry.to_pixels(bounding_boxes).tolist(),
+        'ages': [int(age) for age in ages],
+        'ids': [int(track_id) for track_id in track_ids],
+        'staleness': frames_since_update,
+    }
+
+
+def gen_result_bytes(np_frame, quality=None):
     # draw_FPS(display_np_frame, frames_per_second)
-    result_image = convert_to_JPEG(np_frame)
-    return (b'--frame\r\n'
-            b'Content-Type: image/jpeg\r\n\r\n' + result_image + b'\r\n')
+    if quality is None:
+        quality = app.config['DISPLAY_JPEG_QUALITY']
+    result_image = app.stage_pool.run('encode', convert_to_JPEG, np_frame, quality)
+    return b''.join((b'--frame\r\n'
+                     b'Content-Type: image/jpeg\r\n\r\n', result_image, b'\r\n'))
+
+
+def grant_credit(session, num_credits):
+    """
+    Pass credits that a session got back (see Session.return_credit()) on to
+    its browser, so that it can capture more frames, and tell it how many
+    frames per second its session is processing.
+    """
+    socketio.emit('credit', {'credits': num_credits,
+                             'fps': round(session.processing_fps, 1)},
+                  room=session.sid, namespace='/streaming')
+
+
+def record_frame_sent(received_ts):
+    """Count a result as sent for a frame received at received_ts."""
+    app.frames_sent.inc()
+    app.frame_latency.observe(time.time() - received_ts)
+
+
+def record_inference(future):
+    """Count future as an inference request in flight until it completes,
+    and record its round-trip time."""
+    start = time.perf_counter()
+    app.inference_inflight.inc()
+
+    def on_done(_):
+        app.inference_inflight.dec()
+        app.stage_latency.labels('inference').observe(time.perf_counter() - start)
+    future.add_done_callback(on_done)
+
+
+def catch_up_tracker(tracker, frames, time_budget_sec):
+    """replay_frames(), run on the stage pool as the 'catchup' stage."""
+    return app.stage_pool.run('catchup', replay_frames, tracker, frames, time_budget_sec)
 
 
 def regulate_fps(start_time, frame_time_interval):
@@ -366,160 +1096,81 @@ def regulate_fps(start_time, frame_time_interval):
 
 
 def predict_age_local(np_image):
-    image = convert_to_JPEG(np_image)
-    my_files = {'image': image,
-                'Content-Type': 'multipart/form-data',
-                'accept': 'application/json'}
+    image = app.stage_pool.run('inference_encode', convert_to_JPEG, np_image,
+                               app.config['INFERENCE_JPEG_QUALITY'])
+    return app.inference_client.predict(bytes(image))
 
-    r = requests.post('http://localhost:5000/model/predict',
-                      files=my_files, json={"key": "value"})
 
-    json_str = json.dumps(r.json())
-    data = json.loads(json_str)
-    return data['predictions']
+def update_trackers(image, tracks, tracker=None):
+    """
+    Start tracking a new set of faces.
 
+    Args:
+        image: Frame in which the faces were found
+        tracks: TrackStore with the boxes (x, y, w, h) of the faces in that
+            frame. Faces that the tracker cannot follow are removed from it,
+            so that the tracker keeps reporting boxes in the order of the
+            tracks.
+        tracker: Tracker that may be reused for the new faces, if the
+            configured tracker engine supports that. Pass None if the old
+            tracker is still needed.
+
+    Returns a tracker with an update(image) method.
+    """
+    if app.config['TRACKER_ENGINE'] == 'flow':
+        # One batched optical flow pass for all faces; see tracking.FlowTracker
+        if isinstance(tracker, FlowTracker):
+            tracker.set_boxes(image, tracks.boxes)
+            return tracker
+        return FlowTracker(image, tracks.boxes)
 
-def update_trackers(image, bounding_boxes):
     tracker = cv2.MultiTracker_create()
-    for box in bounding_boxes:
+    failed = []
+    for i, box in enumerate(tracks.boxes):
         # Old code was:
         # tracker.add(cv2.TrackerKCF_create(), image, tuple(box))
         # We use MedianFlow tracker now because it is faster. Even though the
         # algorithm is less accurate, results are more accurate because we drop
         # fewer frames.
-        tracker.add(cv2.TrackerMedianFlow_create(), image, tuple(box))
+        # Boxes clipped to the edge of the image can end up empty, which
+        # MedianFlow cannot be initialized with.
+        if (box[2] < 1 or box[3] < 1
+                or not tracker.add(cv2.TrackerMedianFlow_create(), image,
+                                   tuple(float(c) for c in box))):
+            failed.append(i)
+    if failed:
+        tracks.remove(failed)
     return tracker
 
 
-def scale_up_norm_bbx(box, img_w, img_h):
-    """
-    Scale up a list of normalized bounding boxes.
+def new_track_store(age_smoothing):
+    """Create an empty TrackStore with the configured birth and death
+    hysteresis."""
+    return TrackStore(min_hits=app.config['TRACK_MIN_HITS'],
+                      max_misses=app.config['TRACK_MAX_MISSES'],
+                      max_cost=app.config['TRACK_MAX_MATCH_COST'],
+                      age_smoothing=age_smoothing)
 
-    Args:
-        bounding_boxes: List of lists of [y1, x1, y2, x2], where each coordinate is normalized
-         by the height and width of the image dimension for y and x, respectively.
-         Each coordinate is therefore in the range [0, 1].
-        img_w: Width of the original image
-        img_h: Heigh of the original image
-    Returns:
-        A new list of bounding boxes with the original coordinates with the ordering [x1,y1,x2,y2].
-    """
-    try:
-        ret = []
-        # Use a for loop because OpenCV doesn't play well with generators
-        for eachbbox in box:
-            y1, x1, y2, x2 = (c for c in eachbbox)
-            bbox = [x1, y1, x2, y2]
-            new_bbox = []
-            for i in range(len(bbox)):
-                if i == 0:
-                    new_val = bbox[i] * img_h
-                elif i == 1:
-                    new_val = bbox[i] * img_w
-                elif i == 2:
-                    new_val = bbox[i] * img_h
-                elif i == 3:
-                    new_val = bbox[i] * img_w
-                new_bbox.append(new_val)
-            ret.append(new_bbox)
-        return ret
-    except ValueError:
-        print("The first few frames are blank.")
-        return []
-
-
-def scale_bounding_boxes(bounding_boxes, orig_width, new_width):
-    """
-    Scale a list of bounding boxes to reflect a change in image size.
-
-    Args:
-        bounding_boxes: List of lists of [x1, y1, x2, y2], where
-            (x1, y1) is the upper left corner of the box, x2 is the width
-            of the box, and y2 is the height of the box.
-        orig_width: Width of the images to which bounding_boxes apply
-        new_width: Width of the target images to which the bounding boxes
-            should be translated
-    Returns:
-        A new list of bounding boxes with the appropriate scaling factor
-        applied.
-    """
-    scale_factor = new_width / orig_width
-    ret = []
-    # Use a for loop because OpenCV doesn't play well with generators
-    for bbox in bounding_boxes:
-        new_bbox = []
-        for elem in bbox:
-            new_elem = round(float(elem) * scale_factor)
-            new_bbox.append(new_elem)
-        ret.append(new_bbox)
-    return ret
-
-
-def match_bounding_boxes(old_bounding_boxes, new_bounding_boxes):
-    """
-    Find matches between two sets of bounding boxes.
-
-    We currently match based on distance between the centers of the boxes.
-
-    Args:
-        old_bounding_boxes: List of lists of bounding box coords, where
-            each entry is in the format [x1, y1, x2, y2] and describes the
-            upper-left corner and width and height of the box
-        new_bounding_boxes: Second list of bounding boxes in the same format
-            as the first
-
-    Returns a list of tuples: (old_ix, new_ix), where old_ix and new_ix are
-    offsets into the old and new bounding boxes and each pair indicates a
-    match between the bounding boxes at the indicated offsets.
-    """
-    DISTANCE_THRESH = 200
-    BIG_DISTANCE = 1e6
-    BIG_DISTANCE_MINUS_EPSILON = 9e5
-
-    def center(box):
-        x1, y1, x2, y2 = tuple(box)
-        return [x1 + (x2 / 2), y1 + (y2 / 2)]
-
-    # O(n^2) comparison operation, so use numpy to scale n as far as we can
-    old_centers = np.array([center(b) for b in old_bounding_boxes])
-    new_centers = np.array([center(b) for b in new_bounding_boxes])
-
-    if old_centers.shape[0] == 0 or new_centers.shape[0] == 0:
-        # Special-case: One of input lists is empty
-        return []
-
-    # Generate table of euclidean distances, indexed by (old, new)
-    all_diffs = np.sqrt(np.sum(np.square(old_centers[:, None] - new_centers), axis=2))
-
-    # Replace everything over the threshold with a large number
-    all_diffs[all_diffs > DISTANCE_THRESH] = BIG_DISTANCE
-
-    # Pick the best match for each NEW bounding box.
-    matches = np.argmin(all_diffs, axis=0)
-
-    # Filter out the matches that didn't satisfy our threshold constraint
-    min_distances = np.min(all_diffs, axis=0)
-    matches[np.argwhere(min_distances > BIG_DISTANCE_MINUS_EPSILON)] = -1
-
-    results_as_dict = {}
-    for new_ix in range(matches.shape[0]):
-        old_ix = matches[new_ix]
-        if old_ix == -1:
-            pass
-        elif old_ix not in results_as_dict:
-            results_as_dict[old_ix] = new_ix
-        else:
-            # Break ties by distance
-            my_distance = all_diffs[old_ix, new_ix]
-            their_distance = all_diffs[old_ix, results_as_dict[old_ix]]
-            if my_distance < their_distance:
-                results_as_dict[old_ix] = new_ix
 
-    ret = [(k, v) for k, v in results_as_dict.items()]
-    return ret
+init_inference()
+init_stage_pool()
 
 
 ################################################################################
 # main function
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ml-endpoint', default=','.join(app.config['ML_ENDPOINTS']),
+                        help='Base URL of the MAX Facial Age Estimator model server; '
+                             'comma-separated for several replicas')
+    parser.add_argument('--workers', type=int, default=app.config['WORKER_PROCESSES'],
+                        help='Number of worker processes to run the video pipelines in; '
+                             '0 runs them in the web server process')
+    args = parser.parse_args()
+    app.config['ML_ENDPOINTS'] = args.ml_endpoint.split(',')
+    init_inference()
+    if args.workers > 0:
+        start_workers(args.workers)
+
+    socketio.start_background_task(reap_idle_sessions)
     socketio.run(app, host='0.0.0.0', port=7000)
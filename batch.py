@@ -0,0 +1,387 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Age-annotate recorded footage from the command line.
+
+Each input is a video file or a directory of images (one frame per image,
+in file name order). Frames go through the same pipeline as the webcam
+stream (app.gen()), as fast as the CPU and the model server allow. For each
+input this writes:
+  * <name>.mp4: the video with boxes and ages drawn on it
+  * <name>.csv: one row per face per frame
+  * <name>.jsonl: one JSON object per frame
+
+Inputs, and with --segments also parts of each input, are processed in
+parallel by a pool of worker processes. Track ids are unique within each
+output, but a face that spans two segments gets a new id in the second.
+
+Example:
+
+    python batch.py footage/*.mp4 --output-dir annotated --workers 4
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import geometry
+from sessions import Session
+
+# File extensions of the images in an image directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# One unit of work for a worker process: frames [start, end) of an input.
+#   path: Video file or image directory
+#   part: Index of the segment within the input
+#   fps: Frame rate of the input, for timestamps and the output video
+Segment = namedtuple('Segment', ['path', 'part', 'start', 'end', 'fps'])
+
+
+################################################################################
+# INPUT
+
+def list_images(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def probe(path, default_fps):
+    """Returns (number of frames, frame rate) of an input."""
+    if os.path.isdir(path):
+        return len(list_images(path)), default_fps
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Cannot open {}".format(path))
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or default_fps
+    capture.release()
+    return num_frames, fps
+
+
+def read_frames(segment):
+    """Yields the BGR frames of a segment."""
+    if os.path.isdir(segment.path):
+        size = None
+        for image_path in list_images(segment.path)[segment.start:segment.end]:
+            img = cv2.imread(image_path)
+            if img is None:
+                continue
+            # The output video needs every frame to have the same size.
+            if size is None:
+                size = (img.shape[1], img.shape[0])
+            elif (img.shape[1], img.shape[0]) != size:
+                img = cv2.resize(img, size)
+            yield img
+        return
+    capture = cv2.VideoCapture(segment.path)
+    try:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, segment.start)
+        for _ in range(segment.end - segment.start):
+            ok, img = capture.read()
+            if not ok:
+                return
+            yield img
+    finally:
+        capture.release()
+
+
+def split(path, num_frames, fps, num_segments):
+    """Split an input into at most num_segments segments of similar length."""
+    num_segments = max(min(num_segments, num_frames), 1)
+    bounds = [num_frames * i // num_segments for i in range(num_segments + 1)]
+    return [Segment(path, i, start, end, fps)
+            for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def output_base(output_dir, path):
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    return os.path.join(output_dir, name)
+
+
+def part_base(output_dir, segment, num_parts):
+    base = output_base(output_dir, segment.path)
+    return base if num_parts == 1 else '{}.part{:03d}'.format(base, segment.part)
+
+
+################################################################################
+# WORKER
+
+# The web app module, imported by each worker process when it starts. The
+# parent process never imports it, so that gevent's monkey patching stays
+# out of the process pool machinery.
+_webapp = None
+
+# Queue on which workers report (segment, number of frames done) as they go
+_progress = None
+
+
+def init_worker(ml_endpoint, max_inflight, progress):
+    global _webapp, _progress
+    import app as webapp
+    webapp.app.config['ML_ENDPOINTS'] = ml_endpoint.split(',')
+    webapp.app.config['INFERENCE_MAX_INFLIGHT'] = max_inflight
+    webapp.init_inference()
+    _webapp = webapp
+    _progress = progress
+
+
+def process_segment(segment, out_base, progress_every=25):
+    """
+    Run one segment through the pipeline and write its outputs.
+
+    Args:
+        segment: Segment to process
+        out_base: Path of the outputs, without extension
+        progress_every: Report progress every this many frames
+
+    Returns the number of frames processed.
+    """
+    webapp = _webapp
+    progress = _progress
+    session = Session(out_base, 'annotations', mirror=False)
+    # Decide when to ask the model again by the time in the video rather than
+    # the wall clock, so that the results do not depend on how fast the
+    # frames are processed.
+    video_sec = segment.start / segment.fps
+    session.clock = lambda: video_sec
+    # For the same reason, apply each result a fixed number of frames after
+    # its request: as many as there may be requests in flight, so that the
+    # model server is kept busy.
+    session.result_delay_sec = webapp.app.config['INFERENCE_MAX_INFLIGHT'] / segment.fps
+    pipeline = webapp.gen(session)
+    writer = None
+    num_frames = 0
+    with open(out_base + '.csv', 'w', newline='') as csv_file, \
+            open(out_base + '.jsonl', 'w') as json_file:
+        rows = csv.writer(csv_file)
+        rows.writerow(['frame', 'time_sec', 'id', 'x1', 'y1', 'x2', 'y2', 'age'])
+        for frame_no, bgr in enumerate(read_frames(segment), segment.start):
+            video_sec = frame_no / segment.fps
+            height, width = bgr.shape[:2]
+            if writer is None:
+                writer = cv2.VideoWriter(out_base + '.mp4',
+                                         cv2.VideoWriter_fourcc(*'mp4v'),
+                                         segment.fps, (width, height))
+
+            # The pipeline may hold on to this image (e.g. while it is being
+            # sent for inference), so draw on a copy.
+            rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+            session.put_frame(rgb, frame_no)
+            message = next(pipeline)
+
+            boxes = geometry.to_pixels(geometry.scale(message['boxes'], message['width'], width))
+            display = rgb.copy()
+            color = webapp.box_color(message['staleness'])
+            for box, age in zip(boxes, message['ages']):
+                webapp.draw_boxes_and_label(display, str(age), box, color)
+            writer.write(cv2.cvtColor(display, cv2.COLOR_RGB2BGR, dst=bgr))
+
+            time_sec = round(frame_no / segment.fps, 3)
+            faces = [{'id': track_id, 'box': box.tolist(), 'age': age}
+                     for track_id, box, age in zip(message['ids'], boxes, message['ages'])]
+            json_file.write(json.dumps({'frame': frame_no, 'time_sec': time_sec,
+                                        'faces': faces}) + '\n')
+            rows.writerows([frame_no, time_sec, face['id']] + face['box'] + [face['age']]
+                           for face in faces)
+
+            num_frames += 1
+            if num_frames % progress_every == 0:
+                progress.put((segment, progress_every))
+            # Give the inference requests (greenlets under gevent) a chance to
+            # make progress. A zero sleep is not enough for gevent to poll
+            # their sockets.
+            time.sleep(0.001)
+    progress.put((segment, num_frames % progress_every))
+    session.close()
+    pipeline.close()
+    if writer is not None:
+        writer.release()
+    return num_frames
+
+
+################################################################################
+# OUTPUT
+
+def concatenate_parts(base, num_parts):
+    """Join the per-segment outputs of an input into one set of files."""
+    part_bases = ['{}.part{:03d}'.format(base, i) for i in range(num_parts)]
+
+    # Video: decode and re-encode, since OpenCV cannot copy streams.
+    writer = None
+    for part in part_bases:
+        capture = cv2.VideoCapture(part + '.mp4')
+        while True:
+            ok, img = capture.read()
+            if not ok:
+                break
+            if writer is None:
+                writer = cv2.VideoWriter(base + '.mp4', cv2.VideoWriter_fourcc(*'mp4v'),
+                                         capture.get(cv2.CAP_PROP_FPS),
+                                         (img.shape[1], img.shape[0]))
+            writer.write(img)
+        capture.release()
+    if writer is not None:
+        writer.release()
+
+    # Track ids start at 0 in every segment, so shift each part's ids past
+    # those of the parts before it. A face that spans a segment boundary
+    # gets a new id in the next segment.
+    id_offsets = []
+    next_id = 0
+    for part in part_bases:
+        id_offsets.append(next_id)
+        with open(part + '.jsonl') as f:
+            for line in f:
+                for face in json.loads(line)['faces']:
+                    next_id = max(next_id, id_offsets[-1] + face['id'] + 1)
+
+    with open(base + '.csv', 'w', newline='') as out:
+        rows = csv.writer(out)
+        for i, part in enumerate(part_bases):
+            with open(part + '.csv', newline='') as f:
+                part_rows = csv.reader(f)
+                header = next(part_rows)
+                if i == 0:
+                    rows.writerow(header)
+                for row in part_rows:
+                    row[2] = int(row[2]) + id_offsets[i]
+                    rows.writerow(row)
+
+    with open(base + '.jsonl', 'w') as out:
+        for i, part in enumerate(part_bases):
+            with open(part + '.jsonl') as f:
+                for line in f:
+                    frame = json.loads(line)
+                    for face in frame['faces']:
+                        face['id'] += id_offsets[i]
+                    out.write(json.dumps(frame) + '\n')
+
+    for part in part_bases:
+        for ext in ('.mp4', '.csv', '.jsonl'):
+            if os.path.exists(part + ext):
+                os.remove(part + ext)
+
+
+class Progress(object):
+    """Prints frames done, throughput and speed relative to real time."""
+
+    def __init__(self, total_frames, total_video_sec):
+        self.total_frames = total_frames
+        self.total_video_sec = total_video_sec
+        self.done_frames = 0
+        self.start = time.time()
+
+    def add(self, num_frames):
+        self.done_frames += num_frames
+
+    def report(self, final=False):
+        elapsed = max(time.time() - self.start, 1e-6)
+        fps = self.done_frames / elapsed
+        video_sec = self.total_video_sec * self.done_frames / max(self.total_frames, 1)
+        print("{:>7}/{} frames ({:5.1f}%)  {:6.1f} fps  {:5.1f}x real time  {:6.1f} s"
+              "".format(self.done_frames, self.total_frames,
+                        100. * self.done_frames / max(self.total_frames, 1),
+                        fps, video_sec / elapsed, elapsed),
+              end='\n' if final else '\r', flush=True)
+
+
+################################################################################
+# MAIN
+
+def main():
+    import config
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='Video files or image directories')
+    parser.add_argument('--output-dir', default='annotated',
+                        help='Directory for the annotated videos, CSV and JSON files')
+    parser.add_argument('--ml-endpoint', default=','.join(config.ML_ENDPOINTS),
+                        help='Base URL of the MAX Facial Age Estimator model server; '
+                             'comma-separated for several replicas')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='Split each input into this many segments, processed '
+                             'in parallel')
+    parser.add_argument('--inflight', type=int, default=4,
+                        help='Inference requests kept in flight per segment')
+    parser.add_argument('--fps', type=float, default=25.,
+                        help='Frame rate of image directories, and of videos '
+                             'that do not report one')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    segments = []
+    parts_per_input = {}
+    total_frames = 0
+    total_video_sec = 0.
+    for path in args.inputs:
+        num_frames, fps = probe(path, args.fps)
+        input_segments = split(path, num_frames, fps, args.segments)
+        parts_per_input[path] = len(input_segments)
+        segments.extend(input_segments)
+        total_frames += num_frames
+        total_video_sec += num_frames / fps
+
+    # gevent does not mix with fork, so start the workers from scratch. The
+    # progress queue is a SimpleQueue because its writes don't go through a
+    # background thread, which under gevent would only run when the worker
+    # yields.
+    context = multiprocessing.get_context('spawn')
+    progress_queue = context.SimpleQueue()
+    progress = Progress(total_frames, total_video_sec)
+    with ProcessPoolExecutor(max_workers=max(min(args.workers, len(segments)), 1),
+                             mp_context=context, initializer=init_worker,
+                             initargs=(args.ml_endpoint, args.inflight,
+                                       progress_queue)) as pool:
+        futures = {
+            pool.submit(process_segment, segment,
+                        part_base(args.output_dir, segment, parts_per_input[segment.path])): segment
+            for segment in segments}
+        while any(not f.done() for f in futures):
+            time.sleep(0.5)
+            while not progress_queue.empty():
+                progress.add(progress_queue.get()[1])
+            progress.report()
+        while not progress_queue.empty():
+            progress.add(progress_queue.get()[1])
+        progress.report(final=True)
+
+        failed = False
+        for future, segment in futures.items():
+            if future.exception() is not None:
+                print("Failed on {} (frames {}-{}): {}".format(
+                    segment.path, segment.start, segment.end, future.exception()))
+                failed = True
+
+    for path, num_parts in parts_per_input.items():
+        if num_parts > 1 and not failed:
+            concatenate_parts(output_base(args.output_dir, path), num_parts)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
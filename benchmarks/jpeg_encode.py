@@ -0,0 +1,87 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Micro-benchmark of the JPEG encoder backends in imaging.py, at the frame
+sizes and quality settings the web app uses.
+
+Run from the root of the repository:
+
+    python -m benchmarks.jpeg_encode [--image path/to/frame.jpg]
+"""
+
+import argparse
+import cv2
+import numpy as np
+import time
+
+from imaging import JPEG_ENCODERS
+
+# (width, height) of the frames we encode: Chrome and Safari webcam frames
+FRAME_SIZES = [(1024, 576), (960, 540), (512, 288)]
+
+QUALITIES = [95, 85, 70]
+
+
+def synthetic_frame(width, height):
+    """Smooth gradient plus sensor-like noise, roughly as hard to compress
+    as a webcam frame."""
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.stack([np.broadcast_to(x, (height, width)),
+                    np.broadcast_to(y, (height, width)),
+                    (x + y) / 2], axis=2)
+    img += np.random.normal(0, 8, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def time_encoder(encoder, img, quality, min_time_sec):
+    encoder.encode(img, quality)  # warm up
+    n = 0
+    size = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time_sec:
+        size = len(bytes(encoder.encode(img, quality)))
+        n += 1
+    return (time.perf_counter() - start) / n, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--image', help='Use this image instead of synthetic frames')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='Seconds to spend on each measurement')
+    args = parser.parse_args()
+
+    encoders = [cls() for cls in JPEG_ENCODERS if cls.available()]
+    print("{:>10} {:>9} {:>7} {:>10} {:>9}".format(
+        'backend', 'size', 'quality', 'ms/frame', 'KB'))
+    for width, height in FRAME_SIZES:
+        if args.image:
+            img = cv2.cvtColor(cv2.imread(args.image), cv2.COLOR_BGR2RGB)
+            img = cv2.resize(img, (width, height))
+        else:
+            img = synthetic_frame(width, height)
+        for quality in QUALITIES:
+            for encoder in encoders:
+                sec, size = time_encoder(encoder, img, quality, args.min_time)
+                print("{:>10} {:>9} {:>7} {:>10.2f} {:>9.1f}".format(
+                    encoder.name, '{}x{}'.format(width, height), quality,
+                    sec * 1000, size / 1024))
+
+
+if __name__ == "__main__":
+    main()
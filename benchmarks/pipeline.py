@@ -0,0 +1,413 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+End-to-end benchmark of the web app's frame pipeline (app.gen()), run
+headlessly against a stub model server (see benchmarks/stub_model.py).
+
+Each session is driven by a client that sends a JPEG frame, waits for the
+result and, if --input-fps is given, waits for the next frame time. The
+parameters below can each take a comma-separated list; every combination
+is measured.
+
+Reports throughput, end-to-end and per-stage latency percentiles (from the
+same metrics that /metrics serves), CPU use and peak memory. CPU and memory
+are for the whole process, which includes the stub model server.
+
+With --workers, the sessions run in that many worker processes (see
+workers.py) instead. Per-stage latencies, and the CPU and memory used by the
+workers, are then not measured.
+
+The 'loop lag' latency is how late the event loop wakes up a greenlet that
+sleeps for a few milliseconds: how long the pipelines hold up everything
+else in the process, such as the sockets of other clients. Compare
+--stage-threads 0 (every stage on the event loop) with the default.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.pipeline --frame-sizes 640x360,1280x720 \\
+        --faces 0,1,5 --sessions 1,4 --skip-inference no,yes --workers 0,4 \\
+        --stage-threads 0,4
+"""
+
+# app monkey-patches the standard library for gevent, which has to happen
+# before anything else starts threads.
+import app as webapp
+
+import argparse
+import cv2
+import itertools
+import json
+import numpy as np
+import os
+import queue
+import threading
+import time
+
+from benchmarks.stub_model import StubModelServer, face_boxes
+from metrics import MetricsRegistry, exponential_buckets
+from sessions import Session
+from workers import WorkerPool
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Fine-grained latency buckets, 50 us to about 20 s, for percentiles within a
+# few percent
+BUCKETS_SEC = exponential_buckets(5e-5, 1.1, 136)
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+STAGES = ('decode', 'flip', 'resize', 'inference_encode', 'inference', 'track',
+          'catchup', 'draw', 'encode')
+
+# Interval at which the event loop lag is sampled
+LOOP_LAG_INTERVAL_SEC = 0.005
+
+
+def parse_list(text, convert=str):
+    return [convert(item) for item in text.split(',') if item != '']
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_bool(text):
+    return text.lower() in ('1', 'yes', 'true', 'on')
+
+
+################################################################################
+# FRAMES
+
+def synthetic_frames(width, height, num_faces, num_frames=30, seed=0):
+    """
+    JPEG frames of a noisy background with num_faces textured patches that
+    jitter around the positions where the stub model server reports faces.
+    """
+    rng = np.random.RandomState(seed)
+    background = cv2.GaussianBlur(
+        rng.randint(0, 255, (height, width, 3)).astype(np.uint8), (9, 9), 0)
+    boxes = [(int(x1 * width), int(y1 * height), int(x2 * width), int(y2 * height))
+             for y1, x1, y2, x2 in face_boxes(num_faces)]
+    textures = [rng.randint(0, 255, (y2 - y1, x2 - x1, 3)).astype(np.uint8)
+                for x1, y1, x2, y2 in boxes]
+    frames = []
+    for i in range(num_frames):
+        frame = background.copy()
+        dx = int(round(3 * np.sin(i / 5.)))
+        dy = int(round(3 * np.cos(i / 5.)))
+        for (x1, y1, x2, y2), texture in zip(boxes, textures):
+            x1 = min(max(x1 + dx, 0), width - texture.shape[1])
+            y1 = min(max(y1 + dy, 0), height - texture.shape[0])
+            frame[y1:y1 + texture.shape[0], x1:x1 + texture.shape[1]] = texture
+        frames.append(encode_frame(frame))
+    return frames
+
+
+def recorded_frames(path, width, height, max_frames=300):
+    """
+    JPEG frames from a video file or a directory of images, resized to
+    width x height.
+    """
+    if os.path.isdir(path):
+        images = (cv2.imread(os.path.join(path, name))
+                  for name in sorted(os.listdir(path)))
+        images = (img for img in images if img is not None)
+    else:
+        images = _video_frames(path)
+    frames = [encode_frame(cv2.resize(img, (width, height)))
+              for img in itertools.islice(images, max_frames)]
+    if len(frames) == 0:
+        raise ValueError("No frames found in {}".format(path))
+    return frames
+
+
+def _video_frames(path):
+    capture = cv2.VideoCapture(path)
+    try:
+        while True:
+            ok, img = capture.read()
+            if not ok:
+                return
+            yield img
+    finally:
+        capture.release()
+
+
+def encode_frame(img_bgr):
+    """JPEG-encode a frame the way the browser sends it."""
+    ok, jpeg = cv2.imencode('.jpg', img_bgr, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    return jpeg.tobytes()
+
+
+################################################################################
+# MEASUREMENT
+
+def install_metrics():
+    """
+    Replace the app's latency histograms with fresh, fine-grained ones, so
+    that each run is measured on its own.
+    """
+    registry = MetricsRegistry()
+    webapp.app.stage_latency = registry.histogram(
+        webapp.app.stage_latency.name, webapp.app.stage_latency.help_text,
+        ['stage'], buckets=BUCKETS_SEC)
+    webapp.app.frame_latency = registry.histogram(
+        webapp.app.frame_latency.name, webapp.app.frame_latency.help_text,
+        buckets=BUCKETS_SEC)
+    webapp.app.stage_pool.stage_latency = webapp.app.stage_latency
+    return registry.histogram('loop_lag_seconds', 'Event loop lag', buckets=BUCKETS_SEC)
+
+
+def sample_loop_lag(histogram, stop):
+    """Record how late the event loop wakes this greenlet up, until stop is
+    set."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        time.sleep(LOOP_LAG_INTERVAL_SEC)
+        histogram.observe(max(time.perf_counter() - start - LOOP_LAG_INTERVAL_SEC, 0.))
+
+
+class WorkerSession(object):
+    """
+    A session run by a WorkerPool, with the same interface as a local
+    Session for drive_session().
+    """
+
+    def __init__(self, pool, sid, results):
+        """
+        Args:
+            pool: WorkerPool to run the session in
+            sid: Session id
+            results: Queue that the pool's on_annotations callback puts the
+                session's (message, received_ts) results on
+        """
+        self.pool = pool
+        self.sid = sid
+        self.results = results
+        pool.open(sid, 'annotations', 0)
+
+    def put_frame(self, frame, frame_id):
+        self.pool.put_frame(self.sid, frame, frame_id, time.time())
+
+    def pipeline(self):
+        while True:
+            message, received_ts = self.results.get()
+            webapp.app.frame_latency.observe(time.time() - received_ts)
+            yield message
+
+    def close(self):
+        self.pool.close(self.sid)
+
+
+def start_worker_pool(num_workers):
+    """
+    Start a WorkerPool with the current app settings. Returns the pool and
+    a dict, by session id, of the queues that results go to.
+    """
+    results = {}
+    config = {key: value for key, value in webapp.app.config.items() if key.isupper()}
+    pool = WorkerPool(
+        num_workers, config, on_credit=lambda sid, fps: None,
+        on_annotations=lambda sid, message, ts: results[sid].put((message, ts)),
+        on_restart=lambda sids: None).start()
+    return pool, results
+
+
+def drive_session(session, frames, num_frames, input_fps, start_barrier, results):
+    """Feed num_frames frames through a session's pipeline, one at a time."""
+    if isinstance(session, WorkerSession):
+        pipeline = session.pipeline()
+    else:
+        pipeline = webapp.gen(session)
+    interval = 1.0 / input_fps if input_fps > 0 else 0.
+    start_barrier.wait()
+    next_ts = time.time()
+    for i in range(num_frames):
+        session.put_frame(frames[i % len(frames)], i)
+        next(pipeline)
+        results.append(time.time())
+        # Always give other greenlets (the inference requests and the stub
+        # server) a chance to run, as the socket I/O of a real client does.
+        next_ts += interval
+        time.sleep(max(next_ts - time.time(), 0.))
+    session.close()
+
+
+def run_sessions(frames, num_sessions, num_frames, input_fps, workers=None):
+    """
+    Run num_sessions sessions concurrently, in this process or, if workers
+    is a (pool, results) pair from start_worker_pool(), in its workers.
+    Returns the wall time.
+    """
+    barrier = threading.Barrier(num_sessions + 1)
+    results = []
+    threads = []
+    for i in range(num_sessions):
+        sid = 'bench-{}'.format(i)
+        if workers is None:
+            session = Session(sid, 'video')
+        else:
+            pool, pool_results = workers
+            pool_results[sid] = queue.Queue()
+            session = WorkerSession(pool, sid, pool_results[sid])
+        thread = threading.Thread(target=drive_session,
+                                  args=(session, frames, num_frames, input_fps,
+                                        barrier, results))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    start = time.time()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, len(results)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_benchmark(stub, frames, num_faces, num_sessions, skip_inference,
+                  num_workers, stage_threads, args):
+    """Measure one combination of parameters. Returns a dict of results."""
+    stub.num_faces = num_faces
+    webapp.app.config['SKIP_INFERENCE'] = skip_inference
+    webapp.app.config['STAGE_THREADS'] = stage_threads
+    webapp.init_stage_pool()
+    workers = start_worker_pool(num_workers) if num_workers > 0 else None
+
+    # Warm up connections, trackers and allocators without measuring.
+    run_sessions(frames, num_sessions, args.warmup, args.input_fps, workers)
+
+    loop_lag = install_metrics()
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=sample_loop_lag, args=(loop_lag, stop_sampling))
+    sampler.daemon = True
+    sampler.start()
+    cpu_start = time.process_time()
+    wall_sec, num_results = run_sessions(frames, num_sessions, args.frames,
+                                         args.input_fps, workers)
+    cpu_sec = time.process_time() - cpu_start
+    stop_sampling.set()
+    if workers is not None:
+        workers[0].stop()
+
+    result = {
+        'fps': num_results / wall_sec,
+        'fps_per_session': num_results / wall_sec / num_sessions,
+        'cpu_percent': 100. * cpu_sec / wall_sec,
+        'peak_rss_mb': peak_rss_mb(),
+        'latency_ms': {},
+    }
+    histograms = [('end_to_end', webapp.app.frame_latency), ('loop_lag', loop_lag)]
+    histograms += [(stage, webapp.app.stage_latency.labels(stage)) for stage in STAGES]
+    for name, histogram in histograms:
+        quantiles = [histogram.quantile(q) for q in PERCENTILES]
+        if quantiles[0] is not None:
+            result['latency_ms'][name] = [q * 1000 for q in quantiles]
+    return result
+
+
+################################################################################
+# MAIN
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frame-sizes', default='1024x576',
+                        help='Comma-separated WIDTHxHEIGHT sizes of the input frames')
+    parser.add_argument('--faces', default='1',
+                        help='Comma-separated numbers of faces')
+    parser.add_argument('--sessions', default='1',
+                        help='Comma-separated numbers of concurrent sessions')
+    parser.add_argument('--skip-inference', default='no',
+                        help="Comma-separated 'yes'/'no' values of SKIP_INFERENCE")
+    parser.add_argument('--workers', default='0',
+                        help='Comma-separated numbers of worker processes; 0 runs '
+                             'the sessions in this process')
+    parser.add_argument('--stage-threads', default=str(webapp.app.config['STAGE_THREADS']),
+                        help='Comma-separated numbers of native threads for the '
+                             'CPU-bound stages; 0 runs them on the event loop')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Simulated model latency, in seconds')
+    parser.add_argument('--frames', type=int, default=200,
+                        help='Frames measured per session')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='Frames per session before measuring')
+    parser.add_argument('--input-fps', type=float, default=0.,
+                        help='Frame rate of each client; 0 sends the next frame '
+                             'as soon as the previous result arrives')
+    parser.add_argument('--input', help='Video file or directory of images to use '
+                                        'instead of synthetic frames')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    stub = StubModelServer(latency_sec=args.latency).start()
+    webapp.app.config['ML_ENDPOINTS'] = [stub.url]
+    webapp.init_inference()
+
+    header = "{:>10} {:>5} {:>8} {:>4} {:>7} {:>7} {:>8} {:>8} {:>6} {:>7} {:>7} {:>7}".format(
+        'size', 'faces', 'sessions', 'skip', 'workers', 'threads', 'fps', 'fps/sess', 'cpu%',
+        'p50ms', 'p95ms', 'p99ms')
+    rows = []
+    for size, num_faces, num_sessions, skip, num_workers, stage_threads in itertools.product(
+            parse_list(args.frame_sizes, parse_size), parse_list(args.faces, int),
+            parse_list(args.sessions, int), parse_list(args.skip_inference, parse_bool),
+            parse_list(args.workers, int), parse_list(args.stage_threads, int)):
+        width, height = size
+        if args.input:
+            frames = recorded_frames(args.input, width, height)
+        else:
+            frames = synthetic_frames(width, height, num_faces)
+        result = run_benchmark(stub, frames, num_faces, num_sessions, skip,
+                               num_workers, stage_threads, args)
+        result.update({'frame_size': '{}x{}'.format(width, height),
+                       'faces': num_faces, 'sessions': num_sessions,
+                       'skip_inference': skip, 'workers': num_workers,
+                       'stage_threads': stage_threads})
+        rows.append(result)
+
+        if len(rows) == 1:
+            print(header)
+        e2e = result['latency_ms'].get('end_to_end', [float('nan')] * 3)
+        print("{:>10} {:>5} {:>8} {:>4} {:>7} {:>7} {:>8.1f} {:>8.1f} {:>6.0f} {:>7.1f} {:>7.1f} {:>7.1f}".format(
+            result['frame_size'], num_faces, num_sessions, 'yes' if skip else 'no',
+            num_workers, stage_threads, result['fps'], result['fps_per_session'],
+            result['cpu_percent'], *e2e))
+        for stage in ('loop_lag',) + STAGES:
+            if stage in result['latency_ms']:
+                print("{:>58} {:>21} {:>7.2f} {:>7.2f} {:>7.2f}".format(
+                    '', stage, *result['latency_ms'][stage]))
+
+    peak = peak_rss_mb()
+    if peak is not None:
+        print("Peak RSS: {:.0f} MB".format(peak))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Stand-in for the MAX Facial Age Estimator's /model/predict endpoint, for
+benchmarking and trying out the web app without the real model.
+
+Every request gets the same fixed set of faces, laid out on a grid (see
+face_boxes()), after a configurable delay. /model/metadata answers health
+checks right away.
+
+Run from the root of the repository:
+
+    python -m benchmarks.stub_model --port 5000 --latency 0.1 --faces 2
+"""
+
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+def face_boxes(num_faces):
+    """
+    Normalized [y1, x1, y2, x2] boxes of num_faces faces, one per cell of a
+    roughly square grid over the image.
+    """
+    cols = int(math.ceil(math.sqrt(num_faces))) if num_faces > 0 else 1
+    rows = int(math.ceil(num_faces / cols))
+    boxes = []
+    for i in range(num_faces):
+        col, row = i % cols, i // cols
+        cell_w, cell_h = 1. / cols, 1. / rows
+        x1 = (col + 0.3) * cell_w
+        y1 = (row + 0.25) * cell_h
+        boxes.append([y1, x1, y1 + 0.5 * cell_h, x1 + 0.4 * cell_w])
+    return boxes
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # Benchmarks open many connections at once; the default backlog of 5
+    # resets some of them.
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients closing their keep-alive connections are not errors.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class StubModelServer(object):
+    """
+    HTTP server answering /model/predict like the real model server.
+
+    Safe to run in the same process as the web app; under gevent the
+    handler threads are greenlets and the simulated latency does not block
+    the pipeline.
+    """
+
+    def __init__(self, latency_sec=0.1, num_faces=1, port=0, host='127.0.0.1',
+                 age=30.):
+        """
+        Args:
+            latency_sec: Time to wait before answering each request
+            num_faces: Number of faces in every response
+            port: Port to listen on; 0 picks a free one
+            host: Address to listen on
+            age: Age estimate returned for every face
+        """
+        self.latency_sec = latency_sec
+        self.num_faces = num_faces
+        self.age = age
+
+        # Number of requests answered
+        self.num_requests = 0
+
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def predictions(self):
+        return [{'age_estimation': self.age, 'detection_box': box}
+                for box in face_boxes(self.num_faces)]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='StubModelServer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve requests on the calling thread until stop() is called."""
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                # Health checks
+                if self.path.split('?')[0] != '/model/metadata':
+                    self.send_error(404)
+                    return
+                body = json.dumps({'id': 'stub', 'name': 'Stub model'}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                if self.path.split('?')[0] != '/model/predict':
+                    self.send_error(404)
+                    return
+                time.sleep(stub.latency_sec)
+                body = json.dumps({'status': 'ok',
+                                   'predictions': stub.predictions()}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                stub.num_requests += 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--faces', type=int, default=1,
+                        help='Number of faces in every response')
+    args = parser.parse_args()
+
+    server = StubModelServer(args.latency, args.faces, args.port, args.host)
+    print("Stub model server listening on {}".format(server.url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Benchmark of the batched FlowTracker against OpenCV's MultiTracker with one
+TrackerMedianFlow per face, on synthetic tracking-size frames with 1 to 20
+moving faces.
+
+Run from the root of the repository:
+
+    python -m benchmarks.tracking
+"""
+
+import argparse
+import cv2
+import numpy as np
+import time
+
+from tracking import FlowTracker
+
+# Width and height of the frames used for tracking in app.py
+FRAME_SIZE = (256, 144)
+
+FACE_COUNTS = [1, 2, 5, 10, 20]
+
+FACE_SIZE_PX = 24
+
+
+def multitracker_factory():
+    """Returns a function that builds a MultiTracker, or None if this OpenCV
+    build doesn't have one."""
+    legacy = getattr(cv2, 'legacy', None)
+    for module in (cv2, legacy):
+        if module is not None and hasattr(module, 'MultiTracker_create'):
+            def create(image, boxes, module=module):
+                tracker = module.MultiTracker_create()
+                for box in boxes:
+                    tracker.add(module.TrackerMedianFlow_create(), image, tuple(box))
+                return tracker
+            return create
+    return None
+
+
+def synthetic_video(num_faces, num_frames, seed=0):
+    """
+    Frames with num_faces textured squares drifting across a noisy
+    background.
+
+    Returns (frames, initial_boxes), with boxes as (x, y, w, h).
+    """
+    rng = np.random.RandomState(seed)
+    width, height = FRAME_SIZE
+    background = rng.randint(60, 120, (height, width, 3)).astype(np.uint8)
+    textures = [cv2.GaussianBlur(rng.randint(0, 255, (FACE_SIZE_PX, FACE_SIZE_PX, 3)).astype(np.uint8),
+                                 (3, 3), 0) for _ in range(num_faces)]
+    positions = np.stack([rng.uniform(0, width - FACE_SIZE_PX - 20, num_faces),
+                          rng.uniform(0, height - FACE_SIZE_PX - 20, num_faces)], axis=1)
+    velocities = rng.uniform(-1, 1, (num_faces, 2))
+    frames = []
+    for i in range(num_frames):
+        frame = background.copy()
+        for texture, (x, y) in zip(textures, positions + velocities * i):
+            x = int(np.clip(x, 0, width - FACE_SIZE_PX))
+            y = int(np.clip(y, 0, height - FACE_SIZE_PX))
+            frame[y:y + FACE_SIZE_PX, x:x + FACE_SIZE_PX] = texture
+        frames.append(frame)
+    boxes = [(float(x), float(y), FACE_SIZE_PX, FACE_SIZE_PX) for x, y in positions]
+    return frames, boxes
+
+
+def time_tracker(create, frames, boxes):
+    tracker = create(frames[0], boxes)
+    start = time.perf_counter()
+    for frame in frames[1:]:
+        tracker.update(frame)
+    return (time.perf_counter() - start) / (len(frames) - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=100,
+                        help='Number of frames to track per measurement')
+    args = parser.parse_args()
+
+    trackers = [('flow', FlowTracker)]
+    create_multitracker = multitracker_factory()
+    if create_multitracker is not None:
+        trackers.append(('medianflow', create_multitracker))
+    else:
+        print("This OpenCV build has no MultiTracker; only timing FlowTracker.")
+
+    print("{:>6} {:>12} {:>10}".format('faces', 'tracker', 'ms/frame'))
+    for num_faces in FACE_COUNTS:
+        frames, boxes = synthetic_video(num_faces, args.frames)
+        for name, create in trackers:
+            sec = time_tracker(create, frames, boxes)
+            print("{:>6} {:>12} {:>10.3f}".format(num_faces, name, sec * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,3 +21,213 @@ DEBUG = False
 API_TITLE = 'Model Asset Exchange Server'
 API_DESC = 'An API for serving models'
 API_VERSION = '0.1'
+
+# Session settings
+# Maximum number of browser sessions served at once. Further connections are
+# refused until a session disconnects or is evicted.
+MAX_SESSIONS = 32
+
+# Sessions that have not sent a frame for this many seconds are evicted.
+SESSION_IDLE_TIMEOUT_SEC = 30.0
+
+# Worker processes
+# If WORKER_PROCESSES is more than 0, the video pipelines of the sessions run in
+# that many worker processes instead of the web server process, so that they
+# can use more than one core. Needs Python 3.8 or later. Frames and annotated
+# video are passed to and from the workers through shared memory rings of
+# WORKER_RING_SLOTS slots of WORKER_RING_SLOT_BYTES bytes each. Workers that
+# exit, or have not sent a heartbeat (every WORKER_HEARTBEAT_SEC) for
+# WORKER_HEARTBEAT_TIMEOUT_SEC seconds, are restarted. Can be overridden with
+# the --workers command line flag.
+WORKER_PROCESSES = 0
+WORKER_RING_SLOTS = 16
+WORKER_RING_SLOT_BYTES = 1024 * 1024
+WORKER_HEARTBEAT_SEC = 1.0
+WORKER_HEARTBEAT_TIMEOUT_SEC = 10.0
+
+# Model server settings
+# Base URLs of the MAX Facial Age Estimator REST API: one for each replica of the
+# model server. Can be overridden with the --ml-endpoint command line flag.
+ML_ENDPOINTS = ['http://localhost:5000']
+
+# Maximum number of keep-alive connections to each model server replica, shared
+# by all sessions.
+INFERENCE_POOL_SIZE = 32
+
+# Timeouts for connecting to and reading from the model server.
+INFERENCE_CONNECT_TIMEOUT_SEC = 3.0
+INFERENCE_READ_TIMEOUT_SEC = 10.0
+
+# Each request goes to the healthy replica with the fewest requests in flight.
+# Replicas that time out or refuse connections are ejected until they answer a
+# health check; each replica is checked every INFERENCE_HEALTH_CHECK_INTERVAL_SEC
+# and must answer within INFERENCE_HEALTH_CHECK_TIMEOUT_SEC.
+INFERENCE_HEALTH_CHECK_INTERVAL_SEC = 2.0
+INFERENCE_HEALTH_CHECK_TIMEOUT_SEC = 1.0
+
+# A replica that answers, but with a median latency more than
+# INFERENCE_SLOW_REPLICA_FACTOR times that of the fastest replica, gets no
+# requests for INFERENCE_SLOW_REPLICA_EJECT_SEC (0 disables this).
+INFERENCE_SLOW_REPLICA_FACTOR = 3.0
+INFERENCE_SLOW_REPLICA_EJECT_SEC = 30.0
+
+# Hedged requests: with more than one replica, a request that has not been
+# answered after the INFERENCE_HEDGE_PERCENTILE of the fastest replica's recent
+# latencies (but at least INFERENCE_HEDGE_MIN_DELAY_SEC) is also sent to
+# another replica, and the first answer wins. Costs a few percent of extra load
+# on the model servers.
+INFERENCE_HEDGE = False
+INFERENCE_HEDGE_PERCENTILE = 0.95
+INFERENCE_HEDGE_MIN_DELAY_SEC = 0.02
+
+# Number of inference requests each session may have in flight at once.
+INFERENCE_MAX_INFLIGHT = 2
+
+# Inference requests from all sessions are collected into micro-batches of up
+# to INFERENCE_BATCH_MAX_SIZE requests, waiting at most
+# INFERENCE_BATCH_MAX_WAIT_SEC for a batch to fill up. In 'concurrent' mode a
+# batch is sent as parallel requests over the connection pool; in 'mosaic' mode
+# its images are tiled into a single request.
+INFERENCE_BATCH_MODE = 'concurrent'
+INFERENCE_BATCH_MAX_SIZE = 8
+INFERENCE_BATCH_MAX_WAIT_SEC = 0.005
+
+# Frame ingest settings
+# Credit-based flow control: each browser may send at most FLOW_CONTROL_CREDITS
+# frames that its pipeline has not started on yet, and gets a credit back
+# whenever the pipeline picks up a frame. Frames sent without a credit are
+# dropped on arrival. 0 turns flow control off; the browser then paces itself,
+# and frames that arrive while the pipeline is busy replace each other.
+FLOW_CONTROL_CREDITS = 2
+
+# Factor (1, 2, 4 or 8) by which incoming JPEG frames are downscaled during
+# decoding. Only raise this if the browser sends frames much larger than the
+# sizes used for inference and display.
+FRAME_DECODE_REDUCTION = 1
+
+# The CPU-bound stages of the pipelines (decoding, resizing, tracking, drawing
+# and encoding) run on STAGE_THREADS native threads shared by all sessions, so
+# that they don't hold up the event loop that serves the sockets, and OpenCV can
+# work on several frames at once. 0 runs them on the event loop.
+STAGE_THREADS = 4
+
+# JPEG encoding settings
+# Encoder backend: 'turbojpeg' (needs the PyTurboJPEG package), 'opencv',
+# 'pil', or 'auto' to pick the fastest one available.
+JPEG_ENCODER = 'auto'
+
+# JPEG quality of the annotated frames sent back to the browser, and of the
+# frames uploaded to the model server. A DISPLAY_JPEG_QUALITY of 85 looks
+# about the same in the browser and is recommended: frames are smaller and
+# encode faster.
+DISPLAY_JPEG_QUALITY = 95
+INFERENCE_JPEG_QUALITY = 95
+
+# Adaptive video output
+# In 'video' output mode, the width and JPEG quality of the annotated frames
+# are adapted to each browser's link. While the time from receiving a frame to
+# writing its result to the browser averages more than
+# DISPLAY_TARGET_LATENCY_SEC, they are stepped down, at most once every
+# DISPLAY_ADAPT_INTERVAL_SEC; while it stays below half of that, they are
+# stepped back up. The width stays between DISPLAY_MIN_WIDTH_PX and
+# DISPLAY_IMAGE_WIDTH_PX, the quality between DISPLAY_MIN_JPEG_QUALITY and
+# DISPLAY_JPEG_QUALITY. Frames that would arrive late while a newer one is
+# waiting are skipped. Not available with worker processes, which always send
+# DISPLAY_IMAGE_WIDTH_PX frames at DISPLAY_JPEG_QUALITY.
+ADAPTIVE_DISPLAY = True
+DISPLAY_IMAGE_WIDTH_PX = 1024
+DISPLAY_MIN_WIDTH_PX = 320
+DISPLAY_MIN_JPEG_QUALITY = 40
+DISPLAY_TARGET_LATENCY_SEC = 0.25
+DISPLAY_ADAPT_INTERVAL_SEC = 1.0
+
+# Output settings
+# Default way of sending results back to the browser: 'video' streams annotated
+# JPEG frames over /video_feed; 'annotations' sends only box coordinates and
+# ages over Socket.IO and the browser draws them over its local video. Clients
+# can override this with the 'output' query parameter of their Socket.IO
+# connection.
+OUTPUT_MODE = 'video'
+
+# Scene change detection
+# If enabled, a new inference request is only sent when the frame differs from
+# the one of the previous request by more than SCENE_CHANGE_THRESHOLD (mean
+# absolute difference of small grayscale thumbnails, as a fraction of the pixel
+# range), or when the previous request is older than SCENE_MAX_REUSE_SEC.
+SCENE_CHANGE_DETECTION = True
+SCENE_CHANGE_THRESHOLD = 0.02
+SCENE_MAX_REUSE_SEC = 5.0
+
+# Face crop inference
+# If enabled, faces that are already being tracked are sent to the model as
+# padded crops packed into one small image, instead of sending the whole frame.
+# The whole frame is still sent every FACE_CROP_FULL_DETECTION_INTERVAL_SEC
+# seconds, and whenever tracking fails, so that new faces are found.
+# FACE_CROP_PADDING is the context added around each face, as a fraction of
+# the face's width and height on each side.
+FACE_CROP_INFERENCE = False
+FACE_CROP_FULL_DETECTION_INTERVAL_SEC = 2.0
+FACE_CROP_PADDING = 0.5
+
+# Inference scheduling
+# Maximum number of inference requests per second across all sessions. 0 means
+# unlimited.
+INFERENCE_BUDGET_PER_SEC = 0
+
+# Age labels are refreshed at least this often, even if nothing seems to change.
+SCHEDULER_MAX_STALENESS_SEC = 5.0
+
+# While the mean change between consecutive age estimates stays below
+# SCHEDULER_STABLE_AGE_DELTA years, the interval between requests doubles, up
+# to SCHEDULER_MAX_BACKOFF times the backend round-trip time.
+SCHEDULER_STABLE_AGE_DELTA = 1.0
+SCHEDULER_MAX_BACKOFF = 8.0
+
+# Tracker catch-up
+# When an inference result arrives, a new tracker is created on the frame that
+# was submitted and replayed over the frames that went by since. The last
+# CATCHUP_RING_CAPACITY frames of each session are kept for this; at most
+# CATCHUP_MAX_FRAMES of them are replayed (every k-th frame if there are more)
+# within at most CATCHUP_TIME_BUDGET_SEC seconds (0 means no limit). With
+# CATCHUP_ASYNC the replay runs on one of CATCHUP_WORKERS background threads
+# while the video keeps going with the old tracker.
+CATCHUP_RING_CAPACITY = 64
+CATCHUP_MAX_FRAMES = 16
+CATCHUP_TIME_BUDGET_SEC = 0.05
+CATCHUP_ASYNC = True
+CATCHUP_WORKERS = 4
+
+# Face tracker between inference results: 'flow' tracks all faces with one
+# batched optical flow pass (tracking.FlowTracker); 'medianflow' uses OpenCV's
+# MultiTracker with one TrackerMedianFlow per face.
+TRACKER_ENGINE = 'flow'
+
+# Persistent face tracks (tracking.TrackStore): a new face is shown once it
+# has been detected in TRACK_MIN_HITS consecutive inference results, and
+# dropped once it has been missed in TRACK_MAX_MISSES consecutive results.
+# Detections are matched to faces by IoU and center distance, up to a cost of
+# TRACK_MAX_MATCH_COST.
+TRACK_MIN_HITS = 2
+TRACK_MAX_MISSES = 2
+TRACK_MAX_MATCH_COST = 1.5
+
+# Session journal (journal.py): with JOURNAL_ENABLED, the frames each session
+# receives and the model's predictions for them are recorded under
+# JOURNAL_DIR, one directory per session, for replaying them later. A new
+# segment file is started every JOURNAL_SEGMENT_BYTES, and only the last
+# JOURNAL_MAX_SEGMENTS segments of a session are kept (0 keeps them all).
+# Records are dropped if the writer falls more than JOURNAL_MAX_QUEUED records
+# behind. In worker mode (--workers), only the frames are recorded.
+JOURNAL_ENABLED = False
+JOURNAL_DIR = 'journal'
+JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024
+JOURNAL_MAX_SEGMENTS = 16
+JOURNAL_MAX_QUEUED = 1000
+
+# Print a line for every frame received and sent. Per-stage latencies and
+# frame counts are always available on /metrics.
+LOG_FRAMES = False
+
+# Skip inference and tracking and send the frames straight back, to help
+# debug end-to-end latency issues.
+SKIP_INFERENCE = False
@@ -0,0 +1,133 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Bounding box geometry on (N, 4) float32 arrays, one row per box.
+
+Three box formats appear in the app:
+  * yxyx: [y1, x1, y2, x2], the corners of the box. This is what the model
+    returns in 'detection_box', normalized to [0, 1] by the image height
+    (y) and width (x).
+  * xywh: [x, y, w, h], the upper left corner plus width and height. This
+    is what the trackers and the TrackStore work with.
+  * xyxy: [x1, y1, x2, y2], the corners of the box. This is what drawing
+    and cropping need.
+"""
+
+import numpy as np
+
+
+def as_boxes(boxes):
+    """Convert a sequence of 4-element boxes to an (N, 4) float32 array."""
+    return np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+def parse_predictions(predictions):
+    """
+    Extract the boxes and ages from the model's list of predictions.
+
+    Returns a tuple (boxes, ages): the normalized yxyx boxes as an (N, 4)
+    array and the age estimates as an (N,) array.
+    """
+    boxes = as_boxes([entry['detection_box'] for entry in predictions])
+    ages = np.array([entry['age_estimation'] for entry in predictions],
+                    dtype=np.float32)
+    return boxes, ages
+
+
+def denormalize(boxes_yxyx, width, height):
+    """Scale normalized yxyx boxes up to pixel coordinates of an image of
+    the given size."""
+    return as_boxes(boxes_yxyx) * np.array([height, width, height, width],
+                                           dtype=np.float32)
+
+
+def normalize(boxes_yxyx, width, height):
+    """Inverse of denormalize()."""
+    return as_boxes(boxes_yxyx) / np.array([height, width, height, width],
+                                           dtype=np.float32)
+
+
+def scale(boxes, orig_width, new_width):
+    """
+    Scale boxes in any format to reflect a change in image size from
+    orig_width to new_width pixels wide, keeping the aspect ratio.
+    """
+    return as_boxes(boxes) * np.float32(new_width / orig_width)
+
+
+def yxyx_to_xywh(boxes):
+    boxes = as_boxes(boxes)
+    return np.stack([boxes[:, 1], boxes[:, 0],
+                     boxes[:, 3] - boxes[:, 1], boxes[:, 2] - boxes[:, 0]], axis=1)
+
+
+def xywh_to_yxyx(boxes):
+    boxes = as_boxes(boxes)
+    return np.stack([boxes[:, 1], boxes[:, 0],
+                     boxes[:, 1] + boxes[:, 3], boxes[:, 0] + boxes[:, 2]], axis=1)
+
+
+def xywh_to_xyxy(boxes):
+    boxes = as_boxes(boxes)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+
+
+def xyxy_to_xywh(boxes):
+    boxes = as_boxes(boxes)
+    return np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+
+
+def centers(boxes_xywh):
+    """(N, 2) array of the (x, y) centers of xywh boxes."""
+    boxes = as_boxes(boxes_xywh)
+    return boxes[:, :2] + boxes[:, 2:] / 2
+
+
+def clip_xyxy(boxes_xyxy, width, height):
+    """Clip xyxy boxes to an image of the given size."""
+    limits = np.array([width, height, width, height], dtype=np.float32)
+    return np.clip(as_boxes(boxes_xyxy), 0, limits)
+
+
+def clip_xywh(boxes_xywh, width, height):
+    """Clip xywh boxes to an image of the given size. Boxes entirely outside
+    the image end up with zero width or height."""
+    return xyxy_to_xywh(clip_xyxy(xywh_to_xyxy(boxes_xywh), width, height))
+
+
+def to_pixels(boxes):
+    """Round boxes to integer pixel coordinates, as an (N, 4) int32 array."""
+    return np.rint(as_boxes(boxes)).astype(np.int32)
+
+
+def iou(boxes_a, boxes_b):
+    """
+    Intersection over union of every pair of xywh boxes.
+
+    Args:
+        boxes_a: (N, 4) array of boxes
+        boxes_b: (M, 4) array of boxes
+
+    Returns an (N, M) array.
+    """
+    a = xywh_to_xyxy(boxes_a)[:, None, :]
+    b = xywh_to_xyxy(boxes_b)[None, :, :]
+    overlap = np.minimum(a[..., 2:], b[..., 2:]) - np.maximum(a[..., :2], b[..., :2])
+    intersection = np.prod(np.clip(overlap, 0, None), axis=2)
+    area_a = np.prod(a[..., 2:] - a[..., :2], axis=2)
+    area_b = np.prod(b[..., 2:] - b[..., :2], axis=2)
+    return intersection / np.maximum(area_a + area_b - intersection, 1e-6)
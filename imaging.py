@@ -0,0 +1,291 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import cv2
+import numpy as np
+import time
+
+from gevent.monkey import get_original
+from io import BytesIO
+from PIL import Image
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+
+def scaled_height(img_np, target_width_px):
+    """Height of img_np after scaling it to target_width_px pixels wide."""
+    img_h, img_w = img_np.shape[:2]
+    return int(target_width_px * img_h / img_w)
+
+
+class FramePyramid(object):
+    """
+    Lazily computed versions of one video frame at different widths.
+
+    Each level is only computed the first time it is requested, and is
+    derived from the smallest level already built that is at least as large,
+    so a frame only pays for the sizes it actually uses.
+
+    There are two kinds of levels:
+      * Read-only levels, returned by level(). These may be the base frame
+        itself or shared with other callers, and must not be modified. They
+        are freshly allocated, so it is safe to hold on to them after the
+        next frame arrives; the inference level, for one, is queued for the
+        model server and may only be encoded once later frames have come in.
+      * Writable levels, returned by writable_level(). These live in a
+        buffer owned by the pyramid that is reused from frame to frame, so
+        the caller may draw on them but must be done with them before the
+        next call to set_base().
+
+    One pyramid object is meant to be reused for every frame of a session.
+    """
+
+    def __init__(self):
+        # Read-only levels of the current frame, by width
+        self._levels = {}
+
+        # Preallocated buffers for writable levels, by width. Reused across
+        # frames as long as the frame size does not change.
+        self._buffers = {}
+
+    def set_base(self, img_np):
+        """Start a new frame. img_np is treated as read-only."""
+        self._levels = {img_np.shape[1]: img_np}
+
+    @property
+    def base(self):
+        return self._levels[max(self._levels)]
+
+    def level(self, width_px):
+        """
+        Return the current frame at a width of width_px pixels, as a
+        read-only array.
+        """
+        img = self._levels.get(width_px)
+        if img is None:
+            img = cv2.resize(self._source_for(width_px),
+                             (width_px, scaled_height(self.base, width_px)))
+            self._levels[width_px] = img
+        return img
+
+    def writable_level(self, width_px):
+        """
+        Return a private, writable copy of the current frame at a width of
+        width_px pixels. The returned buffer is reused by the next frame.
+        """
+        size = (scaled_height(self.base, width_px), width_px)
+        buf = self._buffers.get(width_px)
+        if buf is None or buf.shape[:2] != size:
+            buf = np.empty(size + self.base.shape[2:], dtype=self.base.dtype)
+            self._buffers[width_px] = buf
+        src = self._levels.get(width_px)
+        if src is not None:
+            np.copyto(buf, src)
+        else:
+            cv2.resize(self._source_for(width_px), (width_px, size[0]), dst=buf)
+        return buf
+
+    def _source_for(self, width_px):
+        """Smallest existing level that is at least width_px wide."""
+        larger = [w for w in self._levels if w >= width_px]
+        return self._levels[min(larger) if larger else max(self._levels)]
+
+
+class SceneChangeDetector(object):
+    """
+    Cheap test for whether a video frame differs materially from a reference
+    frame.
+
+    Frames are reduced to small grayscale thumbnails and compared by mean
+    absolute pixel difference, so the test costs next to nothing compared to
+    a call to the model.
+    """
+
+    # Size of the thumbnails that are compared, in pixels
+    THUMBNAIL_SIZE = (32, 18)
+
+    def __init__(self, threshold=0.02, max_reuse_sec=5.0, clock=time.time):
+        """
+        Args:
+            threshold: Mean absolute difference between thumbnails, as a
+                fraction of the full pixel range, above which the scene
+                counts as changed
+            max_reuse_sec: The scene counts as changed once the reference
+                frame is older than this, however similar the frames are
+            clock: Function that returns the current time in seconds
+        """
+        self.threshold = threshold
+        self.max_reuse_sec = max_reuse_sec
+        self.clock = clock
+        self._reference = None
+        self._reference_time = 0.
+
+    def _thumbnail(self, img_np):
+        small = cv2.resize(img_np, self.THUMBNAIL_SIZE,
+                           interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+    def changed(self, img_np):
+        """
+        Returns True if img_np differs materially from the reference frame,
+        or if there is no usable reference frame.
+        """
+        if (self._reference is None
+                or self.clock() - self._reference_time > self.max_reuse_sec):
+            return True
+        diff = cv2.absdiff(self._thumbnail(img_np), self._reference)
+        return cv2.mean(diff)[0] / 255. > self.threshold
+
+    def set_reference(self, img_np):
+        """Compare future frames against img_np."""
+        self._reference = self._thumbnail(img_np)
+        self._reference_time = self.clock()
+
+    def reset(self):
+        """Forget the reference frame, so that the next frame counts as
+        changed."""
+        self._reference = None
+
+
+################################################################################
+# JPEG ENCODERS
+
+class JpegEncoder(object):
+    """
+    Base class for JPEG encoder backends.
+
+    All encoders take RGB images as numpy arrays and return the encoded
+    image as a bytes-like object (something that supports the buffer
+    protocol, such as bytes or memoryview). Use bytes() on the result if an
+    actual bytes object is needed.
+
+    The encoded image is a new object for every frame, since the caller
+    keeps it after the encoder has moved on to the next frame. Working
+    buffers are reused where the backend allows it: the OpenCV backend's
+    color conversion buffer and the Pillow backend's output stream.
+    libjpeg-turbo allocates its own buffers.
+    """
+
+    name = None
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def encode(self, np_image, quality):
+        raise NotImplementedError()
+
+
+class PILJpegEncoder(JpegEncoder):
+    """
+    Pillow backend. Slowest, but always available. Each thread writes into
+    its own output stream, which keeps the memory it has grown to between
+    frames.
+    """
+
+    name = 'pil'
+
+    def __init__(self):
+        # Native thread-local; see OpenCVJpegEncoder
+        self._local = get_original('threading', 'local')()
+
+    def encode(self, np_image, quality):
+        f = getattr(self._local, 'stream', None)
+        if f is None:
+            f = self._local.stream = BytesIO()
+        f.seek(0)
+        Image.fromarray(np_image).save(f, format='JPEG', quality=quality)
+        # Only the bytes written for this frame; truncating would give the
+        # memory back.
+        return f.getbuffer()[:f.tell()].tobytes()
+
+
+class OpenCVJpegEncoder(JpegEncoder):
+    """
+    OpenCV backend. The RGB to BGR conversion that OpenCV needs goes into a
+    per-thread buffer that is reused as long as the image size stays the
+    same.
+    """
+
+    name = 'opencv'
+
+    def __init__(self):
+        # A native thread-local, even after gevent's monkey patching: encode()
+        # runs on the stage pool's native threads (see stages.py), which must
+        # not touch gevent objects. Greenlets on the same thread share the
+        # buffer, which is safe because encode() never yields.
+        self._local = get_original('threading', 'local')()
+
+    def encode(self, np_image, quality):
+        buf = getattr(self._local, 'bgr', None)
+        if buf is None or buf.shape != np_image.shape:
+            buf = np.empty_like(np_image)
+            self._local.bgr = buf
+        cv2.cvtColor(np_image, cv2.COLOR_RGB2BGR, dst=buf)
+        ok, encoded = cv2.imencode('.jpg', buf,
+                                   [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        if not ok:
+            raise ValueError("JPEG encoding failed")
+        return encoded.data
+
+
+class TurboJpegEncoder(JpegEncoder):
+    """
+    libjpeg-turbo backend via the optional PyTurboJPEG package. Encodes RGB
+    directly, without a color conversion pass.
+    """
+
+    name = 'turbojpeg'
+
+    @classmethod
+    def available(cls):
+        if TurboJPEG is None:
+            return False
+        try:
+            TurboJPEG()
+        except (OSError, RuntimeError):
+            # Python package installed, but the native library is missing
+            return False
+        return True
+
+    def __init__(self):
+        self._jpeg = TurboJPEG()
+
+    def encode(self, np_image, quality):
+        return self._jpeg.encode(np_image, quality=int(quality),
+                                 pixel_format=TJPF_RGB)
+
+
+# Encoder backends, fastest first
+JPEG_ENCODERS = [TurboJpegEncoder, OpenCVJpegEncoder, PILJpegEncoder]
+
+
+def get_jpeg_encoder(name='auto'):
+    """
+    Create a JPEG encoder.
+
+    Args:
+        name: Name of the backend ('turbojpeg', 'opencv' or 'pil'), or
+            'auto' for the fastest one available
+
+    Returns a JpegEncoder instance.
+    """
+    for cls in JPEG_ENCODERS:
+        if name in ('auto', cls.name) and cls.available():
+            return cls()
+    raise ValueError("JPEG encoder '{}' is not available".format(name))
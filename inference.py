@@ -0,0 +1,669 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import math
+import numpy as np
+import queue
+import requests
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+
+
+class InvalidResponse(requests.RequestException):
+    """The model server answered, but not with a list of predictions."""
+
+
+class InferenceClient(object):
+    """
+    Client for the MAX Facial Age Estimator REST API.
+
+    Keeps a pool of keep-alive connections to the model server so that each
+    request does not pay for a new TCP handshake. Safe to share between
+    sessions and threads.
+    """
+
+    PREDICT_PATH = '/model/predict'
+    METADATA_PATH = '/model/metadata'
+
+    def __init__(self, endpoint, pool_size=10, connect_timeout_sec=3.0,
+                 read_timeout_sec=10.0):
+        """
+        Args:
+            endpoint: Base URL of the model server, e.g.
+                'http://localhost:5000'
+            pool_size: Maximum number of connections kept open to the model
+                server
+            connect_timeout_sec: Timeout for establishing a connection
+            read_timeout_sec: Timeout for waiting on the response
+        """
+        self.endpoint = endpoint.rstrip('/')
+        self.url = self.endpoint + self.PREDICT_PATH
+        self.timeout = (connect_timeout_sec, read_timeout_sec)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def predict(self, jpeg_bytes):
+        """
+        Run the age estimation model on a single image.
+
+        Args:
+            jpeg_bytes: JPEG-encoded image
+
+        Returns the list of predictions from the model, each a dict with
+        'detection_box' and 'age_estimation' keys.
+
+        Raises requests.RequestException if the request fails or times out,
+        or InvalidResponse (a subclass) if the response is not valid.
+        """
+        files = {'image': ('frame.jpg', jpeg_bytes, 'image/jpeg')}
+        r = self._session.post(self.url, files=files, timeout=self.timeout,
+                               headers={'accept': 'application/json'})
+        r.raise_for_status()
+        try:
+            predictions = r.json()['predictions']
+        except (ValueError, KeyError, TypeError) as e:
+            # Not JSON, or not the object we expect
+            raise InvalidResponse("Invalid response from {}: {!r}".format(self.url, e),
+                                  response=r)
+        if not isinstance(predictions, list) or not all(
+                isinstance(entry, dict) and 'detection_box' in entry and 'age_estimation' in entry
+                for entry in predictions):
+            raise InvalidResponse("Invalid predictions from {}: {!r}".format(
+                self.url, predictions), response=r)
+        return predictions
+
+    def check_health(self, timeout_sec=1.0):
+        """Returns True if the model server answers a metadata request within
+        timeout_sec."""
+        try:
+            r = self._session.get(self.endpoint + self.METADATA_PATH, timeout=timeout_sec)
+            return r.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def close(self):
+        self._session.close()
+
+
+class _Replica(object):
+    """One model server behind an InferenceRouter, its load and its recent
+    latencies."""
+
+    def __init__(self, client, latency_window):
+        self.client = client
+        self.endpoint = client.endpoint
+
+        # Latencies of the most recent successful requests, in seconds
+        self.latencies = deque(maxlen=latency_window)
+
+        # While a replica is much slower than the others, it gets no requests
+        # until this time (see InferenceRouter._check_slow())
+        self.slow_until = 0.
+
+        # Requests sent to this replica that have not completed yet
+        self.outstanding = 0
+        self.num_requests = 0
+
+        # Replicas are ejected when a request to them times out or cannot
+        # connect, and reinstated once they pass a health check.
+        self.healthy = True
+
+
+class InferenceRouter(object):
+    """
+    Spreads inference requests over several replicas of the model server.
+
+    Has the same predict() method as InferenceClient. Each request goes to
+    the healthy replica with the fewest requests outstanding. A replica that
+    times out or refuses connections is ejected until it passes one of the
+    health checks that run in the background, and the request is retried
+    once on another replica.
+
+    A replica that stays healthy but answers much more slowly than the
+    others (its median latency more than slow_factor times that of the
+    fastest replica) gets no requests for slow_eject_sec, and is then judged
+    afresh.
+
+    With hedging on, a request that is still running after the 95th
+    percentile of recent latencies of the fastest replica is also sent to a
+    second replica, and whichever answer comes first is used. The slow
+    request is left to finish, so this costs about 5% extra load.
+    """
+
+    # Number of recent latencies kept per replica, and the number needed
+    # before a replica counts for hedging and slow replica detection
+    LATENCY_WINDOW = 100
+    MIN_LATENCY_SAMPLES = 10
+
+    def __init__(self, endpoints, pool_size=10, connect_timeout_sec=3.0,
+                 read_timeout_sec=10.0, health_check_interval_sec=2.0,
+                 health_check_timeout_sec=1.0, hedge=False, hedge_percentile=0.95,
+                 hedge_min_delay_sec=0.02, slow_factor=3.0, slow_eject_sec=30.0,
+                 on_event=None):
+        """
+        Args:
+            endpoints: Base URLs of the model server replicas
+            pool_size, connect_timeout_sec, read_timeout_sec: Settings of the
+                InferenceClient of each replica
+            health_check_interval_sec: Interval between health checks of
+                each replica
+            health_check_timeout_sec: Time a replica has to answer a health
+                check
+            hedge: Whether to send slow requests to a second replica
+            hedge_percentile: Percentile of recent latencies after which a
+                request is hedged
+            hedge_min_delay_sec: Minimum delay before a request is hedged
+            slow_factor: Ratio of a replica's median latency to the fastest
+                replica's above which it is taken out of rotation; 0 never
+                does
+            slow_eject_sec: How long a slow replica is taken out of rotation
+            on_event: Optional function called as on_event(event, endpoint)
+                for 'ejected', 'reinstated', 'slow', 'failover', 'hedge' and
+                'hedge_won' events, e.g. to count them
+        """
+        if len(endpoints) == 0:
+            raise ValueError("No model server endpoints given")
+        self.replicas = [_Replica(InferenceClient(endpoint, pool_size, connect_timeout_sec,
+                                                  read_timeout_sec),
+                                  self.LATENCY_WINDOW)
+                         for endpoint in endpoints]
+        self.health_check_interval_sec = health_check_interval_sec
+        self.health_check_timeout_sec = health_check_timeout_sec
+        self.hedge = hedge and len(self.replicas) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay_sec = hedge_min_delay_sec
+        self.slow_factor = slow_factor
+        self.slow_eject_sec = slow_eject_sec
+        self.on_event = on_event
+
+        self._lock = threading.Lock()
+
+        # Runs the first request of each hedged pair, so that the calling
+        # thread can wait for either answer
+        self._executor = ThreadPoolExecutor(max_workers=pool_size * len(self.replicas))
+
+        self._closed = False
+        self._thread = threading.Thread(target=self._health_check_loop,
+                                        name='InferenceRouter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, jpeg_bytes):
+        """
+        Run the age estimation model on a single image, on one or two of the
+        replicas.
+
+        Returns the list of predictions from the model; see
+        InferenceClient.predict().
+
+        Raises requests.RequestException if the request fails on every
+        replica it was sent to.
+        """
+        primary = self._acquire()
+        delay = self._hedge_delay()
+        if delay is None:
+            try:
+                return self._call(primary, jpeg_bytes)
+            except (requests.ConnectionError, requests.Timeout):
+                backup = self._acquire(exclude=primary)
+                if backup is None:
+                    raise
+                self._event('failover', backup)
+                return self._call(backup, jpeg_bytes)
+
+        first = self._executor.submit(self._call, primary, jpeg_bytes)
+        done, _ = wait([first], timeout=delay)
+        retryable = (requests.ConnectionError, requests.Timeout)
+        if len(done) > 0 and not isinstance(first.exception(), retryable):
+            # Answered in time, or failed in a way that another replica
+            # wouldn't fix
+            return first.result()
+        backup = self._acquire(exclude=primary)
+        if backup is None:
+            return first.result()
+        self._event('failover' if len(done) > 0 else 'hedge', backup)
+        second = self._executor.submit(self._call, backup, jpeg_bytes)
+
+        pending = {first, second}
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second and first in pending:
+                        self._event('hedge_won', backup)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def close(self):
+        self._closed = True
+        self._executor.shutdown(wait=False)
+        for replica in self.replicas:
+            replica.client.close()
+
+    def _acquire(self, exclude=None):
+        """
+        Pick the healthy replica with the fewest outstanding requests, other
+        than exclude, and count a request against it. Replicas that are too
+        slow are only picked if there is no other healthy one. Without an
+        exclude, falls back to all replicas if none is healthy.
+
+        Returns the replica, or None if there is none to pick.
+        """
+        now = time.time()
+        with self._lock:
+            for replica in self.replicas:
+                if 0. < replica.slow_until <= now:
+                    # Give it another chance, judged on new latencies only.
+                    replica.slow_until = 0.
+                    replica.latencies.clear()
+            candidates = [r for r in self.replicas if r.healthy and r is not exclude]
+            fast = [r for r in candidates if r.slow_until == 0.]
+            if len(fast) > 0:
+                candidates = fast
+            if len(candidates) == 0 and exclude is None:
+                candidates = self.replicas
+            if len(candidates) == 0:
+                return None
+            replica = min(candidates, key=lambda r: (r.outstanding, r.num_requests))
+            replica.outstanding += 1
+            replica.num_requests += 1
+            return replica
+
+    def _call(self, replica, jpeg_bytes):
+        """Send a request to a replica that was picked with _acquire()."""
+        start = time.time()
+        try:
+            predictions = replica.client.predict(jpeg_bytes)
+        except (requests.ConnectionError, requests.Timeout):
+            self._set_health(replica, False)
+            raise
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+        with self._lock:
+            replica.latencies.append(time.time() - start)
+        self._check_slow(replica)
+        return predictions
+
+    def _latency_percentiles(self, q):
+        """Dict from each replica with enough latency samples to the q-th
+        percentile of its latencies."""
+        with self._lock:
+            samples = {r: np.array(r.latencies) for r in self.replicas
+                       if len(r.latencies) >= self.MIN_LATENCY_SAMPLES}
+        return {r: float(np.percentile(latencies, q)) for r, latencies in samples.items()}
+
+    def _hedge_delay(self):
+        """Time after which to hedge a request, or None not to."""
+        if not self.hedge:
+            return None
+        # A slow replica must not raise the threshold for its own requests,
+        # so go by the fastest replica.
+        percentiles = self._latency_percentiles(100 * self.hedge_percentile)
+        if len(percentiles) == 0:
+            return None
+        return max(min(percentiles.values()), self.hedge_min_delay_sec)
+
+    def _check_slow(self, replica):
+        """Take a replica out of rotation for a while if it is much slower
+        than the fastest one."""
+        if self.slow_factor <= 0 or len(self.replicas) < 2:
+            return
+        medians = self._latency_percentiles(50)
+        if replica not in medians or len(medians) < 2:
+            return
+        fastest = min(medians.values())
+        if medians[replica] <= self.slow_factor * max(fastest, 1e-3):
+            return
+        with self._lock:
+            if replica.slow_until > 0.:
+                return
+            replica.slow_until = time.time() + self.slow_eject_sec
+        print("Model server {} is slow ({:.0f} ms median, fastest {:.0f} ms); taking it "
+              "out of rotation for {:.0f} s".format(replica.endpoint, 1000 * medians[replica],
+                                                    1000 * fastest, self.slow_eject_sec))
+        self._event('slow', replica)
+
+    def _set_health(self, replica, healthy):
+        with self._lock:
+            changed = replica.healthy != healthy
+            replica.healthy = healthy
+        if changed:
+            print("{} model server {}".format('Reinstating' if healthy else 'Ejecting',
+                                              replica.endpoint))
+            self._event('reinstated' if healthy else 'ejected', replica)
+
+    def _event(self, event, replica):
+        if self.on_event is not None:
+            self.on_event(event, replica.endpoint)
+
+    def _health_check_loop(self):
+        while not self._closed:
+            time.sleep(self.health_check_interval_sec)
+            for replica in self.replicas:
+                if self._closed:
+                    return
+                self._set_health(replica, replica.client.check_health(
+                    self.health_check_timeout_sec))
+
+
+class BatchingGateway(object):
+    """
+    Collects inference requests from all sessions and dispatches them to the
+    model server in micro-batches.
+
+    Requests are gathered until either max_batch_size requests are waiting or
+    max_wait_sec has passed since the first one arrived. A batch is then sent
+    either as concurrent requests over the pooled connections ('concurrent'
+    mode) or tiled into a single mosaic image whose detections are split back
+    per request ('mosaic' mode).
+    """
+
+    MODES = ('concurrent', 'mosaic')
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_sec=0.01,
+                 mode='concurrent', num_workers=8, batch_size=None,
+                 batch_latency=None):
+        """
+        Args:
+            predict_fn: Function that takes an image as a numpy array and
+                returns the model's list of predictions for it
+            max_batch_size: Maximum number of requests per batch
+            max_wait_sec: Maximum time the first request of a batch waits
+                for more requests to arrive
+            mode: 'concurrent' or 'mosaic'
+            num_workers: Number of batches ('mosaic') or requests
+                ('concurrent') sent to the model server at once
+            batch_size: Optional histogram in which the number of requests
+                in each batch is recorded
+            batch_latency: Optional histogram in which the time from
+                dispatching each batch to its last result is recorded
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown batching mode '{}'".format(mode))
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_sec
+        self.mode = mode
+
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+
+        # Number of batches and requests dispatched. Batches finish in
+        # different threads, so these are guarded by _stats_lock.
+        self.num_batches = 0
+        self.num_requests = 0
+        self._stats_lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._closed = False
+        self._thread = threading.Thread(target=self._dispatch_loop,
+                                        name='BatchingGateway')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, np_image):
+        """
+        Queue an image for inference.
+
+        Returns a Future whose result is the list of predictions for this
+        image, exactly as predict_fn would return them.
+        """
+        future = Future()
+        self._queue.put((np_image, future))
+        return future
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._executor.shutdown(wait=False)
+
+    def _next_batch(self):
+        """Block until a batch is ready and return it as a list."""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait_sec
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _dispatch_loop(self):
+        while not self._closed:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if self.mode == 'mosaic' and len(batch) > 1:
+                self._executor.submit(self._run_mosaic, batch)
+            else:
+                self._run_concurrent(batch)
+
+    def _record_batch(self, batch_size, start_time):
+        latency_sec = time.time() - start_time
+        with self._stats_lock:
+            self.num_batches += 1
+            self.num_requests += batch_size
+        if self.batch_size is not None:
+            self.batch_size.observe(batch_size)
+        if self.batch_latency is not None:
+            self.batch_latency.observe(latency_sec)
+
+    def _run_concurrent(self, batch):
+        start = time.time()
+        lock = threading.Lock()
+        remaining = [len(batch)]
+
+        def on_done(_):
+            # The batch is finished when its last request is.
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                self._record_batch(len(batch), start)
+
+        for np_image, future in batch:
+            future.add_done_callback(on_done)
+            try:
+                self._executor.submit(self._run_one, np_image, future)
+            except RuntimeError as e:
+                # The executor has been shut down, e.g. at interpreter exit.
+                future.set_exception(e)
+
+    def _run_one(self, np_image, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.predict_fn(np_image))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _run_mosaic(self, batch):
+        start = time.time()
+        futures = [f for _, f in batch if f.set_running_or_notify_cancel()]
+        images = [img for img, f in batch if f in futures]
+        try:
+            mosaic, offsets = make_mosaic(images)
+            predictions = self.predict_fn(mosaic)
+            per_image = split_mosaic_predictions(predictions, mosaic.shape,
+                                                 images, offsets)
+            for future, result in zip(futures, per_image):
+                future.set_result(result)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        self._record_batch(len(futures), start)
+
+
+def make_mosaic(images):
+    """
+    Tile a list of images into a single image.
+
+    Images are placed on a roughly square grid whose cells are as large as
+    the largest image; each image sits in the upper left corner of its cell.
+
+    Args:
+        images: List of numpy arrays of shape (height, width, channels)
+
+    Returns a tuple (mosaic, offsets), where offsets[i] is the (x, y) pixel
+    position of images[i] within the mosaic.
+    """
+    cols = int(math.ceil(math.sqrt(len(images))))
+    rows = int(math.ceil(len(images) / cols))
+    cell_h = max(img.shape[0] for img in images)
+    cell_w = max(img.shape[1] for img in images)
+    mosaic = np.zeros((rows * cell_h, cols * cell_w, images[0].shape[2]),
+                      dtype=images[0].dtype)
+    offsets = []
+    for i, img in enumerate(images):
+        x = (i % cols) * cell_w
+        y = (i // cols) * cell_h
+        mosaic[y:y + img.shape[0], x:x + img.shape[1]] = img
+        offsets.append((x, y))
+    return mosaic, offsets
+
+
+def split_mosaic_predictions(predictions, mosaic_shape, images, offsets):
+    """
+    Assign the model's predictions on a mosaic back to the tiles it was
+    built from.
+
+    Each detection goes to the image containing the center of its box, and
+    its 'detection_box' is renormalized to that image's dimensions.
+
+    Args:
+        predictions: Predictions returned by the model for the mosaic
+        mosaic_shape: Shape of the mosaic image
+        images: The images that were tiled, in order
+        offsets: Position of each image in the mosaic, as returned by
+            make_mosaic()
+
+    Returns a list with one list of predictions per image.
+    """
+    mosaic_h, mosaic_w = mosaic_shape[:2]
+    ret = [[] for _ in images]
+    for entry in predictions:
+        y1, x1, y2, x2 = entry['detection_box']
+        y1, y2 = y1 * mosaic_h, y2 * mosaic_h
+        x1, x2 = x1 * mosaic_w, x2 * mosaic_w
+        center_x, center_y = (x1 + x2) / 2, (y1 + y2) / 2
+        for i, (img, (off_x, off_y)) in enumerate(zip(images, offsets)):
+            img_h, img_w = img.shape[:2]
+            if (off_x <= center_x < off_x + img_w
+                    and off_y <= center_y < off_y + img_h):
+                box = [min(max((y1 - off_y) / img_h, 0.), 1.),
+                       min(max((x1 - off_x) / img_w, 0.), 1.),
+                       min(max((y2 - off_y) / img_h, 0.), 1.),
+                       min(max((x2 - off_x) / img_w, 0.), 1.)]
+                new_entry = dict(entry)
+                new_entry['detection_box'] = box
+                ret[i].append(new_entry)
+                break
+    return ret
+
+
+def submit_face_crops(submit_fn, np_image, boxes, padding=0.5):
+    """
+    Run the model on padded crops around known faces instead of on the
+    whole image.
+
+    The crops are packed into one small mosaic image, which is submitted as
+    a single request. Detections are mapped back so that the result looks
+    exactly like the result for the whole image.
+
+    Args:
+        submit_fn: Function that takes an image as a numpy array and returns
+            a Future for the model's predictions, e.g.
+            BatchingGateway.submit
+        np_image: The full image
+        boxes: List of face boxes [x1, y1, x2, y2] in pixel coordinates of
+            np_image
+        padding: How much context to include around each face, as a
+            fraction of the box width and height on each side
+
+    Returns a Future whose result is the list of predictions, with each
+    'detection_box' normalized to np_image. Only detections whose center
+    lies within one of the original (unpadded) boxes are kept, so a face
+    that shows up in its neighbor's crop is not reported twice.
+    """
+    img_h, img_w = np_image.shape[:2]
+    crops = []
+    regions = []
+    for x1, y1, x2, y2 in boxes:
+        pad_x = (x2 - x1) * padding
+        pad_y = (y2 - y1) * padding
+        cx1 = int(max(x1 - pad_x, 0))
+        cy1 = int(max(y1 - pad_y, 0))
+        cx2 = int(min(x2 + pad_x, img_w))
+        cy2 = int(min(y2 + pad_y, img_h))
+        if cx2 <= cx1 or cy2 <= cy1:
+            continue
+        crops.append(np_image[cy1:cy2, cx1:cx2])
+        regions.append(((cx1, cy1), (x1, y1, x2, y2)))
+
+    result = Future()
+    result.set_running_or_notify_cancel()
+    if len(crops) == 0:
+        result.set_result([])
+        return result
+
+    mosaic, offsets = make_mosaic(crops)
+    inner = submit_fn(mosaic)
+
+    def on_done(inner):
+        try:
+            per_crop = split_mosaic_predictions(inner.result(), mosaic.shape,
+                                                crops, offsets)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        predictions = []
+        for crop, ((cx1, cy1), (x1, y1, x2, y2)), entries in zip(crops, regions, per_crop):
+            crop_h, crop_w = crop.shape[:2]
+            for entry in entries:
+                ny1, nx1, ny2, nx2 = entry['detection_box']
+                fy1, fy2 = cy1 + ny1 * crop_h, cy1 + ny2 * crop_h
+                fx1, fx2 = cx1 + nx1 * crop_w, cx1 + nx2 * crop_w
+                center_x, center_y = (fx1 + fx2) / 2, (fy1 + fy2) / 2
+                if not (x1 <= center_x <= x2 and y1 <= center_y <= y2):
+                    continue
+                new_entry = dict(entry)
+                new_entry['detection_box'] = [fy1 / img_h, fx1 / img_w,
+                                              fy2 / img_h, fx2 / img_w]
+                predictions.append(new_entry)
+        result.set_result(predictions)
+
+    inner.add_done_callback(on_done)
+    return result
@@ -0,0 +1,474 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Recording sessions to disk and replaying them through the pipeline.
+
+With JOURNAL_ENABLED, every session gets a journal: a directory of
+append-only segment files holding the encoded frames it received, with
+their arrival times, and the model's predictions for them. Recording only
+copies the data onto a queue; a background thread appends it to the current
+segment through a memory map, and starts a new segment when the current one
+is full.
+
+Replaying a journal runs its frames through app.gen() again, at the speed
+they were recorded or as fast as possible, and reports throughput and
+latency. By default the frames go to the configured model server, to
+benchmark the whole system:
+
+    python journal.py replay journal/20181018-101500-abc123 --speed 0
+
+With --recorded-predictions, the pipeline gets the predictions recorded in
+the journal instead, which makes the replay reproducible and measures the
+pipeline without the model server:
+
+    python journal.py replay journal/20181018-101500-abc123 --recorded-predictions
+
+List the contents of a journal with:
+
+    python journal.py dump journal/20181018-101500-abc123
+"""
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import Future
+
+from gevent.monkey import get_original
+from gevent.threadpool import ThreadPool
+
+# Kinds of records
+#   META: JSON object describing the session, at the start of each segment
+#   FRAME: Encoded frame as received from the browser
+#   RESULT: JSON object with the model's predictions for a frame
+META = 1
+FRAME = 2
+RESULT = 3
+
+# Start of every segment file
+SEGMENT_MAGIC = b'AGEJRNL1'
+
+# Record header: kind, payload length, timestamp, frame id (-1 if none).
+# Unused space in a segment is zero, so a kind of 0 marks the end of its
+# records.
+RECORD_HEADER = struct.Struct('<BIdq')
+
+SEGMENT_SUFFIX = '.seg'
+
+# The standard library's queue.SimpleQueue, which blocks the calling native
+# thread, even after gevent's monkey patching
+_NativeSimpleQueue = get_original('queue', 'SimpleQueue')
+
+# Once all frames are replayed, the session is closed after the pipeline has
+# sent nothing for REPLAY_IDLE_SEC, or after at most REPLAY_DRAIN_SEC.
+REPLAY_IDLE_SEC = 0.5
+REPLAY_DRAIN_SEC = 10.
+
+# A record read back from a journal.
+#   kind: META, FRAME or RESULT
+#   ts: For frames, the time they were received; for results, the time
+#       they were applied
+#   frame_id: Identifier the browser attached to the frame, or None
+#   payload: bytes
+Record = namedtuple('Record', ['kind', 'ts', 'frame_id', 'payload'])
+
+
+################################################################################
+# WRITING
+
+class Segment(object):
+    """One segment file of a journal, written through a memory map."""
+
+    def __init__(self, path, size_bytes):
+        self.path = path
+        self._file = open(path, 'w+b')
+        self._file.truncate(size_bytes)
+        self._map = mmap.mmap(self._file.fileno(), size_bytes)
+        self._map[:len(SEGMENT_MAGIC)] = SEGMENT_MAGIC
+        self.offset = len(SEGMENT_MAGIC)
+
+    @property
+    def size_bytes(self):
+        return len(self._map)
+
+    def fits(self, payload_len):
+        return self.offset + RECORD_HEADER.size + payload_len <= len(self._map)
+
+    def append(self, kind, ts, frame_id, payload):
+        start = self.offset + RECORD_HEADER.size
+        end = start + len(payload)
+        # Payload first, so that a record is only visible to readers once
+        # it is complete.
+        self._map[start:end] = payload
+        RECORD_HEADER.pack_into(self._map, self.offset, kind, len(payload), ts,
+                                -1 if frame_id is None else frame_id)
+        self.offset = end
+
+    def close(self):
+        """Flush the segment and trim the unused space off the file."""
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(self.offset)
+        self._file.close()
+
+
+class SessionJournal(object):
+    """
+    Journal of one session. The record_*() methods are called on the hot
+    path, and only copy their data onto the writer's queue.
+    """
+
+    def __init__(self, writer, path, meta, segment_bytes=64 * 1024 * 1024,
+                 max_segments=0):
+        """
+        Args:
+            writer: JournalWriter that writes the records
+            path: Directory for the segment files; created if needed
+            meta: JSON-serializable dict describing the session, written at
+                the start of every segment
+            segment_bytes: Size at which a new segment is started
+            max_segments: Number of segments kept; the oldest segment is
+                deleted when a new one would exceed it. 0 keeps them all.
+        """
+        self.writer = writer
+        self.path = path
+        self.meta = json.dumps(meta).encode()
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+
+        # Accessed only by the writer thread
+        self._segment = None
+        self._segment_no = 0
+        self._segment_paths = []
+        self.closed = False
+
+    def record_frame(self, frame_bytes, frame_id, received_ts):
+        self.writer.put(self, FRAME, received_ts, _int_or_none(frame_id), bytes(frame_bytes))
+
+    def record_result(self, frame_ts, predictions, num_crops=0):
+        """
+        Args:
+            frame_ts: Time the frame that the predictions are for was
+                received
+            predictions: The model's predictions
+            num_crops: Number of face crops the request was made of, or 0
+                if it covered the whole frame
+        """
+        payload = json.dumps({'frame_ts': frame_ts, 'num_crops': num_crops,
+                              'predictions': predictions}, default=float).encode()
+        self.writer.put(self, RESULT, time.time(), None, payload)
+
+    def close(self):
+        """Close the journal once the records queued so far are written."""
+        self.writer.put(self, None, 0., None, b'')
+
+    def _write(self, kind, ts, frame_id, payload):
+        """Append a record. Called by the writer thread."""
+        if kind is None:
+            self._close_segment()
+            self.closed = True
+            return
+        if self.closed:
+            return
+        if self._segment is None or not self._segment.fits(len(payload)):
+            self._start_segment(len(payload))
+        self._segment.append(kind, ts, frame_id, payload)
+
+    def _start_segment(self, payload_len):
+        self._close_segment()
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, '{:06d}{}'.format(self._segment_no, SEGMENT_SUFFIX))
+        self._segment_no += 1
+        # A record larger than a segment gets a segment of its own.
+        size = max(self.segment_bytes, len(SEGMENT_MAGIC) + 2 * RECORD_HEADER.size
+                   + len(self.meta) + payload_len)
+        self._segment = Segment(path, size)
+        self._segment.append(META, time.time(), None, self.meta)
+        self._segment_paths.append(path)
+        while 0 < self.max_segments < len(self._segment_paths):
+            os.remove(self._segment_paths.pop(0))
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+
+class JournalWriter(object):
+    """
+    Writes the records of all session journals in a process, on a native
+    thread, so that copying them into the segment files never holds up the
+    event loop. If the writer falls behind by more than max_queued records,
+    new records are dropped rather than slowing down the pipeline.
+    """
+
+    def __init__(self, max_queued=1000):
+        self.max_queued = max_queued
+
+        # Records waiting to be written, as (journal, kind, ts, frame_id,
+        # payload) tuples. Putting never blocks, so it is safe from the event
+        # loop, and the writer thread blocks on a native lock until there is
+        # a record, without touching any gevent-patched objects.
+        self._records = _NativeSimpleQueue()
+
+        # Number of records dropped because the writer fell behind
+        self.num_dropped = 0
+
+        self._pool = ThreadPool(1)
+        self._pool.spawn(self._run)
+
+    def put(self, journal, kind, ts, frame_id, payload):
+        # Closing a journal must not be lost, so it may exceed max_queued.
+        if kind is not None and self._records.qsize() >= self.max_queued:
+            self.num_dropped += 1
+            return
+        self._records.put((journal, kind, ts, frame_id, payload))
+
+    def _run(self):
+        while True:
+            journal, kind, ts, frame_id, payload = self._records.get()
+            try:
+                journal._write(kind, ts, frame_id, payload)
+            except OSError as e:
+                print("Journal {} failed, closing it: {}".format(journal.path, e))
+                journal._close_segment()
+                journal.closed = True
+
+
+def _int_or_none(frame_id):
+    try:
+        return int(frame_id)
+    except (TypeError, ValueError):
+        return None
+
+
+################################################################################
+# READING
+
+def segment_paths(path):
+    """Paths of the segment files of a journal directory, oldest first."""
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith(SEGMENT_SUFFIX)]
+
+
+def read_segment(path):
+    """Yields the records of a segment file."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(SEGMENT_MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                raise ValueError("{} is not a journal segment".format(path))
+            offset = len(SEGMENT_MAGIC)
+            while offset + RECORD_HEADER.size <= len(data):
+                kind, length, ts, frame_id = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                if kind == 0 or start + length > len(data):
+                    # End of the records, or a record cut short by a crash
+                    return
+                yield Record(kind, ts, None if frame_id < 0 else frame_id,
+                             data[start:start + length])
+                offset = start + length
+
+
+def read_journal(path):
+    """Yields the records of all segments of a journal directory, in the
+    order they were written."""
+    for segment in segment_paths(path):
+        for record in read_segment(segment):
+            yield record
+
+
+################################################################################
+# REPLAY
+
+def replay(path, speed=1.0, output_mode=None, recorded_predictions=False):
+    """
+    Run the frames of a journal through app.gen() again.
+
+    Args:
+        path: Journal directory
+        speed: Factor by which to speed up the recorded timing, or 0 to
+            send each frame as soon as the previous one is done
+        output_mode: 'video' or 'annotations', or None for the mode the
+            session was recorded in
+        recorded_predictions: Answer the pipeline's inference requests at
+            once with the predictions recorded in the journal, instead of
+            calling the model server. A frame gets the predictions recorded
+            for it, or else those of the closest earlier frame that has
+            some.
+
+    Returns a dict of statistics.
+    """
+    import app as webapp
+    from sessions import Session
+
+    meta = {}
+    frames = []
+    # Recorded predictions, by the time their frame was received
+    recorded = {}
+    for record in read_journal(path):
+        if record.kind == META and not meta:
+            meta = json.loads(record.payload.decode())
+        elif record.kind == FRAME:
+            frames.append(record)
+        elif record.kind == RESULT:
+            result = json.loads(record.payload.decode())
+            recorded[result['frame_ts']] = result['predictions']
+    if len(frames) == 0:
+        raise ValueError("No frames in {}".format(path))
+
+    session = Session('replay', output_mode or meta.get('output_mode', 'video'),
+                      mirror=meta.get('mirror', True))
+
+    # Index into frames of each frame put into the session, by the time it
+    # was put
+    frame_ixs = {}
+    if recorded_predictions:
+        # Indexes of the frames with recorded predictions, in order
+        result_ixs = [i for i, record in enumerate(frames) if record.ts in recorded]
+
+        def predictions_for(received_ts):
+            pos = bisect.bisect_right(result_ixs, frame_ixs[received_ts]) - 1
+            future = Future()
+            future.set_result([] if pos < 0 else recorded[frames[result_ixs[pos]].ts])
+            return future
+        session.predictions_for = predictions_for
+
+    pipeline = webapp.gen(session)
+    num_results = 0
+    last_result_ts = None
+    done = threading.Event()
+
+    def consume():
+        nonlocal num_results, last_result_ts
+        for _ in pipeline:
+            num_results += 1
+            last_result_ts = time.time()
+        done.set()
+
+    # The pipeline drops frames that it cannot decode without a result, so
+    # frames are fed from here and results counted by a separate greenlet,
+    # rather than waiting for one result per frame.
+    threading.Thread(target=consume, daemon=True).start()
+    start = time.time()
+    first_ts = frames[0].ts
+    for i, record in enumerate(frames):
+        if speed > 0:
+            time.sleep(max(start + (record.ts - first_ts) / speed - time.time(), 0.))
+        else:
+            # Send the next frame as soon as the pipeline has taken the
+            # previous one.
+            _wait_until(lambda: session.frames_waiting() == 0 or done.is_set())
+        received_ts = time.time()
+        frame_ixs[received_ts] = i
+        session.put_frame(record.payload, record.frame_id, received_ts)
+
+    # The journal is exhausted: let the pipeline take the last frame and
+    # finish it, then end the session.
+    _wait_until(lambda: session.frames_waiting() == 0 or done.is_set(), REPLAY_DRAIN_SEC)
+    last_put_ts = time.time()
+    _wait_until(lambda: time.time() - max(last_result_ts or 0., last_put_ts) > REPLAY_IDLE_SEC
+                or done.is_set(), REPLAY_DRAIN_SEC)
+    session.close()
+    done.wait(REPLAY_DRAIN_SEC)
+    pipeline.close()
+    elapsed = (last_result_ts or time.time()) - start
+
+    latency = webapp.app.frame_latency
+    return {
+        'frames': len(frames),
+        'results': num_results,
+        'recorded_seconds': frames[-1].ts - frames[0].ts,
+        'replay_seconds': elapsed,
+        'fps': num_results / elapsed,
+        'latency_ms': [None if latency.quantile(q) is None else latency.quantile(q) * 1000
+                       for q in (0.5, 0.95, 0.99)],
+        'recorded_results': len(recorded),
+    }
+
+
+def _wait_until(condition, timeout=None, poll_interval_sec=0.001):
+    """Sleep until condition() is true or timeout seconds have passed."""
+    deadline = None if timeout is None else time.time() + timeout
+    while not condition():
+        if deadline is not None and time.time() >= deadline:
+            return
+        time.sleep(poll_interval_sec)
+
+
+################################################################################
+# MAIN
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    dump_parser = subparsers.add_parser('dump', help='List the records of a journal')
+    dump_parser.add_argument('path', help='Journal directory')
+    replay_parser = subparsers.add_parser('replay', help='Run a journal through the pipeline')
+    replay_parser.add_argument('path', help='Journal directory')
+    replay_parser.add_argument('--speed', type=float, default=1.,
+                               help='Speed-up over the recorded timing; 0 replays as '
+                                    'fast as possible')
+    replay_parser.add_argument('--output-mode', choices=('video', 'annotations'),
+                               help='Output mode to replay in, instead of the recorded one')
+    replay_parser.add_argument('--recorded-predictions', action='store_true',
+                               help='Use the predictions recorded in the journal instead '
+                                    'of calling the model server')
+    replay_parser.add_argument('--ml-endpoint',
+                               help='Base URL of the MAX Facial Age Estimator model server; '
+                                    'comma-separated for several replicas')
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        names = {META: 'meta', FRAME: 'frame', RESULT: 'result'}
+        for record in read_journal(args.path):
+            if record.kind == FRAME:
+                details = '{} bytes'.format(len(record.payload))
+            else:
+                details = record.payload.decode()
+            print("{:.3f} {:6} {:>8} {}".format(
+                record.ts, names.get(record.kind, record.kind),
+                '' if record.frame_id is None else record.frame_id, details))
+        return 0
+    if args.command == 'replay':
+        import app as webapp
+        if args.ml_endpoint:
+            webapp.app.config['ML_ENDPOINTS'] = args.ml_endpoint.split(',')
+            webapp.init_inference()
+        stats = replay(args.path, args.speed, args.output_mode, args.recorded_predictions)
+        print("Replayed {frames} frames ({recorded_seconds:.1f} s recorded) in "
+              "{replay_seconds:.1f} s: {results} results, {fps:.1f} fps".format(**stats))
+        if stats['latency_ms'][0] is not None:
+            print("End-to-end latency p50/p95/p99: {:.1f} / {:.1f} / {:.1f} ms".format(
+                *stats['latency_ms']))
+        print("Inference results in the journal: {}".format(stats['recorded_results']))
+        return 0
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
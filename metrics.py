@@ -0,0 +1,278 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Minimal in-process metrics (counters, gauges and histograms) rendered in the
+Prometheus text exposition format.
+
+Recording a value costs a lock and a few list operations, so it is cheap
+enough to do several times per frame.
+"""
+
+import bisect
+import threading
+import time
+
+# Default histogram buckets for latencies, in seconds
+LATENCY_BUCKETS_SEC = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def exponential_buckets(start, factor, count):
+    """Histogram buckets start, start * factor, start * factor^2, ..."""
+    return tuple(start * factor ** i for i in range(count))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    """
+    Base class for a metric family: one metric name with a child per
+    combination of label values.
+    """
+
+    type_name = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """Returns the child metric for the given label values."""
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.label_names):
+            raise ValueError("Expected labels {}".format(self.label_names))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        if len(self.label_names) == 0:
+            # Unlabeled metrics are exported even before their first update.
+            self._default()
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} {}'.format(self.name, self.type_name)]
+        for key, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, key))
+        return lines
+
+
+class _Value(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, label_names, key):
+        return ['{}{} {}'.format(name, _format_labels(label_names, key),
+                                 _format_value(self.value))]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of frames received."""
+
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down, e.g. requests in flight. If value_fn is
+    given, the value is read from value_fn() at render time instead: a
+    number for a gauge without labels, or a dict from tuples of label values
+    to numbers for a gauge with labels.
+    """
+
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), value_fn=None):
+        super(Gauge, self).__init__(name, help_text, label_names)
+        self.value_fn = value_fn
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def render(self):
+        if self.value_fn is not None and len(self.label_names) == 0:
+            self.set(self.value_fn())
+        elif self.value_fn is not None:
+            values = self.value_fn()
+            with self._lock:
+                self._children = {}
+            for key, value in values.items():
+                self.labels(*key).set(value)
+        return super(Gauge, self).render()
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        ix = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[ix] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager that observes the time spent in its body."""
+        return _Timer(self)
+
+    def quantile(self, q):
+        """
+        Estimate the q-quantile (0 <= q <= 1) of the observed values by
+        linear interpolation within the bucket it falls in, as Prometheus'
+        histogram_quantile() does. Returns None if nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.
+        for bound, count in zip(self.buckets, self.counts):
+            if count > 0 and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        # Beyond the last bucket
+        return self.buckets[-1]
+
+    def render(self, name, label_names, key):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(label_names, key, [('le', _format_value(bound))]),
+                cumulative))
+        labels = _format_labels(label_names, key)
+        lines.append('{}_sum{} {}'.format(name, labels, _format_value(self.sum)))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    """Distribution of values, e.g. latencies, counted in fixed buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=LATENCY_BUCKETS_SEC):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def quantile(self, q):
+        return self._default().quantile(q)
+
+
+class MetricsRegistry(object):
+    """The set of metrics exported by the app."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=(), value_fn=None):
+        return self.add(Gauge(name, help_text, label_names, value_fn))
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=LATENCY_BUCKETS_SEC):
+        return self.add(Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
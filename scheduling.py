@@ -0,0 +1,350 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+
+
+class RequestBudget(object):
+    """
+    Token bucket limiting the rate of requests to the model server across
+    all sessions.
+
+    A fraction of the bucket is held in reserve for urgent requests, so that
+    sessions that are backing off cannot starve sessions that have just lost
+    track of a face.
+    """
+
+    def __init__(self, requests_per_sec, burst=None, urgent_reserve=0.25):
+        """
+        Args:
+            requests_per_sec: Sustained request rate. 0 means unlimited.
+            burst: Capacity of the bucket; defaults to one second's worth of
+                requests
+            urgent_reserve: Fraction of the bucket that only urgent requests
+                may use
+        """
+        self.requests_per_sec = requests_per_sec
+        self.capacity = burst if burst is not None else max(requests_per_sec, 1)
+        self.urgent_reserve = urgent_reserve
+        self._tokens = float(self.capacity)
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, urgent=False):
+        """
+        Take one request's worth of budget.
+
+        Returns True if the request may be sent.
+        """
+        if self.requests_per_sec <= 0:
+            return True
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens
+                               + (now - self._last_refill) * self.requests_per_sec)
+            self._last_refill = now
+            floor = 0. if urgent else self.capacity * self.urgent_reserve
+            if self._tokens - 1. < floor:
+                return False
+            self._tokens -= 1.
+            return True
+
+
+class InferenceScheduler(object):
+    """
+    Decides, frame by frame, when a session should send its next inference
+    request.
+
+    Requests are urgent when tracking has failed, when the scene changed
+    while no faces were known, or when the age labels have become too stale;
+    urgent requests go out as soon as the pipeline and the global budget
+    allow. Otherwise requests are only sent while the scene is changing, at
+    an interval derived from the backend latency that grows while the age
+    estimates are stable and shrinks again once they start to move.
+    """
+
+    def __init__(self, budget, max_inflight=1, max_staleness_sec=5.0,
+                 latency_decay=0.2, stable_age_delta=1.0, max_backoff=8.0,
+                 clock=time.time):
+        """
+        Args:
+            budget: RequestBudget shared by all sessions
+            max_inflight: Maximum number of requests in flight for the
+                session
+            max_staleness_sec: Labels are refreshed at least this often
+            latency_decay: Weight of a new sample in the exponentially
+                decaying average of the backend latency
+            stable_age_delta: Mean change in age, in years, below which the
+                age estimates count as stable
+            max_backoff: Maximum factor by which the request interval grows
+                while the ages are stable
+            clock: Function that returns the current time in seconds. The
+                latencies passed to record_result() must be measured with
+                the same clock.
+        """
+        self.budget = budget
+        self.max_inflight = max_inflight
+        self.max_staleness_sec = max_staleness_sec
+        self.latency_decay = latency_decay
+        self.stable_age_delta = stable_age_delta
+        self.max_backoff = max_backoff
+        self.clock = clock
+
+        # Exponentially decaying average of the backend latency, or None
+        # before the first result
+        self.latency_ewma_sec = None
+
+        # Multiplier on the base request interval
+        self.backoff = 1.0
+
+        # Long ago, whatever the clock
+        self.last_dispatch_ts = float('-inf')
+        self.last_result_ts = float('-inf')
+
+    def interval_sec(self):
+        """Minimum time between non-urgent requests."""
+        if self.latency_ewma_sec is None:
+            return 0.
+        # Spread the requests evenly over one round trip, so that a full
+        # pipeline delivers a fresh result every latency / max_inflight.
+        base = self.latency_ewma_sec / self.max_inflight
+        return min(base * self.backoff, self.max_staleness_sec)
+
+    def should_dispatch(self, num_pending, num_faces, tracking_ok,
+                        scene_changed):
+        """
+        Args:
+            num_pending: Number of requests currently in flight
+            num_faces: Number of faces currently being tracked
+            tracking_ok: False if the tracker lost a face on the last frame
+            scene_changed: True if the frame differs materially from the
+                one of the last request
+
+        Returns True if a request should be sent for the current frame. The
+        caller must then call dispatched().
+        """
+        if num_pending >= self.max_inflight:
+            return False
+        now = self.clock()
+        urgent = (not tracking_ok
+                  or (scene_changed and num_faces == 0)
+                  or now - self.last_result_ts > self.max_staleness_sec)
+        if not urgent:
+            if not scene_changed:
+                return False
+            if now - self.last_dispatch_ts < self.interval_sec():
+                return False
+        if urgent:
+            self.backoff = 1.0
+        return self.budget.try_acquire(urgent)
+
+    def dispatched(self):
+        self.last_dispatch_ts = self.clock()
+
+    def record_result(self, latency_sec, mean_age_delta=None):
+        """
+        Update the schedule with a result that just came back.
+
+        Args:
+            latency_sec: Time between submitting the request and receiving
+                the result
+            mean_age_delta: Mean absolute difference between the new and the
+                previous age estimates of the faces matched between the two
+                results, or None if no faces were matched
+        """
+        self.last_result_ts = self.clock()
+        if self.latency_ewma_sec is None:
+            self.latency_ewma_sec = latency_sec
+        else:
+            self.latency_ewma_sec = (latency_sec * self.latency_decay
+                                     + self.latency_ewma_sec * (1.0 - self.latency_decay))
+        if mean_age_delta is None:
+            self.backoff = 1.0
+        elif mean_age_delta < self.stable_age_delta:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        else:
+            self.backoff = max(self.backoff / 2, 1.0)
+
+
+class OutputController(object):
+    """
+    Adapts the annotated video streamed to one browser to how fast the
+    browser takes it.
+
+    The latency of a frame runs from receiving it to handing its JPEG to the
+    network, and includes the time that /video_feed spends blocked writing
+    it to a browser on a slow link. Frames that would reach the browser late
+    while a newer frame is waiting are skipped rather than added to the
+    backlog. While the average latency is above the target, frames are
+    being skipped, or the stream spends most of its time blocked on the
+    browser's connection (so that the link, not the pipeline, limits the
+    frame rate), the width and JPEG quality of the frames are stepped down,
+    one at a time and keeping them at about the same fraction of their
+    range. While the latency stays well below the target and the link is
+    mostly idle, they are stepped back up.
+    """
+
+    def __init__(self, max_width_px=1024, min_width_px=320, max_quality=85,
+                 min_quality=40, target_latency_sec=0.25, adapt_interval_sec=1.0,
+                 width_step=0.8, quality_step=10, max_busy=0.5, decay=0.2):
+        """
+        Args:
+            max_width_px, min_width_px: Bounds of the frame width
+            max_quality, min_quality: Bounds of the JPEG quality
+            target_latency_sec: Latency to hold
+            adapt_interval_sec: Minimum time between changes of the
+                settings, so that the effect of one change can show before
+                the next
+            width_step: Factor by which each step down shrinks the width
+            quality_step: Amount by which each step changes the quality
+            max_busy: Fraction of the time between frames that sending a
+                frame may take before the settings are stepped down. They
+                are only stepped up while it takes less than half of that.
+            decay: Weight of a new sample in the exponentially decaying
+                averages
+        """
+        self.max_width_px = max_width_px
+        self.min_width_px = min(min_width_px, max_width_px)
+        self.max_quality = max_quality
+        self.min_quality = min(min_quality, max_quality)
+        self.target_latency_sec = target_latency_sec
+        self.adapt_interval_sec = adapt_interval_sec
+        self.width_step = width_step
+        self.quality_step = quality_step
+        self.max_busy = max_busy
+        self.decay = decay
+
+        # Current settings
+        self.width_px = max_width_px
+        self.quality = max_quality
+
+        # Exponentially decaying averages of the latency, the size of the
+        # frames sent, the rate in bytes per second at which the browser
+        # takes them, and the fraction of the time spent sending; None before
+        # the first frame
+        self.latency_ewma_sec = None
+        self.frame_bytes_ewma = None
+        self.drain_bytes_per_sec = None
+        self.busy_ewma = None
+        self._last_sent_ts = None
+
+        # Frames skipped since the settings last changed
+        self.num_skipped = 0
+
+        self.last_change_ts = time.time()
+
+    def record_sent(self, num_bytes, send_sec, latency_sec):
+        """
+        Update the settings with a frame that was just sent.
+
+        Args:
+            num_bytes: Size of the frame
+            send_sec: Time it took to hand the frame to the network
+            latency_sec: Time from receiving the frame to having sent it
+        """
+        self.latency_ewma_sec = self._average(self.latency_ewma_sec, latency_sec)
+        self.frame_bytes_ewma = self._average(self.frame_bytes_ewma, num_bytes)
+        # Writes that return at once only fill the socket buffer, and say
+        # little about the link; cap the rate they imply.
+        self.drain_bytes_per_sec = self._average(self.drain_bytes_per_sec,
+                                                 num_bytes / max(send_sec, 1e-3))
+        now = time.time()
+        if self._last_sent_ts is not None:
+            self.busy_ewma = self._average(
+                self.busy_ewma, min(send_sec / max(now - self._last_sent_ts, 1e-3), 1.))
+        self._last_sent_ts = now
+
+        if now - self.last_change_ts < self.adapt_interval_sec or self.busy_ewma is None:
+            return
+        if (self.latency_ewma_sec > self.target_latency_sec or self.num_skipped > 0
+                or self.busy_ewma > self.max_busy):
+            changed = self._step_down()
+        elif (self.latency_ewma_sec < self.target_latency_sec / 2
+              and self.busy_ewma < self.max_busy / 2):
+            changed = self._step_up()
+        else:
+            changed = False
+        if changed:
+            self.last_change_ts = now
+            self.num_skipped = 0
+
+    def record_skipped(self):
+        """Count a frame that was skipped because is_stale() said so."""
+        self.num_skipped += 1
+
+    def expected_send_sec(self):
+        """Time that sending the next frame is expected to take."""
+        if self.drain_bytes_per_sec is None:
+            return 0.
+        return self.frame_bytes_ewma / self.drain_bytes_per_sec
+
+    def is_stale(self, age_sec, newer_waiting):
+        """
+        Args:
+            age_sec: Time since the frame was received
+            newer_waiting: True if a newer frame is already waiting to be
+                processed
+
+        Returns True if the frame should be skipped.
+        """
+        return newer_waiting and age_sec + self.expected_send_sec() > self.target_latency_sec
+
+    def _average(self, average, value):
+        if average is None:
+            return float(value)
+        return value * self.decay + average * (1.0 - self.decay)
+
+    def _fractions(self):
+        """Positions of the width and quality within their ranges, from 0 at
+        the lower bound to 1 at the upper bound."""
+        width_range = self.max_width_px - self.min_width_px
+        quality_range = self.max_quality - self.min_quality
+        width = (self.width_px - self.min_width_px) / width_range if width_range > 0 else 0.
+        quality = (self.quality - self.min_quality) / quality_range if quality_range > 0 else 0.
+        return width, quality
+
+    def _step_down(self):
+        width, quality = self._fractions()
+        # Lowering the quality costs less, so it goes first on a tie.
+        if quality >= width and self.quality > self.min_quality:
+            self.quality = max(self.quality - self.quality_step, self.min_quality)
+        elif self.width_px > self.min_width_px:
+            self.width_px = max(_round_width(self.width_px * self.width_step),
+                                self.min_width_px)
+        else:
+            return False
+        return True
+
+    def _step_up(self):
+        width, quality = self._fractions()
+        if width <= quality and self.width_px < self.max_width_px:
+            self.width_px = min(_round_width(self.width_px / self.width_step),
+                                self.max_width_px)
+        elif self.quality < self.max_quality:
+            self.quality = min(self.quality + self.quality_step, self.max_quality)
+        elif self.width_px < self.max_width_px:
+            self.width_px = min(_round_width(self.width_px / self.width_step),
+                                self.max_width_px)
+        else:
+            return False
+        return True
+
+
+def _round_width(width_px):
+    """Round a frame width to a multiple of 8 pixels, which JPEG encodes
+    without padding."""
+    return max(int(round(width_px / 8.)) * 8, 8)
@@ -0,0 +1,296 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+
+
+class Session(object):
+    """
+    Per-browser state: the most recent frame received from the browser and
+    the bookkeeping needed to evict the session once it goes idle.
+
+    Each session is fed by the 'streamingvideo' Socket.IO handler and drained
+    by exactly one gen() loop, so clients never steal each other's frames.
+    """
+
+    def __init__(self, sid, output_mode='video', mirror=True, credits=0,
+                 on_credit=None):
+        self.sid = sid
+
+        # Whether frames are mirrored before processing, so that the video
+        # looks like a mirror image of the user. Off for recorded footage.
+        self.mirror = mirror
+
+        # How results go back to the browser: 'video' streams annotated JPEG
+        # frames over /video_feed, 'annotations' sends just the boxes and
+        # ages over Socket.IO and lets the browser draw them.
+        self.output_mode = output_mode
+
+        # Flow control: the browser may send at most this many frames that
+        # the processing loop has not dequeued yet, and gets a credit back for
+        # each frame dequeued. 0 turns flow control off, and the browser may
+        # send frames as fast as it likes.
+        self.credits = credits
+
+        # Number of frames the browser may still send. Guarded by
+        # condition_var.
+        self.credits_available = credits
+
+        # Called as on_credit(session, num_credits) whenever the browser gets
+        # credits back, to pass them on to it
+        self.on_credit = on_credit
+
+        # Exponentially decaying average of the number of frames dequeued per
+        # second, reported back to the browser. Guarded by condition_var.
+        self.processing_fps = 0.
+        self._last_dequeue_ts = None
+
+        # Condition variable for passing incoming frames to the video
+        # processing loop of this session.
+        self.condition_var = threading.Condition()
+
+        # List of up to max(credits, 1) unprocessed frames, oldest first.
+        # Each entry holds a video frame, its client-assigned frame id, if
+        # available, and the time it was received. Guarded by condition_var.
+        self.latest_frame_list = []
+
+        # Adapts the annotated video to how fast the browser takes it (a
+        # scheduling.OutputController), once /video_feed has started; None
+        # for a fixed size and quality.
+        self.output = None
+
+        # Records the session's frames and inference results (a
+        # journal.SessionJournal), if enabled; None otherwise
+        self.journal = None
+
+        # Stands in for the model server, if set: called as
+        # predictions_for(received_ts) for a frame that would be sent to the
+        # model, and returns a Future for the predictions. Used to replay a
+        # journal with the predictions it recorded; None otherwise.
+        self.predictions_for = None
+
+        # Returns the current time in seconds, for deciding when to ask the
+        # model again (see InferenceScheduler and SceneChangeDetector).
+        # Batch processing replaces it with the time of the current frame in
+        # the video, so that its results do not depend on how fast the
+        # machine is.
+        self.clock = time.time
+
+        # If set, the result of each inference request is applied once this
+        # many seconds have passed by clock since the request, waiting for
+        # the model server if need be, rather than as soon as it arrives.
+        # Trackers then also catch up without a time budget. Batch
+        # processing sets this along with clock.
+        self.result_delay_sec = None
+
+        # Time that the browser last sent us something. Used for eviction.
+        self.last_active = time.time()
+
+        # Set once the session has been removed from the registry; tells the
+        # gen() loop to shut down.
+        self.closed = False
+
+    def take_credit(self):
+        """
+        Use up one of the browser's credits for an incoming frame.
+
+        Returns False if the browser has no credits left and the frame
+        should be dropped. Always True without flow control.
+        """
+        with self.condition_var:
+            if self.credits <= 0:
+                return True
+            if self.credits_available <= 0:
+                return False
+            self.credits_available -= 1
+            return True
+
+    def return_credit(self, num_credits=1, processing_fps=None):
+        """
+        Give the browser back credits for frames that have left the queue,
+        and pass them on through on_credit.
+
+        Args:
+            num_credits: Number of credits to give back
+            processing_fps: Frames per second that the session is being
+                processed at, if it is measured elsewhere (e.g. in a worker
+                process)
+        """
+        with self.condition_var:
+            if self.credits <= 0:
+                return
+            num_credits = min(num_credits, self.credits - self.credits_available)
+            self.credits_available += num_credits
+            if processing_fps is not None:
+                self.processing_fps = processing_fps
+        if num_credits > 0 and self.on_credit is not None:
+            self.on_credit(self, num_credits)
+
+    def restore_credits(self):
+        """Give the browser back all of its credits, e.g. after the frames it
+        had sent were lost."""
+        self.return_credit(self.credits)
+
+    def touch(self):
+        """Mark the session as active, to keep it from being evicted."""
+        self.last_active = time.time()
+
+    def put_frame(self, frame, frame_id=None, received_ts=None):
+        """
+        Queue a new frame and wake up the processing loop. If the queue is
+        full (which, with flow control, only happens if the browser ignores
+        its credits), the oldest unprocessed frame is dropped.
+
+        Args:
+            frame: Encoded frame as received from the browser, or an
+                already decoded RGB image (see app.decode_frame())
+            frame_id: Identifier the browser attached to the frame, if any
+            received_ts: Time the frame was received, if not now
+
+        Returns True if an unprocessed frame was dropped to make room.
+        """
+        with self.condition_var:
+            # Without flow control only the most recent frame is kept, so a
+            # slow pipeline always works on the freshest frame.
+            dropped = len(self.latest_frame_list) >= max(self.credits, 1)
+            if dropped:
+                del self.latest_frame_list[0]
+            self.touch()
+            self.latest_frame_list.append(
+                (frame, frame_id, self.last_active if received_ts is None else received_ts))
+            self.condition_var.notify()
+            return dropped
+
+    def frames_waiting(self):
+        """Number of frames received that the processing loop has not
+        dequeued yet."""
+        with self.condition_var:
+            return len(self.latest_frame_list)
+
+    def get_frame(self, timeout=None):
+        """
+        Block until a frame is available.
+
+        Args:
+            timeout: Maximum number of seconds to wait, or None to wait
+                until a frame arrives or the session is closed.
+
+        Returns the oldest unprocessed (frame, frame_id, received_ts) tuple,
+        or None if the session was closed or the timeout expired. With flow
+        control, dequeuing the frame gives the browser a credit back.
+        """
+        with self.condition_var:
+            deadline = None if timeout is None else time.time() + timeout
+            while len(self.latest_frame_list) == 0 and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition_var.wait(remaining)
+            if self.closed:
+                return None
+            now = time.time()
+            if self._last_dequeue_ts is not None:
+                fps = 1.0 / max(now - self._last_dequeue_ts, 1e-3)
+                self.processing_fps += 0.1 * (fps - self.processing_fps)
+            self._last_dequeue_ts = now
+            next_frame = self.latest_frame_list.pop(0)
+        self.return_credit()
+        return next_frame
+
+    def close(self):
+        """Mark the session as finished and wake up its processing loop."""
+        with self.condition_var:
+            self.closed = True
+            self.latest_frame_list.clear()
+            self.condition_var.notify_all()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def idle_time(self):
+        return time.time() - self.last_active
+
+
+class SessionRegistry(object):
+    """
+    Thread-safe map from Socket.IO session id to Session.
+    """
+
+    def __init__(self, max_sessions, idle_timeout_sec):
+        """
+        Args:
+            max_sessions: Maximum number of sessions served at once. New
+                sessions beyond this limit are refused.
+            idle_timeout_sec: Sessions that have not sent a frame for this
+                many seconds are evicted.
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout_sec = idle_timeout_sec
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, sid):
+        with self._lock:
+            return self._sessions.get(sid)
+
+    def all(self):
+        """Returns a list of the current sessions."""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def create(self, sid, output_mode='video', credits=0, on_credit=None):
+        """
+        Register a new session, evicting idle sessions first if we are at
+        capacity.
+
+        Returns the new Session, or None if the server is full.
+        """
+        self.evict_idle()
+        with self._lock:
+            if sid in self._sessions:
+                return self._sessions[sid]
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = Session(sid, output_mode, credits=credits, on_credit=on_credit)
+            self._sessions[sid] = session
+            return session
+
+    def remove(self, sid):
+        with self._lock:
+            session = self._sessions.pop(sid, None)
+        if session is not None:
+            session.close()
+        return session
+
+    def evict_idle(self):
+        """
+        Close and remove every session that has been idle for longer than
+        idle_timeout_sec.
+
+        Returns the list of evicted session ids.
+        """
+        with self._lock:
+            stale = [sid for sid, s in self._sessions.items()
+                     if s.idle_time() > self.idle_timeout_sec]
+            evicted = [self._sessions.pop(sid) for sid in stale]
+        for session in evicted:
+            session.close()
+        return stale
@@ -0,0 +1,167 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Running the CPU-bound stages of the frame pipeline off the gevent event loop.
+
+The web server runs every session's pipeline in a greenlet. A greenlet that
+decodes, tracks or encodes a frame holds the event loop for as long as that
+takes, so socket events and the other sessions' streams stall. StagePool
+runs such stages on real (native) threads instead: the calling greenlet
+waits for the result while the event loop keeps serving everything else,
+and OpenCV and numpy calls, which release the GIL, run in parallel across
+sessions. Prefetch hands items from one greenlet to another through a
+bounded queue, so that a stage can work on the next frame while the rest of
+the pipeline is busy with the current one.
+
+Stages run on the pool must not touch gevent-patched objects such as locks,
+queues or sockets, since those belong to the event loop's thread.
+"""
+
+import time
+
+import gevent
+from gevent.queue import Channel, Queue
+from gevent.threadpool import ThreadPool
+
+
+class StagePool(object):
+    """
+    Native thread pool for the CPU-bound stages of the frame pipeline,
+    shared by all sessions.
+    """
+
+    def __init__(self, num_threads, stage_latency=None):
+        """
+        Args:
+            num_threads: Number of native threads. 0 runs every stage
+                directly in the calling greenlet, as if there were no pool.
+            stage_latency: Optional histogram with a 'stage' label, in which
+                the time each stage spends running (not waiting for a
+                thread) is recorded
+        """
+        self.num_threads = num_threads
+        self.stage_latency = stage_latency
+        self._pool = ThreadPool(num_threads) if num_threads > 0 else None
+
+    def run(self, stage, fn, *args):
+        """
+        Run fn(*args) on a native thread and wait for it, letting other
+        greenlets run in the meantime.
+
+        Args:
+            stage: Name of the stage, for the latency histogram
+            fn: Function to run. It must not touch gevent-patched objects.
+
+        Returns the result of fn, or raises its exception.
+        """
+        if self._pool is None:
+            result, error, elapsed_sec = _timed(fn, args)
+        else:
+            result, error, elapsed_sec = self._pool.apply(_timed, (fn, args))
+        # Histograms take a lock, so record on the event loop's thread.
+        if self.stage_latency is not None:
+            self.stage_latency.labels(stage).observe(elapsed_sec)
+        if error is not None:
+            raise error
+        return result
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.kill()
+
+
+def _timed(fn, args):
+    """
+    Returns (result, exception, elapsed seconds) of fn(*args). Exceptions
+    are returned rather than raised, because gevent prints a traceback for
+    every exception raised on a pool thread, even one the caller handles.
+    """
+    start = time.perf_counter()
+    try:
+        return fn(*args), None, time.perf_counter() - start
+    except Exception as e:
+        return None, e, time.perf_counter() - start
+
+
+class Prefetch(object):
+    """
+    Iterates over an iterable in a separate greenlet, so that the next item
+    is produced while the consumer works on the current one.
+
+    Items are handed over through a queue of maxsize items. The producer
+    blocks while the queue is full, so a slow consumer holds it back instead
+    of letting items pile up: it gets at most maxsize + 1 items ahead. With
+    maxsize 0, each item is handed over directly.
+    """
+
+    _DONE = object()
+
+    def __init__(self, iterable, maxsize=0):
+        self._queue = Channel() if maxsize == 0 else Queue(maxsize)
+        # Items produced and not consumed yet
+        self._num_ahead = 0
+        self._done = False
+        self._greenlet = gevent.spawn(self._produce, iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        item = self._queue.get()
+        if item is self._DONE:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            raise item.exception
+        self._num_ahead -= 1
+        return item
+
+    def __len__(self):
+        """Number of items produced but not consumed yet."""
+        return self._num_ahead
+
+    def close(self):
+        """Stop the producer."""
+        try:
+            if not self._greenlet.dead:
+                self._greenlet.kill(block=False)
+        except RuntimeError:
+            # Closed by garbage collection or at interpreter exit, while
+            # gevent is being torn down. The producer dies with it.
+            pass
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                self._num_ahead += 1
+                self._queue.put(item)
+        except gevent.GreenletExit:
+            # Closed by the consumer
+            return
+        except Exception as e:
+            self._queue.put(_Failure(e))
+        self._queue.put(self._DONE)
+
+
+class _Failure(object):
+    """Exception raised by the producer of a Prefetch, passed on to the
+    consumer."""
+
+    def __init__(self, exception):
+        self.exception = exception
@@ -34,6 +34,10 @@
   const _TARGET_FPS = 15
   const _FRAME_INTERVAL_MSEC = 1000.0 / _TARGET_FPS
 
+  // If the server hasn't sent a credit for this long, assume one got lost
+  // and send a frame anyway.
+  const _CREDIT_TIMEOUT_MSEC = 2000
+
   // Parameters of the PID controller for frame rate
   const _DECAY_FACTOR = 0.9
   const _P = 0.6
@@ -65,12 +69,33 @@
   var integralError = 0.0    // Exponential moving average
   var prevError = 0.0
 
-  // Callback that sends video frames to backend
+  // Callback that sends video frames to backend, and the timer that calls it
+  var sendVideoFrame = null;
   var sendFrameCB = null;
 
+  // Sequence number of the next frame sent to the backend
+  var nextFrameId = 0;
+
+  // Number of frames the server lets us send before it has started on the
+  // ones we already sent. The server hands out a credit for every frame it
+  // picks up. Infinity if the server doesn't do flow control.
+  var credits = Infinity;
+
+  // Time that we ran out of credits, or -1 if we have some
+  var waitingForCreditSinceMsec = -1;
+
+  // Canvas on which boxes are drawn in "annotations" output mode
+  var overlay = document.getElementById('overlay');
+
+  // Load the page with ?output=annotations to have the server send only boxes
+  // and ages instead of annotated video.
+  var outputMatch = /[?&]output=(\w+)/.exec(location.search);
+  var connectOptions = outputMatch ? { query: 'output=' + outputMatch[1] } : {};
+
   namespace = '/streaming';
   // console.log('http://' + document.domain + ':' + location.port + namespace);
-  var socket = io.connect('http://' + document.domain + ':' + location.port + namespace);
+  var socket = io.connect('http://' + document.domain + ':' + location.port + namespace,
+    connectOptions);
 
   ////////////////////////////////////////////////////////////////////////////////
   // Subroutines
@@ -104,6 +129,40 @@
     return Math.max(0.0, targetDelay);
   }
 
+  /**
+   * Color of a bounding box, fading from red to yellow as the age estimate
+   * gets stale. Mirrors box_color() in app.py.
+   */
+  function boxColor(framesSinceUpdate) {
+    var DECAY_TIME_FRAMES = 10;
+    var coldWeight = Math.min(framesSinceUpdate / DECAY_TIME_FRAMES, 1.0);
+    return 'rgb(255,' + Math.round(255 * coldWeight) + ',0)';
+  }
+
+  /** Draw the boxes and ages of an "annotations" message on the overlay. */
+  function drawAnnotations(msg) {
+    var ctx = overlay.getContext('2d');
+    var scale = overlay.width / msg.width;
+    ctx.clearRect(0, 0, overlay.width, overlay.height);
+    ctx.lineWidth = 2;
+    ctx.font = '24px sans-serif';
+    ctx.textBaseline = 'bottom';
+    for (var i = 0; i < msg.boxes.length && i < msg.ages.length; i++) {
+      var x1 = msg.boxes[i][0] * scale, y1 = msg.boxes[i][1] * scale;
+      var x2 = msg.boxes[i][2] * scale, y2 = msg.boxes[i][3] * scale;
+      ctx.strokeStyle = boxColor(msg.staleness);
+      ctx.strokeRect(x1, y1, x2 - x1, y2 - y1);
+
+      // Box coordinates are relative to the mirrored image, which is what the
+      // (CSS-mirrored) video shows, so the overlay itself is not mirrored.
+      var label = String(msg.ages[i]);
+      ctx.fillStyle = 'rgb(255,0,0)';
+      ctx.fillRect(x1, y1 - 24, ctx.measureText(label).width, 24);
+      ctx.fillStyle = 'rgb(255,255,255)';
+      ctx.fillText(label, x1, y1);
+    }
+  }
+
   ////////////////////////////////////////////////////////////////////////////////
   // Event handlers
 
@@ -111,6 +170,36 @@
       socket.emit('netin', { data: 'Connected!' });
     });
 
+  // The server assigns each Socket.IO connection its own processing pipeline;
+  // point the video feed at ours, or show our own video with an overlay if
+  // the server only sends annotations.
+  socket.on('session', function (msg) {
+      credits = msg.credits > 0 ? msg.credits : Infinity;
+      if (msg.output_mode === 'annotations') {
+        $("#video_feed").addClass("hide");
+        $("video").removeClass("hide");
+        $("#overlay").removeClass("hide");
+      } else {
+        $("#video_feed").attr("src", $("#video_feed").data("src") + "?sid="
+          + encodeURIComponent(msg.sid));
+      }
+    });
+
+  socket.on('annotations', drawAnnotations);
+
+  // The server has picked up one of our frames, so we may send another one.
+  // It also tells us how many frames per second it is getting through.
+  socket.on('credit', function (msg) {
+      credits += msg.credits;
+      document.title = ORIGINAL_DOC_TITLE + ' (' + msg.fps.toFixed(1) + ' FPS)';
+      if (waitingForCreditSinceMsec >= 0) {
+        // Send the next frame right away instead of waiting for the timer.
+        waitingForCreditSinceMsec = -1;
+        clearTimeout(sendFrameCB);
+        sendFrameCB = setTimeout(sendVideoFrame, 0.0);
+      }
+    });
+
   function initEvents() {
     $('#webcam-button').click('click', webcamButtonHandler);
   };
@@ -147,6 +236,8 @@
         video.srcObject = stream;
         mycanvas.height = video.height;
         mycanvas.width = video.width;
+        overlay.height = video.height;
+        overlay.width = video.width;
         webcamOn = true;
       })
     .catch(function(err) {
@@ -157,16 +248,40 @@
     socket.emit('netin', { data: 'Run Estimator!' });
 
     function sendVideoFrame_() {
+      if (webcamOn && credits <= 0) {
+        // Don't capture and encode a frame the server has no room for. The
+        // 'credit' handler calls us again as soon as there is room.
+        var nowMsec = Date.now();
+        if (waitingForCreditSinceMsec < 0) {
+          waitingForCreditSinceMsec = nowMsec;
+        }
+        if (nowMsec - waitingForCreditSinceMsec < _CREDIT_TIMEOUT_MSEC) {
+          sendFrameCB = setTimeout( sendVideoFrame_, _CREDIT_TIMEOUT_MSEC);
+          return;
+        }
+        waitingForCreditSinceMsec = -1;
+        credits = 1;
+      }
       if (webcamOn) {
+        credits--;
         ctx.drawImage(video, 0, 0, mycanvas.width, mycanvas.height);
-        socket.emit('streamingvideo', { data: mycanvas.toDataURL('image/jpeg',
-          _JPEG_COMPRESSION) });
+        var frameId = nextFrameId++;
+        if (mycanvas.toBlob) {
+          // Send the raw JPEG bytes; the server decodes them directly.
+          mycanvas.toBlob(function(blob) {
+            socket.emit('streamingframe', blob, frameId);
+          }, 'image/jpeg', _JPEG_COMPRESSION);
+        } else {
+          socket.emit('streamingvideo', { data: mycanvas.toDataURL('image/jpeg',
+            _JPEG_COMPRESSION), frame_id: frameId });
+        }
       }
         sendFrameCB = setTimeout( sendVideoFrame_, msecToNextFrame());
     };
 
     // Use setTimeout(), not setInterval(), to avoid queueing events in the
     // browser.
+    sendVideoFrame = sendVideoFrame_;
     sendFrameCB = setTimeout( sendVideoFrame_, 0.0);
   }
 
@@ -0,0 +1,226 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for geometry.py.
+
+The box helpers replaced per-box loops in app.py and tracking.py. Copies of
+those loops are kept here as references, so that the tests pin down that the
+vectorized versions compute the same thing.
+
+Run with:
+
+    python -m pytest test_geometry.py
+"""
+
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import geometry
+
+# Normalized [y1, x1, y2, x2] boxes, as the model returns them
+NORM_BOXES_YXYX = [[0.1, 0.2, 0.5, 0.4],
+                   [0.0, 0.0, 1.0, 1.0],
+                   [0.25, 0.6, 0.75, 0.95]]
+
+# Image size in pixels
+WIDTH = 640
+HEIGHT = 360
+
+
+################################################################################
+# REFERENCE IMPLEMENTATIONS
+
+def old_scale_up_norm_bbx(box, img_w, img_h):
+    """app.scale_up_norm_bbx() before geometry.py. It was called with the
+    image height as img_w and the width as img_h (from img.shape), and
+    returned [x1, y1, x2, y2] corners."""
+    ret = []
+    for eachbbox in box:
+        y1, x1, y2, x2 = (c for c in eachbbox)
+        bbox = [x1, y1, x2, y2]
+        new_bbox = []
+        for i in range(len(bbox)):
+            if i == 0:
+                new_val = bbox[i] * img_h
+            elif i == 1:
+                new_val = bbox[i] * img_w
+            elif i == 2:
+                new_val = bbox[i] * img_h
+            elif i == 3:
+                new_val = bbox[i] * img_w
+            new_bbox.append(new_val)
+        ret.append(new_bbox)
+    return ret
+
+
+def old_scale_bounding_boxes(bounding_boxes, orig_width, new_width):
+    """app.scale_bounding_boxes() before geometry.py."""
+    scale_factor = new_width / orig_width
+    ret = []
+    for bbox in bounding_boxes:
+        new_bbox = []
+        for elem in bbox:
+            new_elem = round(float(elem) * scale_factor)
+            new_bbox.append(new_elem)
+        ret.append(new_bbox)
+    return ret
+
+
+def old_centers(boxes):
+    """Centering in tracking.TrackStore.match() before geometry.py."""
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    return boxes[:, :2] + boxes[:, 2:] / 2
+
+
+def old_box_iou(boxes_a, boxes_b):
+    """tracking.box_iou() before geometry.py."""
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    overlap_w = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    overlap_h = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.clip(overlap_w, 0, None) * np.clip(overlap_h, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+
+################################################################################
+# TESTS
+
+class AsBoxesTest(unittest.TestCase):
+
+    def test_list_of_boxes(self):
+        boxes = geometry.as_boxes([[1, 2, 3, 4], [5, 6, 7, 8]])
+        self.assertEqual(boxes.shape, (2, 4))
+        self.assertEqual(boxes.dtype, np.float32)
+        assert_array_equal(boxes, [[1, 2, 3, 4], [5, 6, 7, 8]])
+
+    def test_single_flat_box(self):
+        self.assertEqual(geometry.as_boxes([1, 2, 3, 4]).shape, (1, 4))
+
+    def test_empty(self):
+        self.assertEqual(geometry.as_boxes([]).shape, (0, 4))
+
+
+class ParsePredictionsTest(unittest.TestCase):
+
+    def test_boxes_and_ages(self):
+        predictions = [{'age_estimation': 31, 'detection_box': NORM_BOXES_YXYX[0]},
+                       {'age_estimation': 48, 'detection_box': NORM_BOXES_YXYX[1]}]
+        boxes, ages = geometry.parse_predictions(predictions)
+        assert_allclose(boxes, NORM_BOXES_YXYX[:2])
+        assert_array_equal(ages, [31, 48])
+
+    def test_no_predictions(self):
+        boxes, ages = geometry.parse_predictions([])
+        self.assertEqual(boxes.shape, (0, 4))
+        self.assertEqual(ages.shape, (0,))
+
+
+class DenormalizeTest(unittest.TestCase):
+
+    def test_matches_scale_up_norm_bbx(self):
+        # Old: yxyx in, xyxy out. New: denormalize keeps yxyx, and the
+        # pipeline converts through xywh.
+        expected = old_scale_up_norm_bbx(NORM_BOXES_YXYX, HEIGHT, WIDTH)
+        boxes = geometry.denormalize(NORM_BOXES_YXYX, WIDTH, HEIGHT)
+        assert_allclose(geometry.xywh_to_xyxy(geometry.yxyx_to_xywh(boxes)), expected,
+                        rtol=1e-5)
+
+    def test_normalize_round_trip(self):
+        boxes = geometry.denormalize(NORM_BOXES_YXYX, WIDTH, HEIGHT)
+        assert_allclose(geometry.normalize(boxes, WIDTH, HEIGHT), NORM_BOXES_YXYX,
+                        rtol=1e-6)
+
+
+class ScaleTest(unittest.TestCase):
+
+    def test_matches_scale_bounding_boxes(self):
+        boxes = [[10, 20, 110, 220], [0, 0, 33, 47], [301, 17, 5, 9]]
+        for orig_width, new_width in ((640, 1024), (1024, 640), (640, 320), (500, 333)):
+            expected = old_scale_bounding_boxes(boxes, orig_width, new_width)
+            actual = geometry.to_pixels(geometry.scale(boxes, orig_width, new_width))
+            assert_array_equal(actual, expected)
+
+    def test_same_width(self):
+        boxes = [[1.5, 2.5, 3.5, 4.5]]
+        assert_array_equal(geometry.scale(boxes, 640, 640), boxes)
+
+
+class ConversionTest(unittest.TestCase):
+
+    def test_yxyx_to_xywh(self):
+        assert_array_equal(geometry.yxyx_to_xywh([[10, 20, 50, 80]]), [[20, 10, 60, 40]])
+
+    def test_xywh_to_xyxy(self):
+        assert_array_equal(geometry.xywh_to_xyxy([[20, 10, 60, 40]]), [[20, 10, 80, 50]])
+
+    def test_round_trips(self):
+        boxes = geometry.denormalize(NORM_BOXES_YXYX, WIDTH, HEIGHT)
+        assert_allclose(geometry.xywh_to_yxyx(geometry.yxyx_to_xywh(boxes)), boxes)
+        xywh = geometry.yxyx_to_xywh(boxes)
+        assert_allclose(geometry.xyxy_to_xywh(geometry.xywh_to_xyxy(xywh)), xywh)
+
+    def test_centers_match_old_centering(self):
+        boxes = [[20, 10, 60, 40], [0, 0, 1, 1], [5.5, 3, 7, 9]]
+        assert_array_equal(geometry.centers(boxes), old_centers(boxes))
+
+
+class ClipTest(unittest.TestCase):
+
+    def test_inside(self):
+        boxes = [[10, 20, 30, 40]]
+        assert_array_equal(geometry.clip_xywh(boxes, WIDTH, HEIGHT), boxes)
+
+    def test_partly_outside(self):
+        clipped = geometry.clip_xywh([[-10, -20, 30, 40], [620, 350, 40, 40]], WIDTH, HEIGHT)
+        assert_array_equal(clipped, [[0, 0, 20, 20], [620, 350, 20, 10]])
+
+    def test_entirely_outside(self):
+        clipped = geometry.clip_xywh([[700, 10, 20, 20]], WIDTH, HEIGHT)
+        self.assertEqual(clipped[0, 2], 0)
+
+
+class ToPixelsTest(unittest.TestCase):
+
+    def test_rounds_like_round(self):
+        # Halves round to even, the same as Python's round().
+        values = [0.4, 0.5, 1.5, 2.5, 2.6]
+        pixels = geometry.to_pixels([values[:4], values[1:]])
+        self.assertEqual(pixels.dtype, np.int32)
+        assert_array_equal(pixels, [[round(v) for v in values[:4]],
+                                    [round(v) for v in values[1:]]])
+
+
+class IouTest(unittest.TestCase):
+
+    def test_matches_box_iou(self):
+        a = geometry.as_boxes([[0, 0, 10, 10], [5, 5, 10, 10], [100, 100, 4, 8]])
+        b = geometry.as_boxes([[0, 0, 10, 10], [2, 3, 6, 5], [50, 50, 1, 1], [101, 99, 4, 8]])
+        assert_allclose(geometry.iou(a, b), old_box_iou(a, b), rtol=1e-6)
+
+    def test_known_values(self):
+        iou = geometry.iou([[0, 0, 10, 10]], [[0, 0, 10, 10], [5, 0, 10, 10], [20, 20, 5, 5]])
+        assert_allclose(iou, [[1., 50. / 150., 0.]])
+
+    def test_empty(self):
+        self.assertEqual(geometry.iou([], [[0, 0, 1, 1]]).shape, (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for inference.py, against stub model servers (benchmarks/stub_model.py).
+
+Run with:
+
+    python -m pytest test_inference.py
+"""
+
+import time
+import unittest
+
+from collections import Counter
+
+from benchmarks.stub_model import StubModelServer
+from inference import InferenceRouter
+
+FAST_LATENCY_SEC = 0.01
+SLOW_LATENCY_SEC = 0.3
+
+
+class SlowReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fast = StubModelServer(FAST_LATENCY_SEC).start()
+        self.slow = StubModelServer(SLOW_LATENCY_SEC).start()
+        self.events = Counter()
+
+    def tearDown(self):
+        self.router.close()
+        self.fast.stop()
+        self.slow.stop()
+
+    def make_router(self, **kwargs):
+        self.router = InferenceRouter(
+            [self.fast.url, self.slow.url], health_check_interval_sec=60.,
+            on_event=lambda event, endpoint: self.events.update([(event, endpoint)]),
+            **kwargs)
+        return self.router
+
+    def run_requests(self, num_requests):
+        start = time.time()
+        for _ in range(num_requests):
+            self.assertEqual(len(self.router.predict(b'jpeg')), 1)
+        return time.time() - start
+
+    def test_routing_moves_away_from_slow_replica(self):
+        self.make_router()
+        self.run_requests(60)
+        self.assertEqual(self.events[('slow', self.slow.url)], 1)
+        self.assertEqual(self.events[('slow', self.fast.url)], 0)
+        # Only the requests needed to find out that it is slow
+        self.assertLessEqual(self.slow.num_requests, InferenceRouter.MIN_LATENCY_SAMPLES + 1)
+        self.assertGreaterEqual(self.fast.num_requests, 60 - InferenceRouter.MIN_LATENCY_SAMPLES - 1)
+
+    def test_slow_replica_gets_another_chance(self):
+        self.make_router(slow_eject_sec=0.5)
+        self.run_requests(30)
+        num_slow = self.slow.num_requests
+        time.sleep(0.6)
+        self.run_requests(2)
+        self.assertGreater(self.slow.num_requests, num_slow)
+
+    def test_requests_to_slow_replica_are_hedged(self):
+        # With slow replica detection off, hedging alone has to keep the
+        # slow replica's requests fast.
+        self.make_router(hedge=True, slow_factor=0.)
+        # Until both replicas have enough latency samples, nothing is hedged.
+        self.run_requests(2 * InferenceRouter.MIN_LATENCY_SAMPLES)
+        delay = self.router._hedge_delay()
+        self.assertIsNotNone(delay)
+        self.assertLess(delay, SLOW_LATENCY_SEC / 2)
+
+        elapsed = self.run_requests(40)
+        hedged = self.events[('hedge', self.fast.url)]
+        self.assertGreater(hedged, 0)
+        self.assertEqual(self.events[('hedge_won', self.fast.url)], hedged)
+        # Without hedging, half the requests would take SLOW_LATENCY_SEC.
+        self.assertLess(elapsed, 40 * SLOW_LATENCY_SEC / 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
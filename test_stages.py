@@ -0,0 +1,107 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for stages.py.
+
+Run with:
+
+    python -m pytest test_stages.py
+"""
+
+import gc
+import unittest
+
+import gevent
+
+from stages import Prefetch, StagePool
+
+
+def count(n, produced):
+    for i in range(n):
+        produced.append(i)
+        yield i
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def test_yields_all_items_in_order(self):
+        self.assertEqual(list(Prefetch(iter(range(10)))), list(range(10)))
+
+    def test_bounded_queue(self):
+        produced = []
+        items = Prefetch(count(100, produced), maxsize=2)
+        self.assertEqual(next(items), 0)
+        gevent.sleep(0.01)
+        # At most maxsize + 1 items ahead of the consumer
+        self.assertLessEqual(len(produced), 1 + 2 + 1)
+        items.close()
+
+    def test_passes_on_exceptions(self):
+        def failing():
+            yield 1
+            raise ValueError("broken")
+
+        items = Prefetch(failing())
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_close_partly_consumed(self):
+        produced = []
+        items = Prefetch(count(100, produced))
+        self.assertEqual([next(items), next(items)], [0, 1])
+        items.close()
+        gevent.sleep(0.01)
+        num_produced = len(produced)
+        gevent.sleep(0.01)
+        self.assertEqual(len(produced), num_produced)
+        self.assertLess(num_produced, 100)
+        # Closing again is harmless.
+        items.close()
+
+    def test_close_from_finalized_generator(self):
+        def pipeline():
+            items = Prefetch(count(100, []))
+            try:
+                yield from items
+            finally:
+                items.close()
+
+        g = pipeline()
+        next(g)
+        g.close()
+        g = pipeline()
+        next(g)
+        del g
+        gc.collect()
+
+
+class StagePoolTest(unittest.TestCase):
+
+    def test_result_and_exception(self):
+        for num_threads in (0, 2):
+            pool = StagePool(num_threads)
+            try:
+                self.assertEqual(pool.run('add', lambda a, b: a + b, 1, 2), 3)
+                with self.assertRaises(ValueError):
+                    pool.run('fail', int, 'not a number')
+            finally:
+                pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
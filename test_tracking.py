@@ -0,0 +1,252 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the track identity part of tracking.py: TrackStore and the
+assignment it is built on.
+
+SciPy is optional, so the assignment tests run the fallback Hungarian
+algorithm directly and compare it against brute force.
+
+Run with:
+
+    python -m pytest test_tracking.py
+"""
+
+import itertools
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import tracking
+from tracking import TrackStore
+
+# Two faces far apart, as (x, y, w, h) in tracking image coordinates
+FACE_A = [10, 10, 40, 40]
+FACE_B = [200, 50, 40, 40]
+
+
+def moved(box, dx, dy=0):
+    x, y, w, h = box
+    return [x + dx, y + dy, w, h]
+
+
+################################################################################
+# REFERENCE IMPLEMENTATIONS
+
+def brute_force_assignment_cost(cost):
+    """Cost of the best assignment of rows to columns, trying all of them."""
+    num_rows, num_cols = cost.shape
+    if num_rows > num_cols:
+        return brute_force_assignment_cost(cost.T)
+    return min(cost[np.arange(num_rows), list(cols)].sum()
+               for cols in itertools.permutations(range(num_cols), num_rows))
+
+
+################################################################################
+# TESTS
+
+class HungarianTest(unittest.TestCase):
+
+    def check(self, cost, rows, cols):
+        num = min(cost.shape)
+        self.assertEqual(len(rows), num)
+        self.assertEqual(len(set(rows.tolist())), num)
+        self.assertEqual(len(set(cols.tolist())), num)
+        assert_array_equal(rows, np.sort(rows))
+        self.assertAlmostEqual(cost[rows, cols].sum(), brute_force_assignment_cost(cost))
+
+    def test_matches_brute_force(self):
+        rng = np.random.RandomState(0)
+        for _ in range(200):
+            num_rows = rng.randint(1, 6)
+            num_cols = rng.randint(num_rows, 7)
+            cost = rng.rand(num_rows, num_cols)
+            self.check(cost, *tracking._hungarian(cost))
+
+    def test_ties(self):
+        # Small integer costs have many optimal assignments.
+        rng = np.random.RandomState(1)
+        for _ in range(100):
+            num_rows = rng.randint(1, 5)
+            cost = rng.randint(0, 3, size=(num_rows, rng.randint(num_rows, 6))).astype(float)
+            self.check(cost, *tracking._hungarian(cost))
+
+    def test_more_rows_than_columns(self):
+        rng = np.random.RandomState(2)
+        for _ in range(50):
+            num_cols = rng.randint(1, 5)
+            cost = rng.rand(rng.randint(num_cols, 7), num_cols)
+            self.check(cost, *tracking.linear_assignment(cost))
+
+    def test_identity(self):
+        cost = 1. - np.eye(4)
+        rows, cols = tracking._hungarian(cost)
+        assert_array_equal(rows, [0, 1, 2, 3])
+        assert_array_equal(cols, [0, 1, 2, 3])
+
+
+class HysteresisTest(unittest.TestCase):
+
+    def test_birth_needs_min_hits(self):
+        tracks = TrackStore(min_hits=2)
+        tracks.update([FACE_A], [30])
+        self.assertEqual(len(tracks), 1)
+        self.assertEqual(tracks.num_tentative, 1)
+        self.assertEqual(len(tracks.visible()[0]), 0)
+
+        tracks.update([moved(FACE_A, 2)], [32])
+        self.assertEqual(tracks.num_tentative, 0)
+        ids, boxes, ages = tracks.visible()
+        assert_array_equal(ids, [0])
+        assert_allclose(boxes, [moved(FACE_A, 2)])
+
+    def test_born_confirmed_with_one_hit(self):
+        tracks = TrackStore(min_hits=1)
+        tracks.update([FACE_A], [30])
+        self.assertEqual(len(tracks.visible()[0]), 1)
+
+    def test_single_spurious_detection_never_shows(self):
+        tracks = TrackStore(min_hits=2)
+        tracks.update([FACE_A], [30])
+        tracks.update([], [])
+        self.assertEqual(len(tracks), 0)
+
+    def test_death_needs_max_misses(self):
+        tracks = TrackStore(min_hits=2, max_misses=3)
+        tracks.update([FACE_A], [30])
+        tracks.update([FACE_A], [30])
+        tracks.update([], [])
+        tracks.update([], [])
+        # Missed twice, still shown where it was last seen
+        ids, boxes, _ = tracks.visible()
+        assert_array_equal(ids, [0])
+        assert_allclose(boxes, [FACE_A])
+        tracks.update([], [])
+        self.assertEqual(len(tracks), 0)
+
+    def test_hit_resets_misses(self):
+        tracks = TrackStore(min_hits=1, max_misses=2)
+        for _ in range(5):
+            tracks.update([FACE_A], [30])
+            tracks.update([], [])
+        assert_array_equal(tracks.visible()[0], [0])
+
+    def test_ages_are_smoothed(self):
+        tracks = TrackStore(min_hits=1, age_smoothing=0.25)
+        tracks.update([FACE_A], [20])
+        age_delta = tracks.update([FACE_A], [40])
+        self.assertEqual(age_delta, 20.)
+        assert_allclose(tracks.visible()[2], [25.])
+
+
+class IdStabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracks = TrackStore(min_hits=1)
+        self.tracks.update([FACE_A, FACE_B], [30, 60])
+
+    def ids_by_age(self):
+        ids, _, ages = self.tracks.visible()
+        return dict(zip(np.round(ages).tolist(), ids.tolist()))
+
+    def test_ids_follow_moving_faces(self):
+        for step in range(1, 10):
+            self.tracks.update([moved(FACE_A, 3 * step), moved(FACE_B, -3 * step, 2 * step)],
+                               [30, 60])
+        self.assertEqual(self.ids_by_age(), {30: 0, 60: 1})
+
+    def test_detection_order_does_not_matter(self):
+        self.tracks.update([moved(FACE_B, 2), moved(FACE_A, 2)], [60, 30])
+        self.assertEqual(self.ids_by_age(), {30: 0, 60: 1})
+
+    def test_new_face_gets_new_id(self):
+        face_c = [100, 200, 40, 40]
+        self.tracks.update([FACE_A, face_c, FACE_B], [30, 45, 60])
+        self.assertEqual(self.ids_by_age(), {30: 0, 45: 2, 60: 1})
+
+    def test_far_detection_is_not_matched(self):
+        # Beyond max_cost, the old track is missed and a new one is born.
+        self.tracks.update([FACE_A, moved(FACE_B, 150)], [30, 60])
+        ids = self.tracks.ids.tolist()
+        self.assertEqual(sorted(ids), [0, 1, 2])
+        self.assertEqual(self.tracks.misses[ids.index(1)], 1)
+
+    def test_ids_are_not_reused(self):
+        self.tracks.update([], [])
+        self.tracks.update([], [])
+        self.assertEqual(len(self.tracks), 0)
+        self.tracks.update([FACE_A], [30])
+        assert_array_equal(self.tracks.ids, [2])
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracks = TrackStore(min_hits=1)
+        self.tracks.update([FACE_A, FACE_B], [30, 60])
+
+    def test_snapshot_is_a_copy(self):
+        snapshot = self.tracks.snapshot()
+        self.tracks.set_boxes([moved(FACE_A, 5), moved(FACE_B, 5)])
+        assert_allclose(snapshot[0], FACE_A)
+        assert_allclose(snapshot[1], FACE_B)
+
+    def test_rewind(self):
+        snapshot = self.tracks.snapshot()
+        del snapshot[1]
+        self.tracks.set_boxes([moved(FACE_A, 5), moved(FACE_B, 5)])
+        self.tracks.rewind(snapshot)
+        # Tracks without a recorded box keep their current one.
+        assert_allclose(self.tracks.boxes, [FACE_A, moved(FACE_B, 5)])
+
+    def test_rewind_does_not_touch_copies(self):
+        other = self.tracks.copy()
+        snapshot = self.tracks.snapshot()
+        self.tracks.set_boxes([moved(FACE_A, 5), moved(FACE_B, 5)])
+        other.boxes = self.tracks.boxes
+        other.rewind(snapshot)
+        assert_allclose(self.tracks.boxes, [moved(FACE_A, 5), moved(FACE_B, 5)])
+
+    def test_rewind_then_match(self):
+        # The detections are in the frame of the snapshot; the faces have
+        # since moved far enough that they would no longer match.
+        snapshot = self.tracks.snapshot()
+        self.tracks.set_boxes([moved(FACE_A, 100), moved(FACE_B, 100)])
+        self.tracks.rewind(snapshot)
+        self.tracks.update([moved(FACE_A, 1), moved(FACE_B, 1)], [30, 60])
+        assert_array_equal(self.tracks.ids, [0, 1])
+
+    def test_add_missing(self):
+        snapshot = {0: np.array(moved(FACE_A, -5), dtype=np.float32)}
+        self.tracks.add_missing(snapshot)
+        # Known tracks keep their recorded box.
+        assert_allclose(snapshot[0], moved(FACE_A, -5))
+        assert_allclose(snapshot[1], FACE_B)
+        self.tracks.set_boxes([moved(FACE_A, 5), moved(FACE_B, 5)])
+        assert_allclose(snapshot[1], FACE_B)
+
+    def test_remove(self):
+        self.tracks.update([FACE_A, FACE_B, [100, 200, 40, 40]], [30, 60, 45])
+        self.tracks.remove([1])
+        assert_array_equal(self.tracks.ids, [0, 2])
+        assert_allclose(self.tracks.boxes, [FACE_A, [100, 200, 40, 40]])
+        assert_allclose(self.tracks.visible()[2], [30, 45])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,527 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import cv2
+import geometry
+import numpy as np
+import time
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+class FrameRing(object):
+    """
+    Fixed-capacity ring buffer of the most recent tracking-size frames of a
+    session, used to let a new tracker catch up with the video that went by
+    while an inference request was in flight.
+
+    Frames are identified by a sequence number that increases by one for
+    each frame pushed. The storage for all slots is allocated once, and
+    again only if the frame size changes, so memory per session is bounded
+    no matter how long the model server takes to answer.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._slots = None
+        self._seqs = np.full(capacity, -1, dtype=np.int64)
+
+        # Sequence number of the next frame to be pushed
+        self.next_seq = 0
+
+    def push(self, img_np):
+        """
+        Copy a frame into the ring, overwriting the oldest one if the ring
+        is full.
+
+        Returns the sequence number of the frame.
+        """
+        if self._slots is None or self._slots.shape[1:] != img_np.shape:
+            self._slots = np.empty((self.capacity,) + img_np.shape,
+                                   dtype=img_np.dtype)
+            self._seqs[:] = -1
+        seq = self.next_seq
+        ix = seq % self.capacity
+        np.copyto(self._slots[ix], img_np)
+        self._seqs[ix] = seq
+        self.next_seq += 1
+        return seq
+
+    def seqs_since(self, seq):
+        """
+        Sequence numbers of the frames still in the ring that were pushed
+        after frame seq, oldest first.
+        """
+        first = max(seq + 1, self.next_seq - self.capacity, 0)
+        return [s for s in range(first, self.next_seq)
+                if self._seqs[s % self.capacity] == s]
+
+    def get(self, seq):
+        """
+        Returns the frame with sequence number seq. The array is a view into
+        the ring and will be overwritten once capacity more frames have been
+        pushed.
+        """
+        ix = seq % self.capacity
+        if self._seqs[ix] != seq:
+            raise KeyError(seq)
+        return self._slots[ix]
+
+
+def select_replay_frames(seqs, max_frames):
+    """
+    Choose which of the frames that went by while a request was in flight to
+    replay through a new tracker.
+
+    Replays every k-th frame, with k chosen so that at most max_frames
+    frames are replayed. The most recent frame is always included, so the
+    tracker ends up on the current frame.
+
+    Args:
+        seqs: Sequence numbers of the candidate frames, oldest first
+        max_frames: Maximum number of frames to replay; 0 means no limit
+
+    Returns a list of sequence numbers, oldest first.
+    """
+    if max_frames <= 0 or len(seqs) <= max_frames:
+        return list(seqs)
+    step = int(np.ceil(len(seqs) / float(max_frames)))
+    selected = list(seqs[-1::-step])[::-1]
+    return selected[-max_frames:]
+
+
+def replay_frames(tracker, frames, time_budget_sec=0.):
+    """
+    Run a tracker over a sequence of frames.
+
+    If time_budget_sec is positive and the replay takes longer than that,
+    the remaining frames except the last one are skipped, so that a slow
+    catch-up cannot hold up the video indefinitely.
+
+    Args:
+        tracker: Tracker with an update(image) method
+        frames: List of images, oldest first
+        time_budget_sec: Maximum time to spend, or 0 for no limit
+
+    Returns the tracker.
+    """
+    start = time.time()
+    for i, img in enumerate(frames):
+        if (time_budget_sec > 0 and i < len(frames) - 1
+                and time.time() - start > time_budget_sec):
+            tracker.update(frames[-1])
+            break
+        tracker.update(img)
+    return tracker
+
+
+class FlowTracker(object):
+    """
+    Tracks all faces of a frame in one batched pass, as a faster drop-in
+    replacement for a cv2.MultiTracker holding one TrackerMedianFlow per
+    face.
+
+    Like MedianFlow, every update samples a grid of points in each box,
+    tracks them forward and backward with pyramidal Lucas-Kanade optical
+    flow, discards points with a large forward-backward error, and moves
+    and scales each box by the median motion of its remaining points. Unlike
+    MultiTracker, the optical flow for all faces is computed in a single
+    call, and the per-box medians are computed on (faces x points) arrays.
+
+    Boxes are (x, y, w, h) tuples, as with the OpenCV trackers.
+    """
+
+    def __init__(self, image, boxes, grid_size=5, win_size=(5, 5),
+                 max_level=2, max_fb_error_px=2.0, min_points=0.25):
+        """
+        Args:
+            image: First frame, as a numpy array, or None if there are no
+                boxes yet
+            boxes: Initial boxes in that frame
+            grid_size: Points sampled per box along each axis
+            win_size: Search window of the optical flow at each pyramid
+                level
+            max_level: Number of pyramid levels of the optical flow
+            max_fb_error_px: Points whose forward-backward error exceeds
+                this are not used
+            min_points: Fraction of a box's points that must survive for the
+                box to count as tracked
+        """
+        self.grid_size = grid_size
+        self.win_size = win_size
+        self.max_level = max_level
+        self.max_fb_error_px = max_fb_error_px
+        self.min_points = min_points
+
+        # Sample positions of the grid within a unit box
+        steps = (np.arange(grid_size, dtype=np.float32) + 0.5) / grid_size
+        gx, gy = np.meshgrid(steps, steps)
+        self._grid = np.stack([gx.ravel(), gy.ravel()], axis=1)
+        self.set_boxes(image, boxes)
+
+    def set_boxes(self, image, boxes):
+        """
+        Replace the tracked boxes in place, as of the given frame. image may
+        be None if there are no boxes.
+        """
+        self._prev_gray = None if image is None else self._gray(image)
+        self._boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+    def getObjects(self):
+        return self._boxes.copy()
+
+    @staticmethod
+    def _gray(image):
+        return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+    def update(self, image):
+        """
+        Track the boxes into a new frame.
+
+        Returns a tuple (success, boxes) like cv2.MultiTracker.update():
+        success is False if any box was lost, and boxes is an (N, 4) array.
+        Lost boxes keep their previous position.
+        """
+        gray = self._gray(image)
+        prev_gray = self._prev_gray
+        self._prev_gray = gray
+        num_boxes = self._boxes.shape[0]
+        if num_boxes == 0 or prev_gray is None:
+            return True, self._boxes.copy()
+
+        # Grid points of all boxes, shape (num_boxes, points per box, 2)
+        xy = self._boxes[:, None, 0:2]
+        wh = self._boxes[:, None, 2:4]
+        points = (xy + self._grid[None] * wh).astype(np.float32)
+        flat = points.reshape(-1, 1, 2)
+
+        lk_params = dict(winSize=self.win_size, maxLevel=self.max_level)
+        fwd, status_fwd, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray,
+                                                      flat, None, **lk_params)
+        back, status_back, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray,
+                                                        fwd, None, **lk_params)
+
+        shape = points.shape[:2]
+        fwd = fwd.reshape(shape + (2,))
+        fb_error = np.linalg.norm(back.reshape(shape + (2,)) - points, axis=2)
+        valid = ((status_fwd.reshape(shape) == 1)
+                 & (status_back.reshape(shape) == 1)
+                 & (fb_error <= self.max_fb_error_px))
+        num_valid = valid.sum(axis=1)
+        ok = num_valid >= max(self.min_points * shape[1], 1)
+
+        # Median translation of each box's valid points
+        motion = fwd - points
+        dx = _masked_median(motion[..., 0], valid, num_valid)
+        dy = _masked_median(motion[..., 1], valid, num_valid)
+
+        # Median change of each point's distance to the box's center, as a
+        # scale estimate
+        weights = valid[..., None] / np.maximum(num_valid, 1)[:, None, None]
+        center_old = (points * weights).sum(axis=1)
+        center_new = (fwd * weights).sum(axis=1)
+        dist_old = np.linalg.norm(points - center_old[:, None], axis=2)
+        dist_new = np.linalg.norm(fwd - center_new[:, None], axis=2)
+        scale_valid = valid & (dist_old > 1e-3)
+        ratio = dist_new / np.maximum(dist_old, 1e-3)
+        scale = _masked_median(ratio, scale_valid, scale_valid.sum(axis=1))
+        scale = np.where(scale_valid.any(axis=1), scale, 1.0)
+
+        boxes = self._boxes
+        cx = boxes[:, 0] + boxes[:, 2] / 2 + dx
+        cy = boxes[:, 1] + boxes[:, 3] / 2 + dy
+        w = boxes[:, 2] * scale
+        h = boxes[:, 3] * scale
+        new_boxes = np.stack([cx - w / 2, cy - h / 2, w, h], axis=1)
+        self._boxes = np.where(ok[:, None], new_boxes, boxes).astype(np.float32)
+        return bool(ok.all()), self._boxes.copy()
+
+
+def _masked_median(values, valid, num_valid):
+    """
+    Median of each row of values, counting only the entries where valid is
+    True. Rows without valid entries get 0.
+
+    Args:
+        values: (rows, columns) array
+        valid: Boolean array of the same shape
+        num_valid: Number of valid entries in each row
+    """
+    # Sort the invalid entries to the end of each row.
+    ordered = np.sort(np.where(valid, values, np.inf), axis=1)
+    rows = np.arange(values.shape[0])
+    lo = ordered[rows, np.maximum((num_valid - 1) // 2, 0)]
+    hi = ordered[rows, np.maximum(num_valid // 2, 0)]
+    return np.where(num_valid > 0, (lo + hi) / 2, 0.)
+
+
+################################################################################
+# TRACK IDENTITY
+
+def linear_assignment(cost):
+    """
+    Minimum-cost assignment of rows to columns (the Hungarian algorithm).
+
+    Uses scipy.optimize.linear_sum_assignment if SciPy is installed.
+
+    Args:
+        cost: (N, M) array of costs
+
+    Returns a tuple (rows, cols) of index arrays of length min(N, M): row
+    rows[i] is assigned to column cols[i].
+    """
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = linear_assignment(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+    return _hungarian(cost)
+
+
+def _hungarian(cost):
+    """
+    Shortest augmenting path version of the Hungarian algorithm, for N <= M.
+    O(N^2 M), with the inner loop over columns vectorized.
+    """
+    num_rows, num_cols = cost.shape
+    # Row and column potentials. Row and column 0 are sentinels, so the
+    # arrays are indexed from 1.
+    u = np.zeros(num_rows + 1)
+    v = np.zeros(num_cols + 1)
+    # Row assigned to each column, 0 for none
+    col_row = np.zeros(num_cols + 1, dtype=np.int64)
+    for row in range(1, num_rows + 1):
+        col_row[0] = row
+        col = 0
+        min_slack = np.full(num_cols + 1, np.inf)
+        prev_col = np.zeros(num_cols + 1, dtype=np.int64)
+        used = np.zeros(num_cols + 1, dtype=bool)
+        while True:
+            used[col] = True
+            i = col_row[col]
+            free = ~used[1:]
+            slack = cost[i - 1] - u[i] - v[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            prev_col[1:][better] = col
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_col = int(np.argmin(candidates)) + 1
+            delta = candidates[next_col - 1]
+            u[col_row[used]] += delta
+            v[used] -= delta
+            min_slack[1:][free] -= delta
+            col = next_col
+            if col_row[col] == 0:
+                break
+        # Flip the augmenting path
+        while col != 0:
+            prev = prev_col[col]
+            col_row[col] = col_row[prev]
+            col = prev
+    cols = np.nonzero(col_row[1:])[0]
+    rows = col_row[cols + 1] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+class TrackStore(object):
+    """
+    The faces a session is following, with an identity that persists from
+    one inference result to the next.
+
+    Track state is kept as parallel NumPy arrays (one row per track) rather
+    than as a list of objects, so that matching a result against the tracks
+    and updating them are a handful of array operations however many faces
+    there are.
+
+    New detections are matched to tracks by minimum-cost assignment, with a
+    cost that combines the overlap of the boxes and the distance between
+    their centers. Tracks are born tentative and only become confirmed (and
+    visible) once they have been seen in min_hits consecutive results; they
+    die once they have been missed in max_misses consecutive results. A face
+    that the model misses once therefore does not flicker, and a single
+    spurious detection never shows up.
+
+    Boxes are (x, y, w, h) in tracking image coordinates, as with the
+    trackers above.
+    """
+
+    def __init__(self, min_hits=2, max_misses=2, max_cost=1.5,
+                 age_smoothing=0.1):
+        """
+        Args:
+            min_hits: Number of consecutive results in which a new face must
+                be detected before it is shown
+            max_misses: Number of consecutive results in which a face must be
+                missing before it is dropped
+            max_cost: Detections are only matched to tracks with a cost
+                (1 - IoU plus the distance between the box centers in units
+                of the mean box diagonal) up to this value
+            age_smoothing: Weight of a new age estimate in the exponentially
+                decaying average age of a track.
+                0.0 => ignore new values, 1.0 => ignore old values
+        """
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.max_cost = max_cost
+        self.age_smoothing = age_smoothing
+        self._next_id = 0
+
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.ages = np.zeros(0, dtype=np.float32)
+        # Consecutive results in which each track was and wasn't detected
+        self.hits = np.zeros(0, dtype=np.int32)
+        self.misses = np.zeros(0, dtype=np.int32)
+        self.confirmed = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def copy(self):
+        other = TrackStore(self.min_hits, self.max_misses, self.max_cost,
+                           self.age_smoothing)
+        other._next_id = self._next_id
+        for name in ('ids', 'boxes', 'ages', 'hits', 'misses', 'confirmed'):
+            setattr(other, name, getattr(self, name).copy())
+        return other
+
+    @property
+    def num_tentative(self):
+        return int(np.count_nonzero(~self.confirmed))
+
+    def visible(self):
+        """Returns a tuple (ids, boxes, ages) of the confirmed tracks."""
+        mask = self.confirmed
+        return self.ids[mask], self.boxes[mask], self.ages[mask]
+
+    def set_boxes(self, boxes):
+        """Move the tracks to the boxes the tracker reported for the current
+        frame, given in the same order as the tracks."""
+        self.boxes = geometry.as_boxes(boxes)
+
+    def remove(self, track_ix):
+        """Stop following the tracks at the given indices."""
+        keep = np.ones(len(self), dtype=bool)
+        keep[track_ix] = False
+        for name in ('ids', 'boxes', 'ages', 'hits', 'misses', 'confirmed'):
+            setattr(self, name, getattr(self, name)[keep])
+
+    def snapshot(self):
+        """Returns a dict from track id to the track's current box, for
+        rewind()."""
+        return dict(zip(self.ids.tolist(), self.boxes.copy()))
+
+    def rewind(self, boxes_by_id):
+        """
+        Move the tracks back to the boxes they had in an earlier frame, as
+        recorded by snapshot() or add_missing(), so that they can be matched
+        against detections in that frame. Tracks without a recorded box keep
+        their current one.
+        """
+        self.boxes = self.boxes.copy()
+        for i, track_id in enumerate(self.ids.tolist()):
+            box = boxes_by_id.get(track_id)
+            if box is not None:
+                self.boxes[i] = box
+
+    def add_missing(self, boxes_by_id):
+        """Add the current boxes of the tracks that a snapshot() does not
+        know about to it."""
+        for track_id, box in zip(self.ids.tolist(), self.boxes):
+            boxes_by_id.setdefault(track_id, box.copy())
+
+    def match(self, boxes):
+        """
+        Match detected boxes against the current tracks.
+
+        Returns a tuple (track_ix, detection_ix) of index arrays of the
+        matched pairs.
+        """
+        if len(self) == 0 or boxes.shape[0] == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        centers_t = geometry.centers(self.boxes)
+        centers_d = geometry.centers(boxes)
+        distance = np.linalg.norm(centers_t[:, None] - centers_d[None], axis=2)
+        diagonal_t = np.linalg.norm(self.boxes[:, 2:], axis=1)
+        diagonal_d = np.linalg.norm(boxes[:, 2:], axis=1)
+        scale = np.maximum((diagonal_t[:, None] + diagonal_d[None]) / 2, 1e-6)
+        cost = 1. - geometry.iou(self.boxes, boxes) + distance / scale
+        # Pairs beyond the gate are never worth matching; make them expensive
+        # enough that the assignment never trades a good match for them.
+        gated = cost > self.max_cost
+        cost[gated] = self.max_cost * (cost.shape[0] + cost.shape[1] + 1)
+        rows, cols = linear_assignment(cost)
+        keep = ~gated[rows, cols]
+        return rows[keep], cols[keep]
+
+    def update(self, boxes, ages):
+        """
+        Apply a new inference result.
+
+        Args:
+            boxes: (N, 4) array of detected boxes
+            ages: Age estimates of the detections
+
+        Returns the mean absolute difference between the new age estimates
+        and the smoothed ages of the tracks they were matched to, or None if
+        no detections were matched to confirmed tracks.
+        """
+        boxes = geometry.as_boxes(boxes)
+        ages = np.asarray(ages, dtype=np.float32).reshape(-1)
+        track_ix, det_ix = self.match(boxes)
+
+        confirmed_match = self.confirmed[track_ix]
+        age_delta = None
+        if np.any(confirmed_match):
+            age_delta = float(np.mean(np.abs(
+                ages[det_ix[confirmed_match]] - self.ages[track_ix[confirmed_match]])))
+
+        # Matched tracks
+        matched = np.zeros(len(self), dtype=bool)
+        matched[track_ix] = True
+        self.boxes[track_ix] = boxes[det_ix]
+        self.ages[track_ix] = (ages[det_ix] * self.age_smoothing
+                               + self.ages[track_ix] * (1. - self.age_smoothing))
+        self.hits[track_ix] += 1
+        self.misses[track_ix] = 0
+        self.confirmed |= self.hits >= self.min_hits
+
+        # Missed tracks. Tentative tracks die as soon as they are missed.
+        self.hits[~matched] = 0
+        self.misses[~matched] += 1
+        alive = (self.misses < self.max_misses) & (matched | self.confirmed)
+
+        # New tracks
+        new = np.ones(boxes.shape[0], dtype=bool)
+        new[det_ix] = False
+        num_new = int(np.count_nonzero(new))
+        new_ids = np.arange(self._next_id, self._next_id + num_new)
+        self._next_id += num_new
+
+        self.ids = np.concatenate([self.ids[alive], new_ids])
+        self.boxes = np.concatenate([self.boxes[alive], boxes[new]])
+        self.ages = np.concatenate([self.ages[alive], ages[new]])
+        self.hits = np.concatenate([self.hits[alive], np.ones(num_new, dtype=np.int32)])
+        self.misses = np.concatenate([self.misses[alive], np.zeros(num_new, dtype=np.int32)])
+        self.confirmed = np.concatenate([self.confirmed[alive],
+                                         np.full(num_new, self.min_hits <= 1)])
+        return age_delta
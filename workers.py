@@ -0,0 +1,458 @@
+#
+# Copyright 2018 IBM Corp. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Worker processes that run the session pipelines on more than one core.
+
+In worker mode the Flask-SocketIO process is only a router: it pins each
+session to one of a pool of worker processes, and each worker runs gen() for
+its sessions. Frames from the browser, and annotated JPEG frames going back,
+are passed through shared memory (ShmRing) rather than pickled. Only small
+control messages go over the pipe between router and worker:
+
+  router -> worker
+    ('open', sid, output_mode, credits)
+    ('frame', sid, slot, length, frame_id, received_ts)
+    ('close', sid)
+    ('stop',)
+
+  worker -> router
+    ('heartbeat', num_sessions)
+    ('credit', sid, processing_fps)
+    ('video', sid, slot, length, received_ts)
+    ('annotations', sid, message, received_ts)
+    ('closed', sid)       (evicted by the worker)
+
+Both sides are gevent-patched, so each waits for its pipe with gevent before
+reading from it.
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+
+from gevent.socket import wait_read, wait_write
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+def available():
+    return shared_memory is not None
+
+
+class ShmRing(object):
+    """
+    Fixed-size slots in shared memory for passing byte strings from one
+    process to another without pickling them.
+
+    One process writes to the ring and the other reads from it, in the same
+    order. A slot can be reused once the reader has copied its contents out.
+    The writer sends the slot number and length of each write to the reader
+    over some other channel.
+    """
+
+    def __init__(self, num_slots, slot_bytes, name=None):
+        """
+        Args:
+            num_slots: Number of byte strings the ring can hold at once
+            slot_bytes: Maximum length of each byte string
+            name: Name of an existing ring to attach to, or None to create
+                a new one
+        """
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        # One "full" flag per slot, followed by the slots themselves
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=name is None, size=num_slots * (slot_bytes + 1))
+        self._flags = self.shm.buf[:num_slots]
+        self._next_slot = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _offset(self, slot):
+        return self.num_slots + slot * self.slot_bytes
+
+    def write(self, data):
+        """
+        Copy data into the next slot.
+
+        Returns the slot number, or None if the reader has not released the
+        slot yet or data is too large.
+        """
+        slot = self._next_slot
+        if len(data) > self.slot_bytes or self._flags[slot]:
+            return None
+        offset = self._offset(slot)
+        self.shm.buf[offset:offset + len(data)] = data
+        self._flags[slot] = 1
+        self._next_slot = (slot + 1) % self.num_slots
+        return slot
+
+    def read(self, slot, length):
+        """Copy the contents of a slot out and release the slot."""
+        offset = self._offset(slot)
+        data = bytes(self.shm.buf[offset:offset + length])
+        self.release(slot)
+        return data
+
+    def release(self, slot):
+        """Mark a slot as free again, e.g. if the writer could not tell the
+        reader about it."""
+        self._flags[slot] = 0
+
+    def close(self, unlink=False):
+        self._flags.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+################################################################################
+# WORKER SIDE
+
+def run_worker(conn, in_ring_name, out_ring_name, num_slots, slot_bytes, config,
+               heartbeat_sec):
+    """
+    Entry point of a worker process: run the pipelines of the sessions that
+    the router opens on this worker until the router says stop or goes away.
+
+    Args:
+        conn: This worker's end of the pipe to the router
+        in_ring_name: Name of the ShmRing that frames arrive on
+        out_ring_name: Name of the ShmRing that annotated frames leave on
+        num_slots, slot_bytes: Size of both rings
+        config: The router's app.config settings
+        heartbeat_sec: Interval between heartbeats to the router
+    """
+    # Importing the app monkey-patches this process for gevent, the same as
+    # the router. Threads below are greenlets.
+    import app as webapp
+    from sessions import SessionRegistry
+
+    webapp.app.config.update(config)
+    webapp.init_inference()
+    webapp.init_stage_pool()
+    in_ring = ShmRing(num_slots, slot_bytes, in_ring_name)
+    out_ring = ShmRing(num_slots, slot_bytes, out_ring_name)
+    sessions = SessionRegistry(config['MAX_SESSIONS'], config['SESSION_IDLE_TIMEOUT_SEC'])
+
+    def on_credit(session, num_credits):
+        conn.send(('credit', session.sid, round(session.processing_fps, 1)))
+
+    def run_session(session):
+        for result, received_ts in webapp.gen(session, with_received_ts=True):
+            if session.output_mode == 'annotations':
+                conn.send(('annotations', session.sid, result, received_ts))
+            else:
+                # If the router is behind on reading results, drop this one
+                # rather than wait.
+                slot = out_ring.write(result)
+                if slot is not None:
+                    conn.send(('video', session.sid, slot, len(result), received_ts))
+            # gen() only yields to other greenlets when its session has no
+            # frames waiting. Sleep briefly so that this worker's pipe,
+            # heartbeat and inference requests are serviced as well.
+            time.sleep(0.001)
+
+    def heartbeat():
+        while True:
+            conn.send(('heartbeat', len(sessions)))
+            # Tell the router about sessions closed here rather than by it.
+            for sid in sessions.evict_idle():
+                conn.send(('closed', sid))
+            time.sleep(heartbeat_sec)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        while True:
+            wait_read(conn.fileno())
+            message = conn.recv()
+            kind = message[0]
+            if kind == 'frame':
+                _, sid, slot, length, frame_id, received_ts = message
+                frame = in_ring.read(slot, length)
+                session = sessions.get(sid)
+                if session is not None:
+                    # The router has checked the browser's credit already.
+                    # Charge it here too, so that dequeuing the frame hands
+                    # it back.
+                    session.take_credit()
+                    session.put_frame(frame, frame_id, received_ts)
+            elif kind == 'open':
+                _, sid, output_mode, credits = message
+                if sessions.get(sid) is None:
+                    session = sessions.create(sid, output_mode, credits, on_credit)
+                    if session is not None:
+                        threading.Thread(target=run_session, args=(session,),
+                                         daemon=True).start()
+            elif kind == 'close':
+                sessions.remove(message[1])
+            elif kind == 'stop':
+                break
+    except (EOFError, OSError):
+        # The router has gone away.
+        pass
+    in_ring.close()
+    out_ring.close()
+
+
+################################################################################
+# ROUTER SIDE
+
+class _Worker(object):
+    """A worker process, as seen from the router."""
+
+    def __init__(self, index, context, num_slots, slot_bytes, config, heartbeat_sec):
+        self.index = index
+        self.in_ring = ShmRing(num_slots, slot_bytes)
+        self.out_ring = ShmRing(num_slots, slot_bytes)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_worker, name='worker-{}'.format(index),
+            args=(child_conn, self.in_ring.name, self.out_ring.name, num_slots,
+                  slot_bytes, config, heartbeat_sec))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        # Time of the last message from the process; starts out generous to
+        # give it time to import the app.
+        self.last_heard = time.time()
+
+        # Set once the process is being replaced, to stop its reader
+        self.stopped = False
+
+    def send(self, message, timeout_sec):
+        """Send a control message. Returns False if the pipe is broken or
+        stays full for timeout_sec."""
+        try:
+            wait_write(self.conn.fileno(), timeout=timeout_sec)
+            self.conn.send(message)
+            return True
+        except OSError:
+            return False
+
+    def stop(self, timeout_sec=2.0):
+        self.stopped = True
+        self.send(('stop',), timeout_sec)
+        self.process.join(timeout_sec)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.in_ring.close(unlink=True)
+        self.out_ring.close(unlink=True)
+
+
+class WorkerPool(object):
+    """
+    The router's side of worker mode: starts the worker processes, pins
+    each session to one of them, passes frames and results back and forth,
+    and restarts workers that die or stop sending heartbeats.
+
+    Results come back through callbacks, which run on the router's reader
+    greenlets:
+      on_credit(sid, processing_fps): The worker has dequeued a frame of the
+          session, which gives its browser a credit back
+      on_annotations(sid, message, received_ts): An annotation message for a
+          session in 'annotations' output mode
+      on_restart(sids): A worker was restarted, and the frames in flight of
+          these sessions were lost; their pipelines start over
+    Annotated video frames are read with video_frames().
+    """
+
+    def __init__(self, num_workers, config, on_credit, on_annotations, on_restart,
+                 num_slots=16, slot_bytes=1 << 20, heartbeat_sec=1.0,
+                 heartbeat_timeout_sec=10.0, send_timeout_sec=1.0):
+        """
+        Args:
+            num_workers: Number of worker processes
+            config: Settings (app.config) for the workers
+            on_credit, on_annotations, on_restart: Callbacks; see above
+            num_slots: Number of slots in each shared memory ring; each
+                worker has one ring for frames and one for results
+            slot_bytes: Maximum size of an encoded frame
+            heartbeat_sec: Interval between heartbeats from each worker
+            heartbeat_timeout_sec: Workers not heard from for this long are
+                restarted
+            send_timeout_sec: Longest time to wait for room in a worker's
+                pipe before giving up on a message
+        """
+        if not available():
+            raise RuntimeError("Worker processes need Python 3.8 or later "
+                               "(multiprocessing.shared_memory)")
+        self.num_workers = num_workers
+        self.config = config
+        self.on_credit = on_credit
+        self.on_annotations = on_annotations
+        self.on_restart = on_restart
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.heartbeat_sec = heartbeat_sec
+        self.heartbeat_timeout_sec = heartbeat_timeout_sec
+        self.send_timeout_sec = send_timeout_sec
+
+        # gevent does not mix with fork, so start the workers from scratch.
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = []
+
+        # Worker index of each open session, and its output mode and credits
+        # for reopening it after a restart
+        self._sessions = {}
+
+        # Annotated frames waiting to be sent, as (multipart chunk,
+        # received_ts), for each session in 'video' output mode. Only the
+        # most recent few are kept.
+        self._video = {}
+
+        # Number of times a worker has been restarted
+        self.num_restarts = 0
+        self._monitor_thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        for index in range(self.num_workers):
+            self._workers.append(self._start_worker(index))
+        self._monitor_thread = threading.Thread(target=self._monitor, daemon=True)
+        self._monitor_thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        for worker in self._workers:
+            worker.stop()
+
+    @property
+    def num_alive(self):
+        return sum(1 for w in self._workers if w.process.is_alive())
+
+    def open(self, sid, output_mode, credits):
+        """Pin a new session to the worker with the fewest sessions."""
+        counts = [0] * self.num_workers
+        for index, _, _ in self._sessions.values():
+            counts[index] += 1
+        index = counts.index(min(counts))
+        self._sessions[sid] = (index, output_mode, credits)
+        if output_mode == 'video':
+            self._video[sid] = queue.Queue(maxsize=2)
+        self._workers[index].send(('open', sid, output_mode, credits), self.send_timeout_sec)
+
+    def close(self, sid):
+        entry = self._sessions.pop(sid, None)
+        self._video.pop(sid, None)
+        if entry is not None:
+            self._workers[entry[0]].send(('close', sid), self.send_timeout_sec)
+
+    def put_frame(self, sid, frame, frame_id, received_ts):
+        """
+        Hand an encoded frame to the worker of a session.
+
+        Returns False if the frame could not be handed over, because the
+        session is unknown or its worker is not keeping up.
+        """
+        entry = self._sessions.get(sid)
+        if entry is None:
+            return False
+        worker = self._workers[entry[0]]
+        slot = worker.in_ring.write(frame)
+        if slot is None:
+            return False
+        if not worker.send(('frame', sid, slot, len(frame), frame_id, received_ts),
+                           self.send_timeout_sec):
+            # The worker will never read the slot, so free it for the next
+            # frame.
+            worker.in_ring.release(slot)
+            return False
+        return True
+
+    def video_frames(self, sid, poll_sec=1.0):
+        """Yields the (multipart chunk, received_ts) results of a session in
+        'video' output mode, until the session is closed."""
+        frames = self._video.get(sid)
+        while frames is not None and self._video.get(sid) is frames:
+            try:
+                yield frames.get(timeout=poll_sec)
+            except queue.Empty:
+                pass
+
+    def _start_worker(self, index):
+        worker = _Worker(index, self._context, self.num_slots, self.slot_bytes,
+                         self.config, self.heartbeat_sec)
+        threading.Thread(target=self._read, args=(worker,), daemon=True).start()
+        return worker
+
+    def _read(self, worker):
+        """Reader greenlet: handle the messages from one worker."""
+        while not worker.stopped:
+            try:
+                wait_read(worker.conn.fileno())
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                # The worker has died; the monitor will restart it.
+                return
+            worker.last_heard = time.time()
+            kind = message[0]
+            if kind == 'credit':
+                self.on_credit(message[1], message[2])
+            elif kind == 'video':
+                _, sid, slot, length, received_ts = message
+                chunk = worker.out_ring.read(slot, length)
+                frames = self._video.get(sid)
+                if frames is not None:
+                    # Drop the oldest frame if the browser isn't keeping up.
+                    if frames.full():
+                        try:
+                            frames.get_nowait()
+                        except queue.Empty:
+                            pass
+                    frames.put_nowait((chunk, received_ts))
+            elif kind == 'annotations':
+                self.on_annotations(message[1], message[2], message[3])
+            elif kind == 'closed':
+                # Evicted by the worker after going idle
+                entry = self._sessions.get(message[1])
+                if entry is not None and entry[0] == worker.index:
+                    self._sessions.pop(message[1])
+                    self._video.pop(message[1], None)
+
+    def _monitor(self):
+        """Monitor greenlet: restart workers that die or hang."""
+        while self._running:
+            time.sleep(self.heartbeat_sec)
+            for index, worker in enumerate(self._workers):
+                if not self._running:
+                    return
+                silent_sec = time.time() - worker.last_heard
+                if worker.process.is_alive() and silent_sec < self.heartbeat_timeout_sec:
+                    continue
+                print("Restarting worker {} (exit code {}, last heard from {:.1f} s ago)"
+                      "".format(index, worker.process.exitcode, silent_sec))
+                worker.stop()
+                self._workers[index] = self._start_worker(index)
+                self.num_restarts += 1
+                sids = [sid for sid, entry in self._sessions.items() if entry[0] == index]
+                for sid in sids:
+                    _, output_mode, credits = self._sessions[sid]
+                    self._workers[index].send(('open', sid, output_mode, credits),
+                                              self.send_timeout_sec)
+                self.on_restart(sids)